@@ -0,0 +1,270 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Local stand-in for the fichub.net API, for the offline benchmarks.
+
+    Implements /api/v0/epub & the cache urls of the ebooks, with a
+    configurable latency, generation delay (on the first request of a fic),
+    429/5xx injection, file sizes, Range support & truncated downloads.
+    The ebooks are generated from the fic id, so their content & md5 hash
+    are stable between requests.
+
+    Usage: python benchmarks/mock_api.py [--port 8080] [--latency 0.02]
+                                         [--generation-delay 0.1]
+                                         [--rate-limit-rate 0.01] [--file-size 65536]
+
+    The bound address is printed on the first line, use --port 0 for
+    a free port.
+"""
+
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockSettings:
+    def __init__(self, latency: float = 0, generation_delay: float = 0,
+                 rate_limit_rate: float = 0, server_error_rate: float = 0,
+                 retry_after: int = 1, file_size: int = 64 * 1024,
+                 size_jitter: float = 0, range_support: bool = True,
+                 truncate_rate: float = 0, seed: int = 0):
+        self.latency = latency
+        self.generation_delay = generation_delay
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.retry_after = retry_after
+        self.file_size = file_size
+        self.size_jitter = size_jitter
+        self.range_support = range_support
+        self.truncate_rate = truncate_rate
+        self.truncate_next = 0  # number of the next downloads to truncate
+        self.range_requests = 0
+        self.conditional_requests = 0
+        self.range_shift = 0  # bytes added to the start of the ranges served
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.generated = set()  # fic ids already generated
+        self.hashes = {}
+        self.block = bytes(range(256)) * (file_size // 256 + 1)
+        self.started_at = formatdate(time.time(), usegmt=True)
+
+    def fic_id(self, url: str) -> str:
+        return hashlib.md5(url.encode("utf-8")).hexdigest()[:10]
+
+    def size(self, fic_id: str) -> int:
+        if not self.size_jitter:
+            return self.file_size
+        jitter = random.Random(fic_id).uniform(-self.size_jitter, self.size_jitter)
+        return max(1, int(self.file_size * (1 + jitter)))
+
+    def ebook(self, fic_id: str) -> bytes:
+        size = self.size(fic_id)
+        header = f"mock ebook {fic_id}\n".encode("utf-8")
+        body = header + self.block * (size // len(self.block) + 1)
+        return body[:size]
+
+    def ebook_hash(self, fic_id: str) -> str:
+        with self.lock:
+            if fic_id not in self.hashes:
+                self.hashes[fic_id] = hashlib.md5(self.ebook(fic_id)).hexdigest()
+            return self.hashes[fic_id]
+
+    def inject_error(self) -> int:
+        """ Returns the status code of the injected error or None """
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.server_error_rate:
+            return 503
+        return None
+
+    def truncate(self) -> bool:
+        """ Returns True if the download should be cut in the middle """
+        with self.lock:
+            if self.truncate_next > 0:
+                self.truncate_next -= 1
+                return True
+            return self.truncate_rate > 0 and \
+                self.random.random() < self.truncate_rate
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    settings: MockSettings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        settings = self.settings
+        if settings.latency:
+            time.sleep(settings.latency)
+
+        error = settings.inject_error()
+        if error:
+            return self.send_body(
+                error, b'{"err": 1, "msg": "injected error"}',
+                {"Retry-After": str(settings.retry_after)})
+
+        parts = urlsplit(self.path)
+        if parts.path == "/api/v0/epub":
+            return self.api_epub(parse_qs(parts.query).get("q", [""])[0])
+
+        match = re.fullmatch(r"/cache/(epub|mobi|pdf|html)/(\w+)/[^/]+", parts.path)
+        if match:
+            return self.cache(match.group(2))
+
+        self.send_body(404, b'{"err": 1, "msg": "not found"}')
+
+    def api_epub(self, url: str):
+        settings = self.settings
+        fic_id = settings.fic_id(url)
+        with settings.lock:
+            generated = fic_id in settings.generated
+            settings.generated.add(fic_id)
+        if not generated and settings.generation_delay:
+            time.sleep(settings.generation_delay)
+
+        ebook_hash = settings.ebook_hash(fic_id)
+        name = f"Mock-Fic-by-Author-{fic_id}"
+        response = {
+            "err": 0,
+            "meta": {
+                "id": fic_id, "title": f"Mock Fic {fic_id}",
+                "author": "Author", "authorId": "1", "authorLocalId": "1",
+                "chapters": 10, "created": "2021-01-01T00:00:00",
+                "updated": "2021-06-01T00:00:00", "status": "complete",
+                "source": url, "words": 10000, "extraMeta": None,
+                "rawExtendedMeta": None,
+            },
+            "urls": {
+                fmt: f"/cache/{fmt}/{fic_id}/{name}.{ext}?h={ebook_hash}"
+                for fmt, ext in (("epub", "epub"), ("mobi", "mobi"),
+                                 ("pdf", "pdf"), ("html", "zip"))
+            },
+            "hashes": {"epub": ebook_hash},
+        }
+        self.send_body(200, json.dumps(response).encode("utf-8"),
+                       {"Content-Type": "application/json"})
+
+    def cache(self, fic_id: str):
+        settings = self.settings
+        etag = f'"{settings.ebook_hash(fic_id)}"'
+        headers = {"ETag": etag, "Last-Modified": settings.started_at,
+                   "Content-Type": "application/octet-stream"}
+        if self.headers.get("If-None-Match"):
+            with settings.lock:
+                settings.conditional_requests += 1
+        if self.headers.get("If-None-Match") == etag:
+            return self.send_body(304, b"", headers)
+
+        body, status = settings.ebook(fic_id), 200
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if settings.range_support:
+            headers["Accept-Ranges"] = "bytes"
+            if match and if_range in (None, etag, settings.started_at):
+                with settings.lock:
+                    settings.range_requests += 1
+                start = int(match.group(1)) + settings.range_shift
+                if start >= len(body):
+                    return self.send_body(
+                        416, b"", {"Content-Range": f"bytes */{len(body)}"})
+                headers["Content-Range"] = \
+                    f"bytes {start}-{len(body) - 1}/{len(body)}"
+                body, status = body[start:], 206
+
+        self.send_body(status, body, headers, settings.truncate())
+
+    def send_body(self, status: int, body: bytes, headers: dict = None,
+                  truncate: bool = False):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if truncate:  # closes the connection in the middle of the body
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        elif status != 304:
+            self.wfile.write(body)
+
+
+class MockServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # the client closing the connection early (e.g. on a 429) is expected
+        pass
+
+
+def make_server(settings: MockSettings, host: str = "127.0.0.1",
+                port: int = 0) -> ThreadingHTTPServer:
+    handler = type("Handler", (MockHandler,), {"settings": settings})
+    server = MockServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock fichub.net API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Delay of every response, in seconds")
+    parser.add_argument("--generation-delay", type=float, default=0,
+                        help="Extra delay of the first API request of a fic, in seconds")
+    parser.add_argument("--rate-limit-rate", type=float, default=0,
+                        help="Fraction of the requests answered with 429")
+    parser.add_argument("--server-error-rate", type=float, default=0,
+                        help="Fraction of the requests answered with 503")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="Retry-After of the injected errors, in seconds")
+    parser.add_argument("--file-size", type=int, default=64 * 1024,
+                        help="Size of the ebooks, in bytes")
+    parser.add_argument("--size-jitter", type=float, default=0,
+                        help="Random variation of the ebook sizes, e.g. 0.5 for +/-50%%")
+    parser.add_argument("--no-range", action="store_true",
+                        help="Ignore the Range requests")
+    parser.add_argument("--truncate-rate", type=float, default=0,
+                        help="Fraction of the downloads cut in the middle")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    settings = MockSettings(
+        latency=args.latency, generation_delay=args.generation_delay,
+        rate_limit_rate=args.rate_limit_rate,
+        server_error_rate=args.server_error_rate,
+        retry_after=args.retry_after, file_size=args.file_size,
+        size_jitter=args.size_jitter, range_support=not args.no_range,
+        truncate_rate=args.truncate_rate, seed=args.seed)
+    server = make_server(settings, args.host, args.port)
+    print(f"http://{server.server_address[0]}:{server.server_address[1]}",
+          flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Startup benchmark of the CLI.
+
+    Measures the cold-start wall time & the import time of the commands
+    that don't download anything, in fresh processes. Fails if a command
+    is slower than the budget or imports one of the modules kept off the
+    startup path.
+
+    Usage: python benchmarks/startup.py [--runs 10] [--budget 500]
+                                        [--output bench_output.txt]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+COMMANDS = [["--version"], ["-ss"], ["--config-info"]]
+# imported only by the download code
+LAZY_MODULES = ["requests", "loguru", "bs4", "urllib3"]
+CLI = "from fichub_cli.cli import app; app()"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_cli(args: list, importtime: bool = False) -> subprocess.CompletedProcess:
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) \
+        + ["-c", CLI] + args
+    return subprocess.run(cmd, cwd=ROOT, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def import_times(stderr: str) -> dict:
+    """ Parses the -X importtime output into {module: cumulative us} """
+    times = {}
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            times[match.group(3)] = int(match.group(1))
+    return times
+
+
+def bench(args: list, runs: int) -> dict:
+    run_cli(args)  # warm up the OS file cache
+    wall_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_cli(args)
+        wall_times.append((time.perf_counter() - start) * 1000)
+
+    times = import_times(run_cli(args, importtime=True).stderr)
+    return {
+        "command": " ".join(args),
+        "wall_median": statistics.median(wall_times),
+        "wall_min": min(wall_times),
+        "import_cli": times.get("fichub_cli.cli", 0) / 1000,
+        "lazy_imported": [module for module in LAZY_MODULES if module in times],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark of the CLI")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="Number of runs per command (default: 10)")
+    parser.add_argument("--budget", type=float, default=0,
+                        help="Max median wall time in ms (default: no budget)")
+    parser.add_argument("--output", default="",
+                        help="Also write the results to this file")
+    args = parser.parse_args()
+
+    lines = [f"{'command':<16}{'wall median':>14}{'wall min':>12}"
+             f"{'import cli':>13}  lazy modules imported"]
+    failed = False
+    for command in COMMANDS:
+        result = bench(command, args.runs)
+        lines.append(
+            f"{result['command']:<16}{result['wall_median']:>11.1f} ms"
+            f"{result['wall_min']:>9.1f} ms{result['import_cli']:>10.1f} ms"
+            f"  {', '.join(result['lazy_imported']) or '-'}")
+        if result["lazy_imported"] or \
+                (args.budget and result["wall_median"] > args.budget):
+            failed = True
+
+    output = "\n".join(lines)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
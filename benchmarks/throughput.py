@@ -0,0 +1,187 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Offline throughput benchmark of the batch downloads.
+
+    Starts the mock API (benchmarks/mock_api.py) in a subprocess & runs
+    FetchData batches against it, each batch in a fresh process & a temp
+    directory, so the peak RSS, the resume state & the metadata cache are
+    per batch. Reports the URLs/s, bytes/s, peak RSS & p50/p95 per-URL
+    latency (metadata request to file saved).
+
+    Usage: python benchmarks/throughput.py [--batches 10,1000,10000]
+                                           [--workers 8] [--latency 0.01]
+                                           [--output bench_output.txt]
+
+    The mock API options (--latency, --generation-delay, --rate-limit-rate,
+    --server-error-rate, --retry-after, --file-size, --size-jitter) are
+    passed through.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+MOCK_OPTIONS = ["latency", "generation_delay", "rate_limit_rate",
+                "server_error_rate", "retry_after", "file_size", "size_jitter"]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def run_batch(api_url: str, batch: int, workers: int, meta_workers: int):
+    """ Runs one batch in the current process, prints the results as JSON """
+    import resource
+
+    work_dir = tempfile.mkdtemp(prefix="fichub_bench_")
+    # keeps the app dir (metadata cache, config) out of the user's
+    os.environ["XDG_DATA_HOME"] = os.path.join(work_dir, "data")
+    os.chdir(work_dir)  # the resume state is saved in the current directory
+    sys.path.insert(0, ROOT)
+
+    from fichub_cli.utils.fetch_data import FetchData
+    from fichub_cli.utils.fichub import FicHubSession
+    from fichub_cli.utils.url_stream import UrlStream
+
+    class TimedFetchData(FetchData):
+        """ Records the latency of each url, from the metadata request
+            to the files saved
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.started = {}
+            self.latencies = []
+
+        def resolve_url(self, url):
+            self.started[url] = time.perf_counter()
+            fic, outcome, exit_status = super().resolve_url(url)
+            if fic is None:
+                self.latencies.append(time.perf_counter() - self.started[url])
+            return fic, outcome, exit_status
+
+        def download_fic(self, url, fic):
+            result = super().download_fic(url, fic)
+            self.latencies.append(time.perf_counter() - self.started[url])
+            return result
+
+    out_dir = os.path.join(work_dir, "out")
+    os.makedirs(out_dir)
+    session = FicHubSession(pool_size=max(10, workers + meta_workers),
+                            base_url=api_url)
+    fic = TimedFetchData(out_dir=out_dir, workers=workers,
+                         meta_workers=meta_workers, session=session)
+    urls = [f"https://archiveofourown.org/works/{work_id}"
+            for work_id in range(1, batch + 1)]
+
+    # the progress bar & the logs are not part of the results
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        start = time.perf_counter()
+        try:
+            fic.download_urls(UrlStream(urls, len(urls)))
+        finally:
+            elapsed = time.perf_counter() - start
+            sys.stdout = stdout
+
+    total_bytes = sum(entry.stat().st_size for entry in os.scandir(out_dir)
+                      if entry.is_file())
+    files = sum(1 for entry in os.scandir(out_dir) if entry.name.endswith(".epub"))
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":  # KiB on Linux, bytes on macOS
+        peak_rss *= 1024
+
+    print(json.dumps({
+        "batch": batch, "files": files, "elapsed": elapsed,
+        "urls_per_s": batch / elapsed, "bytes_per_s": total_bytes / elapsed,
+        "peak_rss": peak_rss, "connections": session.connection_stats(),
+        "p50": percentile(fic.latencies, 50), "p95": percentile(fic.latencies, 95),
+    }))
+
+
+def start_mock(args) -> tuple:
+    cmd = [sys.executable, os.path.join(BENCH_DIR, "mock_api.py"), "--port", "0"]
+    for option in MOCK_OPTIONS:
+        cmd += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+    server = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    return server, server.stdout.readline().strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark")
+    parser.add_argument("--batches", default="10,1000,10000",
+                        help="Comma separated batch sizes (default: 10,1000,10000)")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--meta-workers", type=int, default=0)
+    parser.add_argument("--output", default="",
+                        help="Also write the results to this file")
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--generation-delay", type=float, default=0.05)
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    parser.add_argument("--server-error-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--size-jitter", type=float, default=0)
+    # internal: runs a single batch against the given api
+    parser.add_argument("--run-batch", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--api-url", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    meta_workers = args.meta_workers or args.workers
+
+    if args.run_batch:
+        return run_batch(args.api_url, args.run_batch, args.workers, meta_workers)
+
+    server, api_url = start_mock(args)
+    lines = [f"Mock API: {api_url} | workers: {args.workers} | meta workers: "
+             f"{meta_workers} | latency: {args.latency}s | generation delay: "
+             f"{args.generation_delay}s | file size: {args.file_size} B",
+             f"{'batch':>7}{'files':>7}{'elapsed':>10}{'URLs/s':>9}{'MiB/s':>9}"
+             f"{'peak RSS':>11}{'p50':>9}{'p95':>9}{'conns':>7}"]
+    try:
+        for batch in (int(batch) for batch in args.batches.split(",")):
+            # a fresh process per batch, for the peak RSS
+            result = subprocess.run(
+                [sys.executable, __file__, "--run-batch", str(batch),
+                 "--api-url", api_url, "--workers", str(args.workers),
+                 "--meta-workers", str(meta_workers)],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True, check=True)
+            r = json.loads(result.stdout.strip().splitlines()[-1])
+            lines.append(
+                f"{r['batch']:>7}{r['files']:>7}{r['elapsed']:>9.2f}s"
+                f"{r['urls_per_s']:>9.1f}{r['bytes_per_s'] / 2**20:>9.2f}"
+                f"{r['peak_rss'] / 2**20:>7.1f} MiB{r['p50'] * 1000:>7.0f}ms"
+                f"{r['p95'] * 1000:>7.0f}ms{r['connections']['connections']:>7}")
+            print(lines[-1] if len(lines) > 3 else "\n".join(lines), flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,38 +14,30 @@
 from platformdirs import PlatformDirs
 import typer
 import sys
-from loguru import logger
+import os
 from datetime import datetime
+from typing import List
 from colorama import init, Fore, Style
 
-import importlib
-import pkgutil
-
-from .utils.fetch_data import FetchData
+# requests & loguru are imported with the download code, only when a url
+# is given, to keep them off the startup path
+from .utils.config import get_config
+from .utils.output import set_output_mode, summary
+from .utils.plugins import plugin_group
 from .utils.processing import get_format_type, out_dir_exists_check, \
-     appdir_builder, appdir_config_info, check_cli_outdated, output_log_cleanup
+     appdir_builder, appdir_config_info, check_cli_outdated, output_log_cleanup, \
+     parse_duration, parse_shard
 from fichub_cli import __version__
 
 init(autoreset=True)  # colorama init
 timestamp = datetime.now().strftime("%Y-%m-%d T%H%M%S")
 
-app = typer.Typer(add_completion=False)
 app_dirs = PlatformDirs("fichub_cli", "fichub")
-discovered_plugins = {
-    name: importlib.import_module(name)
-    for finder, name, ispkg
-    in pkgutil.iter_modules()
-    if name.startswith('fichub_cli_')
-}
-for plugin in discovered_plugins.values():
-    if not plugin.__name__.endswith("-script"):
-        app.add_typer(plugin.app)
-
-# build/update the app directory & the config file
-appdir_builder(app_dirs)
+# the plugins are discovered & imported only when their sub-command is used
+app = typer.Typer(add_completion=False, cls=plugin_group(app_dirs))
 
-# check if the cli is outdated
-check_cli_outdated("fichub-cli", __version__)
+# loaded once, on first use
+config = get_config(app_dirs)
 
 
 # @logger.catch  # for internal debugging
@@ -73,6 +65,33 @@ def default(
     force: bool = typer.Option(
         False, "--force", help="Force overwrite of an existing file", is_flag=True),
 
+    workers: int = typer.Option(
+        1, "-w", "--workers", help="Number of concurrent downloads when using -i or -l (default: 1)"),
+
+    meta_workers: int = typer.Option(
+        0, "--meta-workers", help="Number of concurrent metadata requests when using -i or -l (default: same as --workers)"),
+
+    lookahead: int = typer.Option(
+        0, "--lookahead", help="Number of fics resolved ahead of the downloads when using -i or -l (default: 2x --meta-workers)"),
+
+    pool_size: int = typer.Option(
+        0, "--pool-size", help="Number of pooled HTTP connections (default: --workers + --meta-workers, min 10)"),
+
+    keep_alive: bool = typer.Option(
+        True, "--keep-alive/--no-keep-alive", help="Reuse the HTTP connections between requests"),
+
+    max_rate: float = typer.Option(
+        0, "--max-rate", help="Max API requests per second, lowered automatically when rate limited (default: 0, no limit)"),
+
+    max_age: str = typer.Option(
+        "0", "--max-age", help="Use the cached metadata of the urls checked within this duration, e.g. 30m, 12h or 1d (default: 0, always call the API)"),
+
+    shard: str = typer.Option(
+        "", "--shard", help="Only process the urls of the i-th of N shards, given as i/N, to split the urls across machines"),
+
+    update_library: bool = typer.Option(
+        False, "--update-library", help="Check the fics downloaded to the output directory for updates & download the changed ones", is_flag=True),
+
     supported_sites: bool = typer.Option(
         False, "-ss", "--supported-sites", help="List of supported sites", is_flag=True),
 
@@ -82,6 +101,15 @@ def default(
     changelog: bool = typer.Option(
         False, "--changelog", help="Save the changelog file", is_flag=True),
 
+    stats: str = typer.Option(
+        "", "--stats", help="Save the per-url timings to this file as JSON Lines & show a summary"),
+
+    output: str = typer.Option(
+        "text", "--output", help="Output of the run: text (default) or json, one JSON object per line & event"),
+
+    quiet: bool = typer.Option(
+        False, "-q", "--quiet", help="Only show the progress bar & the summary", is_flag=True),
+
     debug_log: bool = typer.Option(
         False, "--debug-log", help="Save the logfile for debugging", is_flag=True),
 
@@ -91,6 +119,9 @@ def default(
     config_info: bool = typer.Option(
         False, "--config-info", help="Show the CLI config info", is_flag=True),
 
+    export_logs: bool = typer.Option(
+        False, "--export-logs", help="Write the resume state to output.log & err.log", is_flag=True),
+
     automated: bool = typer.Option(
         False, "-a", "--automated", help="For internal testing only", is_flag=True, hidden=True),
 
@@ -104,9 +135,20 @@ def default(
 
     To report issues for the CLI, open an issue at https://github.com/FicHub/fichub-cli/issues
 
-    Failed downloads will be saved in the `err.log` file in the current directory
+    Processed & failed downloads will be saved in the `fichub_cli_state.db`
+    file in the current directory, use --export-logs to write them to the
+    `output.log` & `err.log` files
     """
 
+    set_output_mode(output, quiet)
+
+    # build the app directory, the config file is only written if it's
+    # missing or outdated
+    config.save()
+
+    # check if the cli is outdated, without blocking
+    check_cli_outdated("fichub-cli", __version__, app_dirs)
+
     if config_init:
         # initialize/overwrite the config files
         appdir_builder(app_dirs, True)
@@ -115,6 +157,11 @@ def default(
         # show the config files and info
         appdir_config_info(app_dirs)
 
+    if export_logs:
+        from .utils.state import get_state
+        get_state().export_logs()
+        typer.echo(Fore.GREEN + "Exported the resume state to output.log & err.log")
+
     # Check if the output directory exists if input is given
     if not out_dir == "":
         out_dir_exists_check(out_dir)
@@ -126,6 +173,7 @@ def default(
         return
 
     if debug_log:
+        from loguru import logger
         logger.remove()  # remove all existing handlers
         logger.add(f"fichub_cli - {timestamp}.log")
         debug = True
@@ -135,25 +183,55 @@ def default(
             Fore.GREEN + " in the current directory!" + Style.RESET_ALL)
 
     format_type = get_format_type(format)
+    max_age = parse_duration(max_age)
+    shard = parse_shard(shard) if shard else None
+    if infile or list_url or url or update_library:
+        from .utils.fetch_data import FetchData
+        from .utils.fichub import FicHubSession
+
+        # one pooled HTTP session shared by the whole run
+        if pool_size <= 0:
+            pool_size = max(10, workers + (meta_workers or workers))
+        session = FicHubSession(pool_size=pool_size, keep_alive=keep_alive,
+                                config=config, max_rate=max_rate, debug=debug)
+
     if infile:
         fic = FetchData(format_type=format_type, out_dir=out_dir, force=force,
                         debug=debug, changelog=changelog,
-                        automated=automated, verbose=verbose)
+                        automated=automated, verbose=verbose,
+                        workers=workers, meta_workers=meta_workers,
+                        lookahead=lookahead, session=session,
+                        max_age=max_age, config=config,
+                        stats_file=stats or None, shard=shard)
         fic.get_fic_with_infile(infile)
 
     elif list_url:
         fic = FetchData(format_type=format_type, out_dir=out_dir, force=force,
                         debug=debug, changelog=changelog,
-                        automated=automated, verbose=verbose)
+                        automated=automated, verbose=verbose,
+                        workers=workers, meta_workers=meta_workers,
+                        lookahead=lookahead, session=session,
+                        max_age=max_age, config=config,
+                        stats_file=stats or None, shard=shard)
         fic.get_fic_with_list(list_url)
 
     elif url:
         fic = FetchData(format_type=format_type, out_dir=out_dir, force=force,
-                        debug=debug, automated=automated, verbose=verbose)
+                        debug=debug, automated=automated, verbose=verbose,
+                        session=session, max_age=max_age, config=config,
+                        stats_file=stats or None)
         fic.get_fic_with_url(url)
 
+    elif update_library:
+        fic = FetchData(format_type=format_type, out_dir=out_dir, force=force,
+                        debug=debug, automated=automated, verbose=verbose,
+                        workers=workers, meta_workers=meta_workers,
+                        lookahead=lookahead, session=session,
+                        max_age=max_age, config=config,
+                        stats_file=stats or None, shard=shard)
+        fic.update_library()
+
     if version:
-        from . import __version__
         typer.echo(f"fichub-cli: v{__version__}")
 
     if supported_sites:
@@ -185,7 +263,7 @@ To report issues upstream for these sites, visit https://fichub.net/#contact
 
     try:
         if fic.exit_status == 1:
-            typer.echo(
+            summary(
                 Fore.RED +
                 "\nThe CLI ran into some errors! Check the console for the log messages!" + Style.RESET_ALL)
 
@@ -196,3 +274,164 @@ To report issues upstream for these sites, visit https://fichub.net/#contact
     # UnboundLocalError: 'fic' is not assigned value for --version flag
     except (FileNotFoundError, UnboundLocalError):
         sys.exit(0)
+
+
+@app.command()
+def scan(
+    out_dir: str = typer.Option(
+        "", "-o", " --out-dir", help="Path to the directory of the epub files (default: Current Directory)"),
+
+    workers: int = typer.Option(
+        0, "-w", "--workers", help="Number of processes reading the files (default: number of CPUs)"),
+
+    force: bool = typer.Option(
+        False, "--force", help="Scan the files already recorded again", is_flag=True),
+
+    resume_state: bool = typer.Option(
+        False, "--resume-state", help="Also mark the urls as processed in the resume state of the current directory", is_flag=True),
+):
+    """
+    Record the epub files of a directory, for --update-library
+
+    The url of each fic is read from the metadata of the epub & recorded
+    with the hash of the file in the manifest of the directory.
+    """
+    from .utils.scan import scan_library
+
+    if out_dir and not os.path.isdir(out_dir):
+        raise typer.BadParameter(f"Directory doesn't exist: {out_dir}")
+    scan_library(out_dir, workers, force, resume_state)
+
+
+@app.command()
+def verify(
+    out_dir: str = typer.Option(
+        "", "-o", " --out-dir", help="Path to the Output directory to verify (default: Current Directory)"),
+
+    workers: int = typer.Option(
+        0, "-w", "--workers", help="Number of processes hashing the files (default: number of CPUs)"),
+
+    fetch: bool = typer.Option(
+        False, "--fetch", help="Fetch the metadata of the fics to find the files saved from an older version", is_flag=True),
+
+    meta_workers: int = typer.Option(
+        4, "--meta-workers", help="Number of concurrent metadata requests with --fetch (default: 4)"),
+
+    max_age: str = typer.Option(
+        "0", "--max-age", help="Use the cached metadata of the urls checked within this duration, e.g. 30m, 12h or 1d (default: 0, always call the API)"),
+
+    debug: bool = typer.Option(
+        False, "-d", " --debug", help="Show the log in the console for debugging", is_flag=True),
+):
+    """
+    Check the files of an output directory against the recorded hashes
+
+    Reports the corrupt & missing files and with --fetch, the files saved
+    from an older version of the fic. Use --update-library to download them.
+    """
+    from .utils.verify import verify_library
+
+    if out_dir and not os.path.isdir(out_dir):
+        raise typer.BadParameter(f"Directory doesn't exist: {out_dir}")
+    fetch_data = None
+    if fetch:
+        from .utils.fetch_data import FetchData
+        from .utils.fichub import FicHubSession
+
+        session = FicHubSession(pool_size=max(10, meta_workers), config=config,
+                                debug=debug)
+        fetch_data = FetchData(out_dir=out_dir, debug=debug,
+                               meta_workers=meta_workers, session=session,
+                               max_age=parse_duration(max_age), config=config)
+    counts = verify_library(out_dir, workers, fetch_data)
+    sys.exit(1 if counts["corrupt"] or counts["missing"] else 0)
+
+
+@app.command()
+def merge(
+    shard_dirs: List[str] = typer.Argument(
+        ..., help="Directories of the shards, with their resume state, logs & changelogs"),
+
+    out_dir: str = typer.Option(
+        "", "-o", " --out-dir", help="Directory of the merged state, logs & changelog (default: Current Directory)"),
+):
+    """
+    Merge the resume state, logs & changelogs of the --shard runs
+
+    The most recent status of each url is kept & the merged state is
+    exported to the output.log & err.log of the output directory.
+    """
+    from .utils.merge import merge_shards
+
+    for directory in list(shard_dirs) + ([out_dir] if out_dir else []):
+        if not os.path.isdir(directory):
+            raise typer.BadParameter(f"Directory doesn't exist: {directory}")
+    merge_shards(shard_dirs, out_dir)
+
+
+@app.command()
+def serve(
+    host: str = typer.Option(
+        "127.0.0.1", "--host", help="Address to listen on (default: 127.0.0.1)"),
+
+    port: int = typer.Option(
+        8800, "--port", help="Port to listen on (default: 8800)"),
+
+    socket: str = typer.Option(
+        "", "--socket", help="Listen on this Unix socket instead of --host & --port"),
+
+    allow_remote: bool = typer.Option(
+        False, "--allow-remote", help="Allow a --host other than the loopback. The jobs aren't authenticated!", is_flag=True),
+
+    root: str = typer.Option(
+        "", "--root", help="Directory the output directories of the jobs must be in (default: current directory)"),
+
+    workers: int = typer.Option(
+        1, "-w", "--workers", help="Number of concurrent downloads of a job (default: 1)"),
+
+    meta_workers: int = typer.Option(
+        0, "--meta-workers", help="Number of concurrent metadata requests of a job (default: same as --workers)"),
+
+    lookahead: int = typer.Option(
+        0, "--lookahead", help="Number of fics resolved ahead of the downloads (default: 2x --meta-workers)"),
+
+    pool_size: int = typer.Option(
+        0, "--pool-size", help="Number of pooled HTTP connections (default: --workers + --meta-workers, min 10)"),
+
+    max_rate: float = typer.Option(
+        0, "--max-rate", help="Max API requests per second, lowered automatically when rate limited (default: 0, no limit)"),
+
+    debug: bool = typer.Option(
+        False, "-d", " --debug", help="Show the log in the console for debugging", is_flag=True),
+):
+    """
+    Run a server accepting download jobs, with a warm HTTP session
+
+    POST a JSON job like {"urls": [...], "format": "epub", "out_dir": ""}
+    to /jobs, the events of the job are streamed back as JSON Lines.
+    The out_dir of a job is relative to --root & must be inside it.
+    GET /status shows the jobs & connections of the server.
+    """
+    from .utils.fichub import FicHubSession
+    from .utils.serve import JobRunner, make_server
+
+    if pool_size <= 0:
+        pool_size = max(10, workers + (meta_workers or workers))
+    session = FicHubSession(pool_size=pool_size, config=config,
+                            max_rate=max_rate, debug=debug)
+    runner = JobRunner(session, config, workers=workers,
+                       meta_workers=meta_workers, lookahead=lookahead,
+                       debug=debug, root=root or ".")
+    server = make_server(runner, host, port, socket, allow_remote)
+
+    address = socket or f"http://{host}:{server.server_address[1]}"
+    typer.echo(Fore.GREEN + f"Listening on {address}, press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        session.close()
+        if socket and os.path.exists(socket):
+            os.remove(socket)
@@ -0,0 +1,152 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import threading
+
+from colorama import Fore, Style
+from tqdm import tqdm
+from platformdirs import PlatformDirs
+
+CONFIG_FILE = "config.json"
+DEFAULT_CONFIG = {
+    "db_up_time_format": r"%Y-%m-%dT%H:%M:%S%z",
+    "fic_up_time_format": r"%Y-%m-%dT%H:%M:%S",
+    "delete_output_log": "",
+    "filename_format": "",
+    "api_key_v0": ""
+}
+# allowed values of the settings, the others only need to be strings
+CONFIG_CHOICES = {"delete_output_log": ("", "true", "false")}
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def get_config(app_dirs=None) -> "Config":
+    """ Returns the config of the app dir, shared by all the threads
+        in the process
+    """
+    if app_dirs is None:
+        app_dirs = PlatformDirs("fichub_cli", "fichub")
+    key = os.path.realpath(app_dirs.user_data_dir)
+    with _configs_lock:
+        if key not in _configs:
+            _configs[key] = Config(app_dirs)
+        return _configs[key]
+
+
+class Config:
+    """ Parsed & validated config.json, loaded once & reloaded only if the
+        file's mtime or size changed
+    """
+
+    def __init__(self, app_dirs):
+        self.app_dirs = app_dirs
+        self.config_file = os.path.join(app_dirs.user_data_dir, CONFIG_FILE)
+        self._lock = threading.Lock()
+        self._stat = None
+        self._raw = None  # the settings as found in the file
+        self._data = dict(DEFAULT_CONFIG)
+
+    def _reload(self):
+        try:
+            stat = os.stat(self.config_file)
+        except OSError:
+            self._stat = self._raw = None
+            self._data = dict(DEFAULT_CONFIG)
+            return
+
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if stat == self._stat:
+            return
+
+        self._stat = stat
+        try:
+            with open(self.config_file, "r") as f:
+                self._raw = json.load(f)
+            if not isinstance(self._raw, dict):
+                raise ValueError("the config must be a JSON object")
+        except (OSError, ValueError) as e:
+            tqdm.write(
+                Fore.RED + f"Invalid config file {self.config_file}: {e}. "
+                "Using the default config!" + Style.RESET_ALL)
+            self._raw = None
+            self._data = dict(DEFAULT_CONFIG)
+            return
+
+        self._data = self.validate(self._raw)
+
+    @staticmethod
+    def validate(raw: dict) -> dict:
+        """ Fills in the missing settings & replaces the invalid ones
+            with their defaults
+        """
+        data = dict(raw)
+        for key, default in DEFAULT_CONFIG.items():
+            value = data.get(key, default)
+            if not isinstance(value, str) or \
+                    value not in CONFIG_CHOICES.get(key, (value,)):
+                if key in raw:
+                    tqdm.write(
+                        Fore.RED + f"Invalid value for {key} in the config: "
+                        f"{value!r}. Using {default!r}!" + Style.RESET_ALL)
+                value = default
+            data[key] = value
+        return data
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            self._reload()
+            return self._data.get(key, default)
+
+    def __getitem__(self, key: str):
+        with self._lock:
+            self._reload()
+            return self._data[key]
+
+    def items(self):
+        with self._lock:
+            self._reload()
+            return list(self._data.items())
+
+    def save(self, show_output: bool = False):
+        """ Builds the app dir & adds the missing settings to the config
+            file. The file is only written if its content changes.
+        """
+        os.makedirs(self.app_dirs.user_data_dir, exist_ok=True)
+        with self._lock:
+            self._reload()
+            if self._raw is None and self._stat is not None:
+                return  # invalid file, left for the user to fix
+
+            if self._raw is None:
+                if show_output:
+                    tqdm.write(f"Building the config file: {self.config_file}")
+                config = dict(DEFAULT_CONFIG)
+            else:
+                if show_output:
+                    tqdm.write(
+                        f"Existing config file found: {self.config_file}. "
+                        "Updating with new config if its outdated!")
+                config = dict(DEFAULT_CONFIG, **self._raw)
+                if config == self._raw:
+                    return
+
+            temp_file = f"{self.config_file}.{os.getpid()}.tmp"
+            with open(temp_file, "w") as f:
+                json.dump(config, f)
+            os.replace(temp_file, self.config_file)
+            self._reload()
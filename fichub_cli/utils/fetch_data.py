@@ -12,26 +12,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import typer
+import os
 import sys
 from tqdm import tqdm
 from colorama import Fore
 from loguru import logger
 import traceback
+from typing import Tuple
 from platformdirs import PlatformDirs
 
-from .fichub import FicHub
+from .config import get_config
+from .fichub import FicHub, FicHubSession
+from .manifest import FILE_FORMATS, HashManifest, get_manifest
+from .pipeline import Pipeline
+from .meta_cache import MetadataCache
+from .state import get_state, ERROR_STATUS
+from .stats import RunStats, UrlTimings
+from .url_stream import UrlStream, SpillList, count_lines, iter_infile, \
+    in_shard
 from .logging import init_log, download_processing_log, \
-    verbose_log
+    verbose_log, latest_version_log
+from .output import console, summary, emit, show_progress
 from .processing import check_url, output_log_cleanup, save_data, \
-    urls_preprocessing, build_changelog
+    urls_preprocessing, build_changelog, ebook_file_names
 
 bar_format = "{l_bar}{bar}| {n_fmt}/{total_fmt}, {rate_fmt}{postfix}, ETA: {remaining}"
 app_dirs = PlatformDirs("fichub_cli", "fichub")
 
+
 class FetchData:
     def __init__(self, format_type=[0], out_dir="", force=False,
-                 debug=False, changelog=False, automated=False, verbose=False):
+                 debug=False, changelog=False, automated=False, verbose=False,
+                 workers=1, meta_workers=0, lookahead=0, session=None,
+                 max_age=0, config=None, stats_file=None, shard=None):
         self.format_type = format_type
         self.out_dir = out_dir
         self.force = force
@@ -40,6 +53,28 @@ class FetchData:
         self.automated = automated
         self.exit_status = 0
         self.verbose = verbose
+        self.workers = max(1, workers)
+        # metadata workers default to the same number as the download workers
+        self.meta_workers = meta_workers if meta_workers > 0 else self.workers
+        self.lookahead = lookahead
+        self.config = config if config is not None else get_config(app_dirs)
+        if session is None:
+            # one pooled connection per concurrent request
+            session = FicHubSession(
+                pool_size=max(10, self.workers + self.meta_workers),
+                config=self.config, debug=debug)
+        self.session = session
+        # cached metadata newer than max_age seconds skips the API call
+        self.max_age = max_age
+        self.meta_cache = MetadataCache(app_dirs)
+        self.state = get_state()
+        # timings of the urls, exported to the stats file & the changelog
+        self.stats = RunStats(stats_file, keep_urls=changelog)
+        self.show_stats = bool(stats_file)
+        self._timings = {}
+        self._bytes_saved = {}
+        # (i, N): only the urls of the i-th of N shards are processed
+        self.shard = shard
 
     def get_fic_with_infile(self, infile: str):
         if self.debug:
@@ -47,8 +82,8 @@ class FetchData:
             logger.info(f"Input file: {infile}")
 
         try:
-            with open(infile, "r") as f:
-                urls_input = f.read().splitlines()
+            # the urls are read lazily while downloading
+            total = count_lines(infile)
 
         except FileNotFoundError:
 
@@ -56,214 +91,376 @@ class FetchData:
                 logger.error(
                     f"FileNotFoundError: {infile} file could not be found. Please enter a valid file path.")
 
-            tqdm.write(
+            summary(
                 Fore.RED +
                 f"{infile} file could not be found. Please enter a valid file path.")
+            emit("fatal", reason=f"{infile} file could not be found")
             exit(1)
 
-        urls, urls_input_dedup = urls_preprocessing(urls_input, self.debug)
-        downloaded_urls, no_updates_urls, err_urls = [], [], []
+        self.download_urls(UrlStream(iter_infile(infile), total,
+                                     keep_lists=self.changelog,
+                                     shard=self.shard))
 
-        try:
-            if urls:
-                init_log(self.debug, self.force)
-                with tqdm(total=len(urls), ascii=False,
-                          unit="file", bar_format=bar_format) as pbar:
+    def get_fic_with_list(self, list_url: str):
 
-                    for url in urls:
-                        url_exit_status = 0
-                        download_processing_log(self.debug, url)
-                        supported_url, self.exit_status = check_url(
-                            url, self.debug, self.exit_status)
-                        if supported_url:
-                            try:
-                                fic = FicHub(self.debug, self.automated,
-                                             self.exit_status)
-                                fic.get_fic_metadata(url, self.format_type)
-
-                                if self.verbose:
-                                    verbose_log(self.debug, fic)
-
-                                # update the exit status
-                                self.exit_status = fic.exit_status
-
-                                if not fic.files:
-                                    self.exit_status = 1
-
-                                else:
-                                    self.exit_status, url_exit_status = save_data(
-                                        self.out_dir, fic.files,
-                                        self.debug, self.force,
-                                         self.exit_status,
-                                        self.automated)
-
-                                    with open("output.log", "a") as file:
-                                        file.write(f"{url}\n")
-
-                                    if url_exit_status == 0:
-                                        downloaded_urls.append(url)
-                                    else:
-                                        no_updates_urls.append(url)
-                                pbar.update(1)
-
-                            # Error: 'FicHub' object has no attribute 'files'
-                            # Reason: Unsupported URL
-                            except Exception as e:
-                                if self.debug:
-                                    logger.error(str(traceback.format_exc()))
-                                err_urls.append(url)
-                                pbar.update(1)
-                                self.exit_status = 1
-                                pass  # skip the unsupported url
-
-                        else:  # skip the unsupported url
-                            err_urls.append(url)
-                            pbar.update(1)
-                            continue
+        if self.debug:
+            logger.info("-l flag used!")
+
+        urls_input = list_url.split(",")
+        self.download_urls(UrlStream(urls_input, len(urls_input),
+                                     keep_lists=self.changelog,
+                                     shard=self.shard))
+
+    def get_fic_with_url(self, url_input: str):
+
+        if self.debug:
+            logger.info("-u flag used!")
 
+        url, _ = urls_preprocessing([url_input], self.debug)
+        if url:
+            if url[0]:
+                init_log(self.debug, self.force)
+                with tqdm(total=1, ascii=False, unit="file",
+                          bar_format=bar_format,
+                          disable=not show_progress()) as pbar:
+
+                    fic, outcome, self.exit_status = self.process_url(url[0])
+                    self.state.record(url[0], outcome or ERROR_STATUS,
+                                      getattr(fic, "cache_hash", None))
+                    self.record_timings(url[0], outcome, self.exit_status)
+                    pbar.update(1)
+                emit("summary", urls=1, downloaded=int(outcome == "downloaded"),
+                     no_updates=int(outcome == "no_updates"),
+                     errors=int(outcome not in ("downloaded", "no_updates")),
+                     bytes=self.stats.bytes, retries=self.stats.retries,
+                     exit_status=self.exit_status)
+                self.session.log_stats(self.debug)
+                self.log_stats()
+                self.stats.close()
+                self.meta_cache.close()
+                self.state.flush()
             else:
-                typer.echo(Fore.RED +
-                           "No new urls found! If output.log exists, please clear it.")
+                summary(Fore.RED +
+                        "No new urls found! To check them again, delete the output.log when prompted.")
+
+    def download_urls(self, stream: UrlStream):
+        """ Download the urls given as input by the -i & -l flags,
+            sequentially or using a pool of workers. The urls are
+            preprocessed lazily by the UrlStream.
+        """
+        downloaded_urls = SpillList(self.changelog)
+        no_updates_urls = SpillList(self.changelog)
+        err_urls = SpillList(self.changelog)
+
+        console(Fore.BLUE + f"URLs found: {stream.total}")
+        emit("start", urls=stream.total)
+        if self.debug:
+            logger.info(f"URLs found: {stream.total}")
+
+        # runs on the main thread only, so the accounting &
+        # the resume state writes are never shared between workers
+        def record(url: str, fic: FicHub, outcome: str, exit_status: int):
+            self.exit_status = exit_status
+            if outcome == "downloaded":
+                downloaded_urls.append(url)
+            elif outcome == "no_updates":
+                no_updates_urls.append(url)
+            elif outcome == "error":
+                err_urls.append(url)
+
+            self.state.record(url, outcome or ERROR_STATUS,
+                              getattr(fic, "cache_hash", None))
+            self.record_timings(url, outcome, exit_status)
+            # the duplicates & processed urls are removed from the total
+            pbar.total = max(stream.total - stream.skipped, pbar.n + 1)
+            pbar.update(1)
+
+        try:
+            init_log(self.debug, self.force)
+            with tqdm(total=stream.total, ascii=False, unit="file",
+                      bar_format=bar_format,
+                      disable=not show_progress()) as pbar:
+
+                if self.workers == 1 and self.meta_workers == 1 \
+                        and self.lookahead == 0:
+                    for url in stream:
+                        record(url, *self.process_url(url))
+                else:
+                    pipeline = Pipeline(
+                        self.resolve_url, self.download_fic,
+                        meta_workers=self.meta_workers,
+                        download_workers=self.workers,
+                        lookahead=self.lookahead, debug=self.debug)
+                    for result in pipeline.run(stream):
+                        record(*result)
+
+                pbar.total = pbar.n
+                pbar.refresh()
+
+            summary(
+                Fore.BLUE + f"After removing duplicates, total URLs: {len(stream.urls_input_dedup)}")
+            summary(
+                Fore.BLUE + f"After comparing with output.log, total URLs: {len(stream.urls)}")
+            emit("summary", urls=stream.total,
+                 dedup=len(stream.urls_input_dedup), new=len(stream.urls),
+                 downloaded=len(downloaded_urls),
+                 no_updates=len(no_updates_urls), errors=len(err_urls),
+                 bytes=self.stats.bytes, retries=self.stats.retries,
+                 exit_status=self.exit_status)
+            if self.debug:
+                logger.info(
+                    f"After Deduplication, total URLs: {len(stream.urls_input_dedup)}")
+                logger.info(
+                    f"After comparing with output.log, total URLs: {len(stream.urls)}")
+
+            if not stream.urls:
+                summary(Fore.RED +
+                        "No new urls found! To check them again, delete the output.log when prompted.")
 
         except KeyboardInterrupt:
             output_log_cleanup(app_dirs)
             sys.exit(2)
 
         finally:
+            self.session.log_stats(self.debug)
+            self.log_stats()
+            self.meta_cache.close()
+            self.state.flush()
             if self.changelog:
-                build_changelog(urls_input, urls_input_dedup, urls,
-                                downloaded_urls, err_urls, no_updates_urls, self.out_dir)
-
-    def get_fic_with_list(self, list_url: str):
-
+                build_changelog(stream.urls_input, stream.urls_input_dedup,
+                                stream.urls, downloaded_urls, err_urls,
+                                no_updates_urls, self.out_dir, self.stats)
+            for spill_list in (downloaded_urls, no_updates_urls, err_urls):
+                spill_list.close()
+            stream.close()
+            self.stats.close()
+
+    def update_library(self):
+        """ Checks the fics recorded in the manifest of the output directory
+            for updates & downloads the changed ones, like the -i flag.
+
+            The metadata is compared with the hash & `updated` recorded
+            when the files were saved, so the unchanged files are neither
+            downloaded nor rehashed. Every recorded url is checked, the
+            resume state isn't used.
+        """
+        manifest = get_manifest(self.out_dir)
+        total = manifest.url_count()
+        if not total:
+            summary(Fore.RED +
+                    "No urls are recorded in the output directory! Download the fics with -i or -l, or record the existing files with: fichub_cli scan -o <dir>")
+            return
+
+        counts = {"checked": 0, "changed": 0, "downloaded": 0, "errors": 0,
+                  "bytes_saved": 0}
+        console(Fore.BLUE + f"URLs recorded: {total}")
+        emit("start", urls=total)
         if self.debug:
-            logger.info("-l flag used!")
-
-        urls_input = list_url.split(",")
-        urls, urls_input_dedup = urls_preprocessing(urls_input, self.debug)
-        downloaded_urls, no_updates_urls, err_urls = [], [], []
+            logger.info(f"Checking {total} recorded urls for updates")
+
+        # runs on the main thread only, like in download_urls
+        def record(url: str, fic: FicHub, outcome: str, exit_status: int):
+            self.exit_status = exit_status
+            counts["checked"] += 1
+            counts["changed"] += fic is not None
+            counts["downloaded"] += outcome == "downloaded"
+            counts["errors"] += outcome in ("error", None)
+            counts["bytes_saved"] += self._bytes_saved.pop(url, 0)
+            self.record_timings(url, outcome, exit_status)
+            pbar.update(1)
+
+        def check_update(url: str):
+            return self.check_update(url, manifest)
+
+        urls = manifest.urls()
+        if self.shard:
+            urls = (url for url in urls if in_shard(url, self.shard))
 
         try:
-            if urls:
-                init_log(self.debug, self.force)
-                with tqdm(total=len(urls), ascii=False,
-                          unit="file", bar_format=bar_format) as pbar:
+            init_log(self.debug, self.force)
+            with tqdm(total=total, ascii=False, unit="file",
+                      bar_format=bar_format,
+                      disable=not show_progress()) as pbar:
 
+                if self.workers == 1 and self.meta_workers == 1 \
+                        and self.lookahead == 0:
                     for url in urls:
-                        url_exit_status = 0
-                        download_processing_log(self.debug, url)
-                        supported_url,  self.exit_status = check_url(
-                            url, self.debug, self.exit_status)
-
-                        if supported_url:
-                            try:
-                                fic = FicHub(self.debug, self.automated,
-                                             self.exit_status)
-                                fic.get_fic_metadata(url, self.format_type)
-
-                                if self.verbose:
-                                    verbose_log(self.debug, fic)
-
-                                # update the exit status
-                                self.exit_status = fic.exit_status
-
-                                if not fic.files:
-                                    self.exit_status = 1
-
-                                else:
-                                    self.exit_status, url_exit_status = save_data(
-                                        self.out_dir, fic.files,
-                                        self.debug, self.force,
-                                         self.exit_status, self.automated)
-
-                                    with open("output.log", "a") as file:
-                                        file.write(f"{url}\n")
-
-                                    if url_exit_status == 0:
-                                        downloaded_urls.append(url)
-                                    else:
-                                        no_updates_urls.append(url)
-
-                                pbar.update(1)
-
-                            # Error: 'FicHub' object has no attribute 'files'
-                            # Reason: Unsupported URL
-                            except Exception as e:
-                                if self.debug:
-                                    logger.error(str(traceback.format_exc()))
-                                err_urls.append(url)
-                                pbar.update(1)
-                                self.exit_status = 1
-                                pass  # skip the unsupported url
-
-                        else:  # skip the unsupported url
-                            err_urls.append(url)
-                            pbar.update(1)
-                            continue
-            else:
-                typer.echo(Fore.RED +
-                           "No new urls found! If output.log exists, please clear it.")
+                        fic, outcome, exit_status = check_update(url)
+                        if fic is not None:
+                            outcome, exit_status = self.download_fic(url, fic)
+                        record(url, fic, outcome, exit_status)
+                else:
+                    pipeline = Pipeline(
+                        check_update, self.download_fic,
+                        meta_workers=self.meta_workers,
+                        download_workers=self.workers,
+                        lookahead=self.lookahead, debug=self.debug)
+                    for result in pipeline.run(urls):
+                        record(*result)
+
+                # the urls of the other shards are not counted
+                pbar.total = pbar.n
+                pbar.refresh()
+
+            summary(
+                Fore.BLUE + f"Checked: {counts['checked']} | Changed: "
+                f"{counts['changed']} | Downloaded: {counts['downloaded']} | "
+                f"Errors: {counts['errors']} | Bytes saved: {counts['bytes_saved']}")
+            emit("summary", **counts, bytes=self.stats.bytes,
+                 retries=self.stats.retries, exit_status=self.exit_status)
+            if self.debug:
+                logger.info(f"Library update: {counts}")
 
         except KeyboardInterrupt:
-            output_log_cleanup(app_dirs)
             sys.exit(2)
 
         finally:
-            if self.changelog:
-                build_changelog(urls_input, urls_input_dedup, urls,
-                                downloaded_urls, err_urls, no_updates_urls, self.out_dir)
+            self.session.log_stats(self.debug)
+            self.log_stats()
+            self.meta_cache.close()
+            self.stats.close()
+
+    def check_update(self, url: str, manifest: HashManifest) -> Tuple[FicHub, str, int]:
+        """ Metadata stage of --update-library: fetch the metadata in the
+            formats recorded for the url
+
+            Returns the FicHub object if a file of the fic changed since it
+            was saved, else None with the outcome & exit status
+        """
+        entries = manifest.url_entries(url)
+        format_type = sorted({FILE_FORMATS.get(os.path.splitext(entry["name"])[1], 0)
+                              for entry in entries}) or [0]
+        fic, outcome, exit_status = self.resolve_url(url, format_type)
+        if fic is None:
+            return fic, outcome, exit_status
+
+        # the entries of the files saved under an older name (renamed fic,
+        # new filename_format) aren't the files of the fic anymore
+        file_names = set(ebook_file_names(
+            fic.files, self.config["filename_format"]).values())
+        entries = [entry for entry in entries if entry["name"] in file_names]
+
+        cache_hash = next(iter(fic.cache_hash.values()), "")
+        updated = str(fic.files["meta"].get("updated", ""))
+        if not entries or not all(self.is_current(entry, cache_hash, updated)
+                                  for entry in entries):
+            return fic, None, exit_status
+
+        for entry in entries:
+            latest_version_log(self.debug, os.path.join(self.out_dir, entry["name"]))
+        self._bytes_saved[url] = sum(entry["size"] or 0 for entry in entries)
+        return None, "no_updates", 0
+
+    def is_current(self, entry: dict, cache_hash: str, updated: str) -> bool:
+        """ Check if the recorded file is unchanged on the disk & saved
+            from the latest version of the fic, without reading the file
+        """
+        try:
+            stat = os.stat(os.path.join(self.out_dir, entry["name"]))
+        except FileNotFoundError:
+            return False
+        # found corrupt by verify, even if the size & mtime are unchanged
+        if entry["corrupt"]:
+            return False
+        # modified since it was saved, rehashed by the download stage
+        if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime_ns"]:
+            return False
+
+        # same rules as check_freshness: the epub is compared with the hash
+        # given by the API, the other formats with the epub they came from
+        if entry["name"].endswith(".epub"):
+            return (entry["hash"] or "").strip() == cache_hash.strip()
+        if (entry["source_hash"] or "").strip() == cache_hash.strip():
+            return True
+        return bool(updated) and entry["updated"] == updated
+
+    def record_timings(self, url: str, outcome: str, exit_status: int = 0):
+        timings = self._timings.pop(url, None)
+        if timings is not None:
+            timings.outcome = outcome or ERROR_STATUS
+            timings.finish()
+            self.stats.add(timings)
+            emit("done", url=url, outcome=timings.outcome,
+                 exit_status=exit_status, bytes=timings.bytes,
+                 seconds=round(timings.total, 3))
+
+    def log_stats(self):
+        """ Shows the summary of the timings """
+        lines = self.stats.summary()
+        if self.show_stats:
+            for line in lines:
+                summary(Fore.BLUE + line)
+            summary(Fore.GREEN + f"Saved the timings to {self.stats.stats_file}")
+        elif self.debug:
+            for line in lines:
+                logger.info(line)
+
+    def process_url(self, url: str) -> Tuple[FicHub, str, int]:
+        """ Fetch the metadata & download the files for a single url
+
+            Returns the FicHub object (None if the metadata couldn't be
+            fetched), the outcome: "downloaded", "no_updates", "error" or
+            None if the API couldn't process the url, with the exit status
+        """
+        fic, outcome, exit_status = self.resolve_url(url)
+        if fic is None:
+            return fic, outcome, exit_status
+        return (fic, *self.download_fic(url, fic))
+
+    def resolve_url(self, url: str, format_type: list = None) -> Tuple[FicHub, str, int]:
+        """ Metadata stage: fetch the metadata for the url, in the formats
+            of the run unless format_type is given
+
+            Returns the FicHub object ready for download or None with the
+            outcome & exit status, if the url can't be downloaded
+        """
+        download_processing_log(self.debug, url)
+        timings = self._timings[url] = UrlTimings(url)
+        supported_url, exit_status = check_url(url, self.debug, 0)
+
+        if not supported_url:  # skip the unsupported url
+            return None, "error", exit_status
 
-    def get_fic_with_url(self, url_input: str):
+        try:
+            fic = FicHub(self.debug, self.automated, exit_status,
+                         self.session, timings)
+            fic.get_fic_metadata(url, format_type or self.format_type,
+                                 self.meta_cache, self.max_age)
 
-        if self.debug:
-            logger.info("-u flag used!")
+            if self.verbose:
+                verbose_log(self.debug, fic)
 
-        url, _ = urls_preprocessing([url_input], self.debug)
-        if url:
-            if url[0]:
-                init_log(self.debug, self.force)
-                with tqdm(total=1, ascii=False,
-                        unit="file", bar_format=bar_format) as pbar:
-
-                    download_processing_log(self.debug, url[0])
-                    supported_url, self.exit_status = check_url(
-                        url[0], self.debug, self.exit_status)
-
-                    if supported_url:
-                        try:
-                            fic = FicHub(self.debug, self.automated,
-                                        self.exit_status)
-                            fic.get_fic_metadata(url[0], self.format_type)
-
-                            if self.verbose:
-                                verbose_log(self.debug, fic)
-
-                            # update the exit status
-                            self.exit_status = fic.exit_status
-
-                            if not fic.files:
-                                self.exit_status = 1
-
-                            else:
-                                self.exit_status, _ = save_data(
-                                    self.out_dir, fic.files,
-                                    self.debug, self.force,
-                                    self.exit_status, self.automated)
-                                with open("output.log", "a") as file:
-                                    file.write(f"{url[0]}\n")
-                            pbar.update(1)
-
-                        # Error: 'FicHub' object has no attribute 'files'
-                        # Reason: Unsupported URL
-                        except Exception:
-                            if self.debug:
-                                logger.error(str(traceback.format_exc()))
-                            pbar.update(1)
-                            self.exit_status = 1
-                            pass  # skip the unsupported url
-
-                    else:  # skip the unsupported url
-                        pbar.update(1)
-            else:
-                typer.echo(Fore.RED +
-                        "No new urls found! If output.log exists, please clear it.")
+            if not fic.files:
+                return None, None, 1
+
+            emit("metadata", url=url, title=fic.files["meta"].get("title"),
+                 chapters=fic.files["meta"].get("chapters"),
+                 updated=fic.files["meta"].get("updated"),
+                 cached=timings.metadata_cached)
+
+            return fic, None, fic.exit_status
+
+        # Error: 'FicHub' object has no attribute 'files'
+        # Reason: Unsupported URL
+        except Exception:
+            if self.debug:
+                logger.error(str(traceback.format_exc()))
+            return None, "error", 1
+
+    def download_fic(self, url: str, fic: FicHub) -> Tuple[str, int]:
+        """ Download stage: save the files for the resolved fic """
+        try:
+            exit_status, url_exit_status = save_data(
+                self.out_dir, fic.files,
+                self.debug, self.force,
+                fic.exit_status, self.automated, self.session,
+                self.config, fic.timings, url)
+
+            if url_exit_status == 0:
+                return "downloaded", exit_status
+            return "no_updates", exit_status
+
+        except Exception:
+            if self.debug:
+                logger.error(str(traceback.format_exc()))
+            return "error", 1
@@ -21,49 +21,185 @@ from requests.packages.urllib3.util.retry import Retry
 import traceback
 import re
 import time
+import threading
+import hashlib
 from colorama import Fore, Style
-from tqdm import tqdm
 from loguru import logger
 from fichub_cli import __version__
-from platformdirs import PlatformDirs
 
+from .config import Config, get_config
+from .output import console, summary, emit
+from .scheduler import RequestScheduler, THROTTLE_STATUSES
+from .stats import UrlTimings
 
+
+# retries the connection errors, the 429 & 5xx responses are retried by
+# FicHubSession.get through the scheduler
 retry_strategy = Retry(
     total=3,
     backoff_factor=1,
-    status_forcelist=[429, 500, 502, 503, 504]
+    respect_retry_after_header=False
 )
+# retries of the 429 & 5xx responses, with an exponential backoff if the
+# server didn't send a Retry-After
+STATUS_RETRIES = 3
+STATUS_BACKOFF = 1
+
+# size of the chunks read when streaming the ebooks to the disk
+CHUNK_SIZE = 64 * 1024
+# suffix of the partially downloaded files, kept to resume the download
+PART_SUFFIX = ".part"
+# attempts to download a file, resuming the .part if possible
+DOWNLOAD_ATTEMPTS = 3
+# the API & the cache urls of the ebooks, e.g. a local mock for the benchmarks
+API_BASE_URL = "https://fichub.net"
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """ HTTPAdapter that counts the requests sent & the TCP/TLS connections
+        opened, to check if the pooled connections are being reused
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.connections = 0
+        self.requests_sent = 0
+        self._lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        def counting_pool(pool_cls):
+            class CountingConnection(pool_cls.ConnectionCls):
+                def connect(self):
+                    with adapter._lock:
+                        adapter.connections += 1
+                    super().connect()
+
+            return type(pool_cls.__name__, (pool_cls,),
+                        {"ConnectionCls": CountingConnection})
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting_pool(pool_cls) for scheme, pool_cls
+            in self.poolmanager.pool_classes_by_scheme.items()}
+
+    def send(self, *args, **kwargs):
+        with self._lock:
+            self.requests_sent += 1
+        return super().send(*args, **kwargs)
+
+
+class FicHubSession:
+    """ HTTP session & client settings shared by all the requests in a run,
+        so the connections to fichub.net are pooled & reused
+    """
+
+    def __init__(self, pool_size: int = 10, keep_alive: bool = True,
+                 config: Config = None, base_url: str = API_BASE_URL,
+                 max_rate: float = 0, debug: bool = False):
+        self.pool_size = max(1, pool_size)
+        self.base_url = base_url.rstrip("/")
+        self.debug = debug
+        # rate & concurrency of the requests, shared by all the workers
+        self.scheduler = RequestScheduler(max_concurrency=self.pool_size,
+                                          max_rate=max_rate, debug=debug)
+        self.keep_alive = keep_alive
+        self.adapter = CountingHTTPAdapter(pool_connections=self.pool_size,
+                                           pool_maxsize=self.pool_size,
+                                           max_retries=retry_strategy)
+        self.http = requests.Session()
+        self.http.mount("https://", self.adapter)
+        self.http.mount("http://", self.adapter)
+        self.headers = {'User-Agent': f'fichub_cli/{__version__}'}
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+
+        if config is None:
+            config = get_config()
+        self.api_key = config.get('api_key_v0')
+        if self.api_key:
+            self.headers['Authorization'] = f'Bearer {self.api_key}'
+
+    def get(self, url: str, timings: UrlTimings = None,
+            **kwargs) -> requests.Response:
+        """ GET through the scheduler, retrying the 429 & 5xx responses
+            after the Retry-After or an exponential backoff. The retries
+            are counted in the timings, if given. Raises HTTPError once
+            the retries are used up.
+        """
+        for attempt in range(STATUS_RETRIES + 1):
+            started = self.scheduler.acquire()
+            try:
+                response = self.http.get(url, **kwargs)
+            except BaseException:
+                self.scheduler.release(started)
+                raise
+
+            pause = self.scheduler.release(
+                started, response.status_code, response.headers)
+            if response.status_code not in THROTTLE_STATUSES:
+                return response
+
+            response.close()
+            if attempt == STATUS_RETRIES:
+                response.raise_for_status()
+            if timings is not None:
+                timings.retries += 1
+            if self.debug:
+                logger.debug(
+                    f"GET: {response.status_code}: {response.url}, "
+                    f"retry {attempt + 1}/{STATUS_RETRIES}")
+            if pause is None:  # otherwise acquire() waits for the pause
+                time.sleep(STATUS_BACKOFF * 2 ** attempt)
+
+    def connection_stats(self) -> dict:
+        """ Returns the number of connections opened, requests sent
+            & requests that reused an open connection
+        """
+        connections = self.adapter.connections
+        requests_sent = self.adapter.requests_sent
+        return {"connections": connections, "requests": requests_sent,
+                "reused": max(0, requests_sent - connections)}
+
+    def log_stats(self, debug: bool):
+        if debug:
+            stats = self.connection_stats()
+            logger.info(
+                f"HTTP connections opened: {stats['connections']} | Requests: "
+                f"{stats['requests']} | Connections reused: {stats['reused']}")
+            logger.info(f"Request scheduler: {self.scheduler.state()}")
+
+    def close(self):
+        self.http.close()
 
 
 class FicHub:
-    def __init__(self, debug, automated, exit_status):
+    def __init__(self, debug, automated, exit_status, session=None,
+                 timings=None):
         self.debug = debug
         self.automated = automated
         self.exit_status = exit_status
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.http = requests.Session()
-        self.http.mount("https://", adapter)
-        self.http.mount("http://", adapter)
+        if session is None:
+            session = FicHubSession()
+        self.session = session
+        self.http = session.http
         self.files = {}
         self.response = ""
         self.file_format = []
         self.cache_hash = {}
-        self.headers = { 'User-Agent': f'fichub_cli/{__version__}' }
-        self.api_key = None
-        try:
-            app_dirs = PlatformDirs("fichub_cli", "fichub")
-            with open(os.path.join(app_dirs.user_data_dir, 'config.json'), "r") as f:
-                config = json.load(f)
-                self.api_key = config.get('api_key_v0')
-        except FileNotFoundError:
-            pass
-
-        if self.api_key:
-            self.headers['Authorization'] = f'Bearer {self.api_key}'
+        self.headers = session.headers
+        self.api_key = session.api_key
+        # timings of the url, shared by the FicHub objects of its files
+        self.timings = timings if timings is not None else UrlTimings()
 
-    def get_fic_metadata(self, url: str, format_type: list):
+    def get_fic_metadata(self, url: str, format_type: list,
+                         cache=None, max_age: float = 0):
         """
         Sends GET request to Fichub API to fetch the metadata
+
+        If a MetadataCache is given, the response is cached & a cached
+        response newer than max_age seconds is used instead of the API call
         """
         params = {'q': url}
         if self.automated:  # for internal testing
@@ -72,11 +208,19 @@ class FicHub:
                 logger.debug(
                     "--automated flag was passed. Internal Testing mode is on.")
 
-        for _ in range(2):
+        cached_response = None
+        started = time.perf_counter()
+        if cache is not None and max_age > 0:
+            cached_response = cache.get(url, max_age)
+            self.timings.metadata_cached = cached_response is not None
+
+        for attempt in range(0 if cached_response else 2):
+            self.timings.retries += attempt
             try:
-                response = self.http.get(
-                    "https://fichub.net/api/v0/epub", params=params,
-                    allow_redirects=True, headers=self.headers, timeout=(6.1, 300)
+                response = self.session.get(
+                    f"{self.session.base_url}/api/v0/epub", params=params,
+                    timings=self.timings, allow_redirects=True,
+                    headers=self.headers, timeout=(6.1, 300)
                 )
                 if self.debug:
                     logger.debug(
@@ -87,17 +231,27 @@ class FicHub:
             except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
                 if self.debug:
                     logger.error(str(traceback.format_exc()))
-                tqdm.write("\n" + Fore.RED + str(e) + Style.RESET_ALL +
-                           Fore.GREEN + "\nWill retry in 3s!" +
-                           Style.RESET_ALL)
+                console("\n" + Fore.RED + str(e) + Style.RESET_ALL +
+                        Fore.GREEN + "\nWill retry in 3s!" +
+                        Style.RESET_ALL)
+                emit("retry", url=url, reason=str(e))
                 time.sleep(3)
 
+        self.timings.metadata += time.perf_counter() - started
         try:
-            self.response = response.json()
-            if response.status_code == 403:
-                tqdm.write("\n" + Fore.RED + "API Key was invalid! Please recheck & use a valid key!" + Style.RESET_ALL)
-                sys.exit(3)
+            if cached_response:
+                self.response = cached_response
+                if self.debug:
+                    logger.debug(f"Using the cached metadata for {url}")
+            else:
+                self.response = response.json()
+                if response.status_code == 403:
+                    summary("\n" + Fore.RED + "API Key was invalid! Please recheck & use a valid key!" + Style.RESET_ALL)
+                    emit("fatal", reason="invalid API key")
+                    sys.exit(3)
 
+            # the API only gives the hash of the epub, which is also
+            # used to check the freshness of the other formats
             cache_urls = {}
             for format in format_type:
                 if format == 0:
@@ -125,14 +279,15 @@ class FicHub:
                 self.files[self.response['urls']['epub'].split(
                     "/")[4].split("?")[0].replace(".epub", file_format)] = {
                     "hash": self.cache_hash[file_format.replace(".", "")],
-                    "download_url": "https://fichub.net" + cache_urls[file_format.replace(".", "")]
+                    "download_url": self.session.base_url + cache_urls[file_format.replace(".", "")]
                 }
+
+            if cache is not None and not cached_response:
+                cache.put(url, self.response)
+
         # Error: 'epub_url'
         # Reason: Unsupported URL
         except (KeyError, UnboundLocalError) as e:
-            with open("err.log", "a") as file:
-                file.write(url.strip()+"\n")
-
             if self.debug:
                 logger.error(f"Error: {str(e)} not found!")
                 logger.error(f"GET:Response: {str(self.response)}")
@@ -140,27 +295,32 @@ class FicHub:
                     f"Skipping unsupported URL: {url}")
 
             self.exit_status = 1
-            tqdm.write(
+            console(
                 Fore.RED + f"\nSkipping unsupported URL: {url}" +
                 Style.RESET_ALL + Fore.CYAN +
                 "\nTo see the supported site list, use " + Fore.YELLOW +
                 "fichub_cli -ss" + Style.RESET_ALL + Fore.CYAN +
                 "\nReport the error if the URL is supported!\n")
+            emit("error", url=url, reason="unsupported url")
 
-    def get_fic_data(self, download_url: str):
+    def get_fic_data(self, download_url: str, stream: bool = False,
+                     headers: dict = None):
         """
         Sends GET request to Fichub API to fetch the cache for the ebook
         """
 
+        headers = {**self.headers, **(headers or {})}
         params = {}
         if self.automated:  # for internal testing
             params['automated'] = 'true'
 
-        for _ in range(2):
+        for attempt in range(2):
+            self.timings.retries += attempt
             try:
-                self.response_data = self.http.get(
-                    download_url, allow_redirects=True, headers=self.headers,
-                    params=params, timeout=(6.1, 300))
+                self.response_data = self.session.get(
+                    download_url, timings=self.timings, allow_redirects=True,
+                    headers=headers, params=params, timeout=(6.1, 300),
+                    stream=stream)
                 if self.debug:
                     logger.debug(
                         f"GET: {self.response_data.status_code}: {self.response_data.url}")
@@ -168,7 +328,194 @@ class FicHub:
             except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
                 if self.debug:
                     logger.error(str(traceback.format_exc()))
-                tqdm.write("\n" + Fore.RED + str(e) + Style.RESET_ALL +
-                           Fore.GREEN + "\nWill retry in 3s!" +
-                           Style.RESET_ALL)
+                console("\n" + Fore.RED + str(e) + Style.RESET_ALL +
+                        Fore.GREEN + "\nWill retry in 3s!" +
+                        Style.RESET_ALL)
+                emit("retry", url=download_url, reason=str(e))
                 time.sleep(3)
+
+    def save_fic_data(self, download_url: str, ebook_file: str,
+                      validators: dict = None, expected_hash: str = None) -> str:
+        """
+        Streams the cache for the ebook to `ebook_file`.part & renames it to
+        `ebook_file` once the download is complete. Returns the md5 hash of
+        the file, computed while it's being written.
+
+        If the validators (etag, last_modified) of the local file are given,
+        the download is conditional & None is returned if the server
+        responds with 304 Not Modified.
+
+        The .part file is kept with its validators in `ebook_file`.part.json
+        if the download is interrupted, so the later attempts (in this run
+        or the next one) resume it with a Range request. If the server
+        doesn't support it or the remote file changed, the download restarts
+        from the beginning. A resumed download must match the expected_hash,
+        otherwise it's downloaded again from the beginning.
+        """
+        part_file = ebook_file + PART_SUFFIX
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            self.timings.retries += min(attempt, 1)
+            # the last attempt always downloads the whole file
+            resume = self.part_validators(part_file, download_url) \
+                if attempt < DOWNLOAD_ATTEMPTS - 1 else None
+
+            headers = {}
+            if validators:
+                if validators.get("etag"):
+                    headers["If-None-Match"] = validators["etag"]
+                if validators.get("last_modified"):
+                    headers["If-Modified-Since"] = validators["last_modified"]
+            if resume:
+                headers["Range"] = f"bytes={resume['size']}-"
+                headers["If-Range"] = resume["etag"] or resume["last_modified"]
+
+            started = time.perf_counter()
+            self.get_fic_data(download_url, stream=True, headers=headers)
+            self.timings.ttfb += time.perf_counter() - started
+            response = self.response_data
+            self.validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")}
+
+            if response.status_code == 304:
+                response.close()
+                remove_part(part_file)
+                return None
+
+            if response.status_code == 416:  # the .part is invalid
+                response.close()
+                remove_part(part_file)
+                continue
+
+            # the body of an error is never saved as the ebook
+            if response.status_code not in (200, 206):
+                response.close()
+                raise requests.exceptions.HTTPError(
+                    f"{response.status_code} Error: {response.reason} "
+                    f"for url: {response.url}", response=response)
+
+            offset = 0
+            if response.status_code == 206:
+                # a range starting elsewhere isn't the rest of the .part
+                if not resume or not response.headers.get(
+                        "Content-Range", "").startswith(f"bytes {resume['size']}-"):
+                    if self.debug:
+                        logger.warning(
+                            f"Unexpected Content-Range for {ebook_file}, "
+                            "restarting the download")
+                    response.close()
+                    remove_part(part_file)
+                    continue
+                offset = resume["size"]
+                if self.debug:
+                    logger.info(f"Resuming {ebook_file} from byte {offset}")
+            elif resume and self.debug:
+                logger.info(
+                    f"The server can't resume {ebook_file}, restarting the download")
+
+            try:
+                md5 = self.write_part(part_file, download_url, offset)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout, IncompleteDownload) as e:
+                if self.debug:
+                    logger.error(f"Download of {ebook_file} interrupted: {e}")
+                if attempt == DOWNLOAD_ATTEMPTS - 1:
+                    raise
+                continue
+
+            ebook_hash = md5.hexdigest()
+            if offset and expected_hash and ebook_hash != expected_hash.strip():
+                if self.debug:
+                    logger.warning(
+                        f"The md5 hash of the resumed {ebook_file} doesn't "
+                        "match the hash given by the API, downloading it again.")
+                remove_part(part_file)
+                continue
+
+            os.replace(part_file, ebook_file)
+            remove_part(part_file, validators_only=True)
+            return ebook_hash
+
+        raise IncompleteDownload(
+            f"Unable to download the whole {ebook_file}")
+
+    def part_validators(self, part_file: str, download_url: str) -> dict:
+        """ Returns the size & validators of the .part file, if it can be
+            resumed for the download_url
+        """
+        try:
+            with open(part_file + ".json", "r") as f:
+                part = json.load(f)
+            part["size"] = os.path.getsize(part_file)
+        except (OSError, ValueError):
+            return None
+
+        if part.get("url") != download_url or not part["size"] or \
+                not (part.get("etag") or part.get("last_modified")):
+            return None
+        return part
+
+    def write_part(self, part_file: str, download_url: str, offset: int):
+        """ Streams the response to the .part file from the offset.
+            Returns the md5 of the whole file.
+        """
+        md5 = hashlib.md5()
+        expected_size = self.response_data.headers.get("Content-Length")
+        written = 0
+        try:
+            if offset:
+                with open(part_file, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        md5.update(chunk)
+            else:
+                # the validators are saved first, to resume after a crash
+                with open(part_file + ".json", "w") as f:
+                    json.dump({"url": download_url, **self.validators}, f)
+
+            started = time.perf_counter()
+            disk_write = 0.0
+            with open(part_file, "ab" if offset else "wb") as f:
+                try:
+                    for chunk in self.response_data.iter_content(chunk_size=CHUNK_SIZE):
+                        md5.update(chunk)
+                        write_started = time.perf_counter()
+                        f.write(chunk)
+                        disk_write += time.perf_counter() - write_started
+                        written += len(chunk)
+                finally:
+                    # the transfer time excludes the writes to the disk
+                    self.timings.disk_write += disk_write
+                    self.timings.transfer += \
+                        time.perf_counter() - started - disk_write
+                    self.timings.bytes += written
+
+            if expected_size and expected_size.isdigit() \
+                    and written < int(expected_size):
+                raise IncompleteDownload(
+                    f"got {written} of {expected_size} bytes")
+
+        # the .part is kept if it can be resumed
+        except BaseException:
+            if not (self.validators["etag"] or self.validators["last_modified"]):
+                remove_part(part_file)
+            raise
+
+        finally:
+            self.response_data.close()
+
+        return md5
+
+
+class IncompleteDownload(IOError):
+    """ The connection was closed before the whole file was received """
+
+
+def remove_part(part_file: str, validators_only: bool = False):
+    """ Removes the .part file & its validators """
+    for file in ((part_file + ".json",) if validators_only
+                 else (part_file, part_file + ".json")):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
@@ -12,11 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from colorama import Fore
+from colorama import Fore, Style
 from loguru import logger
-from tqdm import tqdm
 from datetime import datetime
 
+from .output import console, emit
+
 
 def init_log(debug: bool, force: bool):
     if debug:
@@ -24,7 +25,7 @@ def init_log(debug: bool, force: bool):
             logger.warning(
                 "--force flag was passed. Files will be overwritten.")
     if force:
-        tqdm.write(
+        console(
             Fore.YELLOW +
             "WARNING: --force flag was passed. Files will be overwritten.")
 
@@ -32,13 +33,27 @@ def init_log(debug: bool, force: bool):
 def downloaded_log(debug: bool, file_name: str):
     if debug:
         logger.info(f"Downloaded '{file_name}'")
-    tqdm.write(Fore.GREEN + f"Downloaded '{file_name}'")
+    console(Fore.GREEN + f"Downloaded '{file_name}'")
+    emit("downloaded", file=file_name)
+
+
+def latest_version_log(debug: bool, file_name: str):
+    if debug:
+        logger.error(
+            f"{file_name} is already the latest version. Skipping download. Use --force flag to overwrite.")
+
+    console(
+        Fore.RED +
+        f"{file_name} is already the latest version. Skipping download." +
+        Style.RESET_ALL + Fore.CYAN + " Use --force flag to overwrite.")
+    emit("latest_version", file=file_name)
 
 
 def download_processing_log(debug: bool, url: str):
     if debug:
         logger.info(f"Processing {url.strip()}")
-    tqdm.write(Fore.BLUE + f"\nProcessing {url.strip()}")
+    console(Fore.BLUE + f"\nProcessing {url.strip()}")
+    emit("processing", url=url.strip())
 
 
 def verbose_log(debug: bool, fic):
@@ -51,14 +66,14 @@ def verbose_log(debug: bool, fic):
                         + " | Last Scrape: " + datetime
                         .strptime(str(fic.response['meta']['updated']), "%Y-%m-%dT%H:%M:%S")
                         .strftime("%d %b, %Y at %H:%M:%S"))
-        tqdm.write(Fore.MAGENTA
-                   + "Title: " +
-                   str(fic.response['meta']['title'])
-                   + "\nTotal Chapters: " +
-                   str(fic.response['meta']['chapters'])
-                   + "\nLast Updated: " + datetime
-                   .strptime(str(fic.response['meta']['updated']), "%Y-%m-%dT%H:%M:%S")
-                   .strftime("%d %b, %Y at %H:%M:%S"))
+        console(Fore.MAGENTA
+                + "Title: " +
+                str(fic.response['meta']['title'])
+                + "\nTotal Chapters: " +
+                str(fic.response['meta']['chapters'])
+                + "\nLast Updated: " + datetime
+                .strptime(str(fic.response['meta']['updated']), "%Y-%m-%dT%H:%M:%S")
+                .strftime("%d %b, %Y at %H:%M:%S"))
     # Error: KeyError: 'meta'
     # Reason: Unsupported url
     except KeyError:
@@ -0,0 +1,233 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import hashlib
+import sqlite3
+import threading
+
+MANIFEST_FILE = ".fichub_manifest.db"
+
+# columns of the files table, new columns are added to existing manifests
+MANIFEST_COLUMNS = {
+    "size": "INTEGER",
+    "mtime_ns": "INTEGER",
+    "hash": "TEXT",
+    # epub hash & `updated` metadata from the API when the file was saved
+    "source_hash": "TEXT",
+    "updated": "TEXT",
+    # validators of the downloaded file, for the conditional downloads
+    "etag": "TEXT",
+    "last_modified": "TEXT",
+    # canonical url of the fic, for the library updates
+    "url": "TEXT",
+    # set by verify if the file no longer has the recorded hash
+    "corrupt": "INTEGER",
+}
+
+# format type of the recorded files, by extension
+FILE_FORMATS = {".epub": 0, ".mobi": 1, ".pdf": 2, ".zip": 3}
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def hash_file(ebook_file: str, chunk_size: int = 1024 * 1024) -> str:
+    """ md5 hash of the file, read in chunks into the same buffer """
+    md5 = hashlib.md5()
+    buffer = memoryview(bytearray(chunk_size))
+    with open(ebook_file, "rb", buffering=0) as f:
+        for size in iter(lambda: f.readinto(buffer), 0):
+            md5.update(buffer[:size])
+    return md5.hexdigest()
+
+
+def get_manifest(out_dir: str) -> "HashManifest":
+    """ Returns the manifest for the output directory,
+        shared by all the threads in the process
+    """
+    key = os.path.realpath(out_dir or ".")
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = HashManifest(out_dir)
+        return _manifests[key]
+
+
+class HashManifest:
+    """ Records the size, mtime & md5 hash of the files saved in an output
+        directory, so the existing files are only rehashed if they changed
+        on the disk since they were recorded.
+    """
+
+    def __init__(self, out_dir: str):
+        self.out_dir = out_dir
+        self.manifest_file = os.path.join(out_dir, MANIFEST_FILE)
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(
+                self.manifest_file, timeout=30, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY)")
+            existing_columns = {row[1] for row in
+                                self._db.execute("PRAGMA table_info(files)")}
+            for column, column_type in MANIFEST_COLUMNS.items():
+                if column not in existing_columns:
+                    self._db.execute(
+                        f"ALTER TABLE files ADD COLUMN {column} {column_type}")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS files_url ON files (url)")
+            self._db.commit()
+        return self._db
+
+    def _key(self, ebook_file: str) -> str:
+        return os.path.basename(ebook_file)
+
+    def get(self, ebook_file: str) -> dict:
+        """ Returns the recorded entry for the file or None """
+        with self._lock:
+            cursor = self.db.execute(
+                "SELECT * FROM files WHERE name = ?", (self._key(ebook_file),))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([col[0] for col in cursor.description], row))
+
+    def file_hash(self, ebook_file: str) -> str:
+        """ Returns the md5 hash of the file, using the recorded hash if the
+            size & mtime of the file are unchanged, else rehashes the file.
+            A corrupt file is always rehashed & its entry is kept.
+        """
+        stat = os.stat(ebook_file)  # FileNotFoundError if missing
+        entry = self.get(ebook_file)
+        if entry and entry["corrupt"]:
+            return hash_file(ebook_file)
+        if entry and entry["hash"] and entry["size"] == stat.st_size \
+                and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["hash"]
+
+        ebook_hash = hash_file(ebook_file)
+        self.record(ebook_file, ebook_hash)
+        return ebook_hash
+
+    def is_unchanged(self, ebook_file: str, entry: dict) -> bool:
+        """ Check if the file still has the recorded hash, without
+            replacing the recorded entry if it doesn't
+        """
+        stat = os.stat(ebook_file)
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return True
+
+        if hash_file(ebook_file) != entry["hash"]:
+            return False
+
+        # same content, only the mtime changed
+        self.record(ebook_file, entry["hash"])
+        return True
+
+    def record(self, ebook_file: str, ebook_hash: str, **fields):
+        """ Records the current size & mtime of the file with its hash
+            & any other manifest columns, in a single transaction. The file
+            is no longer marked as corrupt.
+        """
+        stat = os.stat(ebook_file)
+        fields.update({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                       "hash": ebook_hash, "corrupt": None})
+        columns = ["name"] + list(fields)
+        with self._lock:
+            with self.db:
+                self.db.execute(
+                    f"INSERT INTO files ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))}) "
+                    "ON CONFLICT(name) DO UPDATE SET " +
+                    ", ".join(f"{col} = excluded.{col}" for col in fields),
+                    [self._key(ebook_file)] + list(fields.values()))
+
+    def record_many(self, entries: list):
+        """ Records the entries, dicts with the name, size, mtime_ns, hash
+            & the same other manifest columns, in a single transaction
+        """
+        if not entries:
+            return
+        columns = list(entries[0])
+        with self._lock:
+            with self.db:
+                self.db.executemany(
+                    f"INSERT INTO files ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))}) "
+                    "ON CONFLICT(name) DO UPDATE SET " +
+                    ", ".join(f"{col} = excluded.{col}" for col in columns
+                              if col != "name"),
+                    [[entry[col] for col in columns] for entry in entries])
+
+    def update(self, ebook_file: str, **fields):
+        """ Updates the manifest columns of a recorded file, without
+            changing its recorded size, mtime & hash
+        """
+        with self._lock:
+            with self.db:
+                self.db.execute(
+                    f"UPDATE files SET {', '.join(f'{col} = ?' for col in fields)}"
+                    " WHERE name = ?",
+                    list(fields.values()) + [self._key(ebook_file)])
+
+    def url_count(self) -> int:
+        with self._lock:
+            return self.db.execute(
+                "SELECT COUNT(DISTINCT url) FROM files WHERE url IS NOT NULL"
+            ).fetchone()[0]
+
+    def urls(self, page_size: int = 1000):
+        """ Yields the urls of the recorded files, read a page at a time """
+        last_url = ""
+        while True:
+            with self._lock:
+                page = [row[0] for row in self.db.execute(
+                    "SELECT DISTINCT url FROM files WHERE url > ? "
+                    "ORDER BY url LIMIT ?", (last_url, page_size))]
+            yield from page
+            if len(page) < page_size:
+                return
+            last_url = page[-1]
+
+    def entries(self, page_size: int = 1000):
+        """ Yields the recorded entries, read a page at a time """
+        last_name = ""
+        while True:
+            with self._lock:
+                cursor = self.db.execute(
+                    "SELECT * FROM files WHERE name > ? ORDER BY name LIMIT ?",
+                    (last_name, page_size))
+                columns = [col[0] for col in cursor.description]
+                page = [dict(zip(columns, row)) for row in cursor]
+            yield from page
+            if len(page) < page_size:
+                return
+            last_name = page[-1]["name"]
+
+    def url_entries(self, url: str) -> list:
+        """ Returns the recorded entries of the files saved from the url """
+        with self._lock:
+            cursor = self.db.execute("SELECT * FROM files WHERE url = ?", (url,))
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
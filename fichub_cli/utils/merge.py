@@ -0,0 +1,133 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import glob
+from datetime import datetime
+from typing import Tuple
+
+from colorama import Fore
+
+from .output import console, summary, emit
+from .state import StateStore, STATE_FILE, DONE_STATUSES, ERROR_STATUS
+
+MERGED_CHANGELOG = "CHANGELOG - merged - {timestamp}.txt"
+# the percentiles of the shards can't be merged, the timings per url are
+UNMERGED_SECTIONS = ("Timings",)
+# the shards read the same input, so these are kept from one changelog
+SHARED_TOTALS = ("Total URLs given as input",
+                 "Total URLs after removing duplicates")
+SHARED_SECTIONS = ("URLs given as Input", "URLs after removing duplicates")
+
+
+def read_changelog(changelog_file: str) -> Tuple[dict, dict]:
+    """ Returns the totals & the lines of each section of a changelog """
+    totals, sections = {}, {}
+    section = None
+    with open(changelog_file, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("## "):
+                section = sections.setdefault(line[3:], [])
+            elif section is not None:
+                if line:
+                    section.append(line)
+            elif line.startswith("Total ") and ": " in line:
+                label, _, value = line.rpartition(": ")
+                try:
+                    totals[label] = int(value)
+                except ValueError:
+                    pass
+    return totals, sections
+
+
+def merge_changelogs(changelog_files: list, out_dir: str) -> str:
+    """ Writes a changelog with the summed totals & the sorted urls of the
+        changelogs. Returns the path of the merged changelog.
+    """
+    totals, sections = {}, {}
+    for changelog_file in changelog_files:
+        file_totals, file_sections = read_changelog(changelog_file)
+        for label, value in file_totals.items():
+            if label in SHARED_TOTALS:
+                totals[label] = max(totals.get(label, 0), value)
+            else:
+                totals[label] = totals.get(label, 0) + value
+        for title, lines in file_sections.items():
+            if title in UNMERGED_SECTIONS:
+                continue
+            if title in SHARED_SECTIONS:
+                if len(lines) > len(sections.get(title, ())):
+                    sections[title] = lines
+            else:
+                sections.setdefault(title, set()).update(lines)
+
+    merged_file = os.path.join(out_dir, MERGED_CHANGELOG.format(
+        timestamp=datetime.now().strftime("%Y-%m-%d T%H%M%S")))
+    with open(merged_file, "w") as file:
+        file.write(f"# Changelog\nMerged from {len(changelog_files)} changelogs\n")
+        for label, value in totals.items():
+            file.write(f"{label}: {value}\n")
+        for title, lines in sections.items():
+            file.write(f"\n\n## {title}")
+            # the input is kept in its order
+            for line in lines if title in SHARED_SECTIONS else sorted(lines):
+                file.write(f"\n{line}")
+    return merged_file
+
+
+def merge_shards(shard_dirs: list, out_dir: str = "") -> dict:
+    """ Merges the resume state, the output.log & err.log files & the
+        changelogs of the directories of the shards into out_dir. The
+        merged state is exported to the output.log & err.log of out_dir.
+    """
+    out_dir = out_dir or "."
+    state = StateStore(os.path.join(out_dir, STATE_FILE))
+    counts = {"shards": 0, "urls": 0, "changelogs": 0}
+    state.import_logs(os.path.join(out_dir, "output.log"),
+                      os.path.join(out_dir, "err.log"))
+
+    changelog_files = []
+    for shard_dir in shard_dirs:
+        state_file = os.path.join(shard_dir, STATE_FILE)
+        if os.path.realpath(state_file) != os.path.realpath(state.state_file):
+            if os.path.exists(state_file):
+                counts["urls"] += state.merge(state_file)
+            # the urls in the state files are more recent than the logs
+            counts["urls"] += state.import_logs(
+                os.path.join(shard_dir, "output.log"),
+                os.path.join(shard_dir, "err.log"))
+        counts["shards"] += 1
+
+        changelogs = [changelog for changelog in
+                      glob.glob(os.path.join(glob.escape(shard_dir), "CHANGELOG - *.txt"))
+                      if not os.path.basename(changelog).startswith("CHANGELOG - merged")]
+        changelog_files += sorted(changelogs)
+        console(Fore.BLUE + f"Merged {shard_dir}: {len(changelogs)} changelogs")
+
+    state.export_logs(os.path.join(out_dir, "output.log"),
+                      os.path.join(out_dir, "err.log"))
+    done, errors = state.count(DONE_STATUSES), state.count((ERROR_STATUS,))
+    state.close()
+
+    if changelog_files:
+        counts["changelogs"] = len(changelog_files)
+        merged_file = merge_changelogs(changelog_files, out_dir)
+        summary(Fore.GREEN + f"Saved the merged changelog to {merged_file}")
+
+    summary(Fore.BLUE + f"Merged {counts['shards']} shards: {counts['urls']} urls "
+            f"added or updated | Processed: {done} | Errors: {errors} | "
+            f"Changelogs: {counts['changelogs']}")
+    emit("summary", **counts, processed=done, errors=errors)
+    return counts
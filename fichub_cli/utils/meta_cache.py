@@ -0,0 +1,102 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from .sites import canonical_url, normalize_url
+
+META_CACHE_FILE = "meta_cache.db"
+# entries older than this are evicted, whatever the --max-age
+META_CACHE_RETENTION = 30 * 24 * 3600
+# max number of entries kept, the oldest ones are evicted first
+META_CACHE_MAX_ENTRIES = 50000
+# the cache is evicted once every N new entries
+EVICT_INTERVAL = 500
+
+
+def cache_key(url: str) -> str:
+    return canonical_url(url) or normalize_url(url)
+
+
+class MetadataCache:
+    """ On-disk cache of the API responses (meta, urls & hashes), so the
+        urls checked recently can skip the API call on the next run
+    """
+
+    def __init__(self, app_dirs, max_entries: int = META_CACHE_MAX_ENTRIES,
+                 retention: int = META_CACHE_RETENTION):
+        self.cache_file = os.path.join(app_dirs.user_data_dir, META_CACHE_FILE)
+        self.max_entries = max_entries
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._db = None
+        self._puts = 0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            self._db = sqlite3.connect(
+                self.cache_file, timeout=30, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (url TEXT PRIMARY KEY, "
+                "fetched_at REAL, response TEXT)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS meta_fetched_at ON meta (fetched_at)")
+            self._db.commit()
+        return self._db
+
+    def get(self, url: str, max_age: float) -> dict:
+        """ Returns the cached response if it's newer than max_age seconds """
+        with self._lock:
+            row = self.db.execute(
+                "SELECT response FROM meta WHERE url = ? AND fetched_at >= ?",
+                (cache_key(url), time.time() - max_age)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, url: str, response: dict):
+        payload = {key: response[key] for key in ("meta", "urls", "hashes")}
+        with self._lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?, ?)",
+                    (cache_key(url), time.time(), json.dumps(payload)))
+            self._puts += 1
+            if self._puts % EVICT_INTERVAL == 0:
+                self._evict()
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        """ Drops the expired entries & the oldest ones past max_entries """
+        with self.db:
+            self.db.execute("DELETE FROM meta WHERE fetched_at < ?",
+                            (time.time() - self.retention,))
+            self.db.execute(
+                "DELETE FROM meta WHERE url IN (SELECT url FROM meta "
+                "ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._evict()
+                self._db.close()
+                self._db = None
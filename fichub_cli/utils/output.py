@@ -0,0 +1,80 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import json
+import time
+import threading
+
+import typer
+from tqdm import tqdm
+
+# text: the colored log messages, json: one JSON object per line & event
+OUTPUT_MODES = ("text", "json")
+
+# set once by the cli, shared by the whole process
+_output = {"mode": "text", "quiet": False, "sink": None}
+_lock = threading.Lock()
+
+
+def set_output_mode(mode: str = "text", quiet: bool = False):
+    """ Sets the output of the run. The quiet text output only shows the
+        progress bar & the summary at the end of the run.
+    """
+    if mode not in OUTPUT_MODES:
+        raise typer.BadParameter(
+            f"Invalid output: {mode}. Use one of: {', '.join(OUTPUT_MODES)}.")
+    _output["mode"] = mode
+    _output["quiet"] = quiet
+
+
+def set_output_sink(sink=None):
+    """ Sends the json events to the sink, a function called with each
+        line, instead of stdout. None restores stdout.
+    """
+    _output["sink"] = sink
+
+
+def json_output() -> bool:
+    return _output["mode"] == "json"
+
+
+def show_progress() -> bool:
+    """ The progress bar is hidden with the json output, to keep the
+        events the only output of the run
+    """
+    return _output["mode"] == "text"
+
+
+def console(message: str):
+    """ Writes a log message of the text output, hidden by --quiet """
+    if _output["mode"] == "text" and not _output["quiet"]:
+        tqdm.write(message)
+
+
+def summary(message: str):
+    """ Writes a summary or error message of the text output """
+    if _output["mode"] == "text":
+        tqdm.write(message)
+
+
+def emit(event: str, **fields):
+    """ Writes an event of the json output, as a compact JSON line """
+    if _output["mode"] != "json":
+        return
+    line = json.dumps({"event": event, "time": round(time.time(), 3), **fields},
+                      separators=(",", ":"), default=str)
+    # the events are written by the workers too, one line at a time
+    with _lock:
+        (_output["sink"] or sys.stdout.write)(line + "\n")
@@ -0,0 +1,171 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import threading
+from loguru import logger
+
+_DONE = object()  # end of a stage
+_ERROR = object()  # exception raised inside a worker
+
+
+class Pipeline:
+    """ Two-stage pipeline for the batch downloads.
+
+        The metadata stage calls `resolve(url)` which returns
+        (fic, outcome, exit_status). Resolved fics are handed to the
+        download stage through a bounded lookahead queue, so the server-side
+        ebook generation for the later urls overlaps with the file transfer
+        of the earlier ones. Urls that couldn't be resolved (fic is None)
+        skip the download stage.
+
+        The download stage calls `download(url, fic)` which returns
+        (outcome, exit_status).
+    """
+
+    def __init__(self, resolve, download, meta_workers: int = 1,
+                 download_workers: int = 1, lookahead: int = 0,
+                 debug: bool = False):
+        self.resolve = resolve
+        self.download = download
+        self.meta_workers = max(1, meta_workers)
+        self.download_workers = max(1, download_workers)
+        # default: let the metadata stage run 2 fics per worker ahead
+        self.lookahead = lookahead if lookahead > 0 else 2 * self.meta_workers
+        self.debug = debug
+
+        self._lookahead_queue = queue.Queue(maxsize=self.lookahead)
+        self._results = queue.Queue()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._meta_active = 0
+        self._download_active = 0
+        self._meta_running = self.meta_workers
+        self._download_running = self.download_workers
+
+    def run(self, urls):
+        """ Generator yielding (url, fic, outcome, exit_status) for each url
+            in the order the urls finish processing. Must be consumed
+            on the main thread.
+        """
+        self._urls = iter(urls)
+        if self.debug:
+            logger.info(
+                f"Pipeline: {self.meta_workers} metadata workers, "
+                f"{self.download_workers} download workers, "
+                f"lookahead queue of {self.lookahead}")
+
+        threads = [threading.Thread(target=self._meta_worker, daemon=True)
+                   for _ in range(self.meta_workers)]
+        threads += [threading.Thread(target=self._download_worker, daemon=True)
+                    for _ in range(self.download_workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._results.get()
+                if item is _DONE:
+                    break
+                if item[0] is _ERROR:
+                    raise item[1]
+
+                if self.debug:
+                    logger.debug(self.queue_depth())
+                yield item
+        finally:
+            # stops the workers if interrupted or on an error
+            self._stop.set()
+
+    def queue_depth(self) -> str:
+        return (f"Pipeline queue depth: metadata {self._meta_active}/{self.meta_workers}"
+                f" | lookahead {self._lookahead_queue.qsize()}/{self.lookahead}"
+                f" | download {self._download_active}/{self.download_workers}")
+
+    def _next_url(self):
+        with self._lock:
+            return next(self._urls, None)
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """ Blocking put that gives up once the pipeline is stopped """
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _meta_worker(self):
+        try:
+            while not self._stop.is_set():
+                url = self._next_url()
+                if url is None:
+                    break
+
+                with self._lock:
+                    self._meta_active += 1
+                try:
+                    fic, outcome, exit_status = self.resolve(url)
+                finally:
+                    with self._lock:
+                        self._meta_active -= 1
+
+                if fic is None:
+                    self._results.put((url, fic, outcome, exit_status))
+                elif not self._put(self._lookahead_queue, (url, fic)):
+                    break
+
+        except BaseException as e:
+            self._stop.set()
+            self._results.put((_ERROR, e))
+
+        finally:
+            with self._lock:
+                self._meta_running -= 1
+                last_worker = self._meta_running == 0
+            if last_worker:  # end of the metadata stage
+                for _ in range(self.download_workers):
+                    self._put(self._lookahead_queue, _DONE)
+
+    def _download_worker(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    item = self._lookahead_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    break
+
+                url, fic = item
+                with self._lock:
+                    self._download_active += 1
+                try:
+                    outcome, exit_status = self.download(url, fic)
+                finally:
+                    with self._lock:
+                        self._download_active -= 1
+                self._results.put((url, fic, outcome, exit_status))
+
+        except BaseException as e:
+            self._stop.set()
+            self._results.put((_ERROR, e))
+
+        finally:
+            with self._lock:
+                self._download_running -= 1
+                last_worker = self._download_running == 0
+            if last_worker:  # end of the download stage
+                self._results.put(_DONE)
@@ -0,0 +1,172 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import importlib
+
+import click
+import typer
+from typer.core import TyperGroup
+from colorama import Fore, Style
+
+# entry point group of the plugins, e.g. in the setup.py of a plugin:
+# entry_points={"fichub_cli.plugins": ["metadata=fichub_cli_metadata:app"]}
+PLUGIN_GROUP = "fichub_cli.plugins"
+PLUGIN_CACHE_FILE = "plugins.json"
+# prefix of the plugins without an entry point, found by scanning sys.path
+LEGACY_PLUGIN_PREFIX = "fichub_cli_"
+
+
+def path_fingerprint() -> list:
+    """ mtimes of the sys.path entries, which change when packages are
+        installed or removed. The current directory is skipped since the
+        downloads are written to it.
+    """
+    cwd = os.getcwd()
+    fingerprint = []
+    for path in sys.path:
+        if not path or os.path.abspath(path) == cwd:
+            continue
+        try:
+            fingerprint.append([path, os.stat(path).st_mtime_ns])
+        except OSError:
+            continue
+    return fingerprint
+
+
+def iter_entry_points(group: str):
+    from importlib.metadata import entry_points
+
+    eps = entry_points()
+    if hasattr(eps, "select"):  # python 3.10+
+        return eps.select(group=group)
+    return eps.get(group, [])
+
+
+def scan_plugins() -> dict:
+    """ Finds the plugins, returns {command name: {"target", "help"}} """
+    import pkgutil
+    from loguru import logger
+
+    plugins = {}
+    for ep in iter_entry_points(PLUGIN_GROUP):
+        plugins[ep.name] = {"target": ep.value, "help": ""}
+
+    # the plugins released before the entry points are imported once here,
+    # to get their command name & help
+    modules = {plugin["target"].split(":")[0].split(".")[0]
+               for plugin in plugins.values()}
+    for _, name, _ in pkgutil.iter_modules():
+        if not name.startswith(LEGACY_PLUGIN_PREFIX) or \
+                name.endswith("-script") or name in modules:
+            continue
+        try:
+            command = typer.main.get_group(importlib.import_module(name).app)
+        except Exception as e:
+            logger.error(f"Failed to load the plugin {name}: {e}")
+            continue
+        plugins.setdefault(command.name, {
+            "target": f"{name}:app",
+            "help": command.get_short_help_str()})
+
+    return plugins
+
+
+def discover_plugins(app_dirs) -> dict:
+    """ Returns the plugins from the cache in the app dir, rescanning
+        only if the installed packages changed
+    """
+    cache_file = os.path.join(app_dirs.user_data_dir, PLUGIN_CACHE_FILE)
+    fingerprint = path_fingerprint()
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+        if cache["fingerprint"] == fingerprint:
+            return cache["plugins"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    plugins = scan_plugins()
+    try:
+        os.makedirs(app_dirs.user_data_dir, exist_ok=True)
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump({"fingerprint": fingerprint, "plugins": plugins}, f)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        pass
+    return plugins
+
+
+def load_plugin(name: str, target: str) -> click.Command:
+    """ Imports the typer app of the plugin & builds its command """
+    module_name, _, attr = target.partition(":")
+    plugin_app = importlib.import_module(module_name)
+    for part in (attr or "app").split("."):
+        plugin_app = getattr(plugin_app, part)
+
+    command = typer.main.get_group(plugin_app)
+    command.name = name
+    return command
+
+
+def plugin_group(app_dirs) -> type:
+    """ Returns the click group class of the CLI, which discovers the
+        plugins only when a sub-command is resolved or the help is shown
+        & imports a plugin only when its sub-command is invoked
+    """
+
+    class PluginGroup(TyperGroup):
+        _plugins = None
+
+        @property
+        def plugins(self) -> dict:
+            if PluginGroup._plugins is None:
+                PluginGroup._plugins = discover_plugins(app_dirs)
+            return PluginGroup._plugins
+
+        def list_commands(self, ctx: click.Context):
+            return sorted(set(super().list_commands(ctx)) | set(self.plugins))
+
+        def get_command(self, ctx: click.Context, cmd_name: str):
+            command = super().get_command(ctx, cmd_name)
+            if command is not None or cmd_name not in self.plugins:
+                return command
+
+            try:
+                command = load_plugin(
+                    cmd_name, self.plugins[cmd_name]["target"])
+            except Exception as e:
+                typer.echo(
+                    Fore.RED + f"Failed to load the plugin {cmd_name}: {e}"
+                    + Style.RESET_ALL)
+                return None
+            self.add_command(command, cmd_name)
+            return command
+
+        def format_commands(self, ctx: click.Context, formatter):
+            # lists the plugins with the cached help, without importing them
+            rows = [(name, command.get_short_help_str())
+                    for name, command in self.commands.items()
+                    if not command.hidden]
+            rows += [(name, plugin["help"])
+                     for name, plugin in self.plugins.items()
+                     if name not in self.commands]
+            if rows:
+                with formatter.section("Commands"):
+                    formatter.write_dl(sorted(rows))
+
+    return PluginGroup
@@ -14,23 +14,31 @@
 
 import json
 from datetime import datetime
-from typing import Tuple
+from typing import Tuple, TYPE_CHECKING
 import re
 import os
 import sys
-import hashlib
 import pathlib
-import requests
-from bs4 import BeautifulSoup
+import time
+import atexit
+import threading
 
 from colorama import Fore, Style
 from tqdm import tqdm
-from loguru import logger
 import typer
 from platformdirs import PlatformDirs
 
-from .fichub import FicHub
-from .logging import downloaded_log
+# requests & loguru are imported in the functions using them, to keep
+# them off the startup path of the CLI
+from .config import Config, get_config
+from .manifest import HashManifest, get_manifest, hash_file
+from .output import console, summary, emit, json_output
+from .sites import canonical_url
+from .state import get_state, DONE_STATUSES
+
+if TYPE_CHECKING:
+    from .fichub import FicHubSession
+    from .stats import UrlTimings
 
 
 def get_format_type(_format: str = "epub") -> int:
@@ -55,8 +63,30 @@ def get_format_type(_format: str = "epub") -> int:
     return format_type
 
 
+def parse_duration(duration: str) -> int:
+    """ Parse a duration like 90, 30m, 12h or 7d into seconds """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    match = re.fullmatch(r"\s*(\d+)\s*([smhd]?)\s*", duration, re.I)
+    if not match:
+        raise typer.BadParameter(
+            f"Invalid duration: {duration}. Use seconds or a number followed by s, m, h or d.")
+
+    return int(match.group(1)) * units[(match.group(2) or "s").lower()]
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """ Parse a shard like 2/4 into (2, 4) """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", shard)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise typer.BadParameter(
+            f"Invalid shard: {shard}. Use i/N, with i from 1 to N.")
+
+    return int(match.group(1)), int(match.group(2))
+
+
 def check_url(url: str, debug: bool = False,
               exit_status: int = 0) -> Tuple[bool, int]:
+    from loguru import logger
 
     if re.search(r"\barchiveofourown.org/series\b", url):
         unsupported_flag = True
@@ -64,24 +94,26 @@ def check_url(url: str, debug: bool = False,
     elif re.search(r"\bfanfiction.net/u\b", url):
         unsupported_flag = True
 
+    # not a story from a supported site, rejected without an API call
+    elif canonical_url(url) is None:
+        unsupported_flag = True
+
     else:
         unsupported_flag = False
 
     if unsupported_flag:
-        with open("err.log", "a") as file:
-            file.write(url)
-
         exit_status = 1
 
         if debug:
             logger.error(
                 f"Skipping unsupported URL: {url}")
-        tqdm.write(
+        console(
             Fore.RED + f"\nSkipping unsupported URL: {url}" +
             Style.RESET_ALL + Fore.CYAN +
             "\nTo see the supported site list, use " + Fore.YELLOW +
             "fichub_cli -ss" + Style.RESET_ALL + Fore.CYAN +
             "\nReport the error if the URL is supported!\n")
+        emit("error", url=url, reason="unsupported url")
 
         return False, exit_status
 
@@ -91,25 +123,28 @@ def check_url(url: str, debug: bool = False,
 
 def save_data(out_dir: str, files: dict,
               debug: bool, force: bool,
-              exit_status: int, automated: bool) -> int:
+              exit_status: int, automated: bool,
+              session: "FicHubSession" = None, config: Config = None,
+              timings: "UrlTimings" = None, url: str = None) -> int:
+    from loguru import logger
+    from .fichub import FicHub
+    from .logging import downloaded_log, latest_version_log
 
     exit_status = url_exit_status = 0
-    filename_formats = fetch_filename_formats(files)
+    manifest = get_manifest(out_dir)
+    if config is None:
+        config = get_config()
+    file_names = ebook_file_names(files, config["filename_format"])
+    # the url of the fic is recorded with its files, for --update-library
+    url_field = {"url": url} if url else {}
     for file_name, file_data in files.items():
         if file_name != "meta":
-            app_dirs = PlatformDirs("fichub_cli", "fichub")
-            with open(os.path.join(app_dirs.user_data_dir, "config.json"), 'r') as f:
-                app_config = json.load(f)
-
-            if not app_config["filename_format"] == "":
-                file_name= construct_filename(file_name,filename_formats,app_config["filename_format"])
-
-            # clean the filename
-            file_name = re.sub(r"[\\/:\"*?<>|]+", "", file_name, re.MULTILINE) 
-            ebook_file = os.path.join(out_dir, file_name)
+            ebook_file = os.path.join(out_dir, file_names[file_name])
             
             try:
-                hash_flag = check_hash(ebook_file,file_data["hash"])
+                hash_flag = False if force else \
+                    check_freshness(ebook_file, file_data["hash"],
+                                    files["meta"], manifest)
 
             except FileNotFoundError:
                 hash_flag = False
@@ -118,49 +153,120 @@ def save_data(out_dir: str, files: dict,
             if os.path.exists(ebook_file) and force is False and hash_flag is True:
                 exit_status = url_exit_status = 1
                 if debug:
-                    logger.warning(
-                        "The md5 hash of the local file & the remote file are the same.")
-
-                    logger.error(
-                        f"{ebook_file} is already the latest version. Skipping download. Use --force flag to overwrite.")
-
-                tqdm.write(
-                    Fore.RED +
-                    f"{ebook_file} is already the latest version. Skipping download." +
-                    Style.RESET_ALL + Fore.CYAN + " Use --force flag to overwrite.")
+                    if ebook_file.endswith(".epub"):
+                        logger.warning(
+                            "The md5 hash of the local file & the remote file are the same.")
+                    else:
+                        logger.warning(
+                            "The local file was saved from the same version of the fic.")
+
+                entry = manifest.get(ebook_file)
+                if url and entry and entry["url"] != url:
+                    manifest.update(ebook_file, url=url)
+                latest_version_log(debug, ebook_file)
 
             else:
                 if force and debug:
                     logger.warning(
                         f"--force flag was passed. Overwriting {ebook_file}")
 
-                fic = FicHub(debug, automated, exit_status)
-                fic.get_fic_data(file_data["download_url"])
-                
+                fic = FicHub(debug, automated, exit_status, session, timings)
+
                 try:
-                    with open(ebook_file, "wb") as f:
+                    if debug:
+                        logger.info(
+                            f"Saving {ebook_file}")
+                    # the API only gives the hash of the epub
+                    ebook_hash = fic.save_fic_data(
+                        file_data["download_url"], ebook_file,
+                        None if force else get_validators(ebook_file, manifest),
+                        file_data["hash"] if ebook_file.endswith(".epub") else None)
+
+                    # 304: the local file is the same as the remote file
+                    if ebook_hash is None:
+                        exit_status = url_exit_status = 1
                         if debug:
-                            logger.info(
-                                f"Saving {ebook_file}")
-                        f.write(fic.response_data.content)
+                            logger.warning(
+                                "The server returned 304 Not Modified for the local file.")
+                        manifest.record(ebook_file, manifest.get(ebook_file)["hash"],
+                                        source_hash=file_data["hash"],
+                                        updated=str(files["meta"].get("updated", "")),
+                                        **url_field)
+                        latest_version_log(debug, ebook_file)
+                        continue
+
+                    if debug and ebook_file.endswith(".epub") \
+                            and ebook_hash != file_data["hash"].strip():
+                        logger.warning(
+                            f"The md5 hash of {ebook_file} doesn't match the hash given by the API.")
+                    manifest.record(ebook_file, ebook_hash,
+                                    source_hash=file_data["hash"],
+                                    updated=str(files["meta"].get("updated", "")),
+                                    etag=fic.validators.get("etag"),
+                                    last_modified=fic.validators.get("last_modified"),
+                                    **url_field)
                     downloaded_log(debug, ebook_file)
                 except FileNotFoundError:
-                    tqdm.write(Fore.RED + "Output directory doesn't exist. Exiting!")
+                    summary(Fore.RED + "Output directory doesn't exist. Exiting!")
+                    emit("fatal", reason="output directory doesn't exist")
                     sys.exit(1)
 
     return exit_status, url_exit_status
 
 
-def check_hash(ebook_file: str, cache_hash: str) -> bool:
+def check_hash(ebook_file: str, cache_hash: str,
+               manifest: HashManifest = None) -> bool:
 
-    with open(ebook_file, 'rb') as file:
-        data = file.read()
-
-    ebook_hash = hashlib.md5(data).hexdigest()
+    if manifest is None:
+        ebook_hash = hash_file(ebook_file)
+    else:  # only rehash if the file changed since it was recorded
+        ebook_hash = manifest.file_hash(ebook_file)
 
     return ebook_hash.strip() == cache_hash.strip()
 
 
+def check_freshness(ebook_file: str, cache_hash: str, meta: dict,
+                    manifest: HashManifest) -> bool:
+    """ Check if the local file is the latest version of the fic
+
+        The API only gives the hash of the epub, so the epub is compared
+        directly. The mobi, pdf & html files are fresh if they are unchanged
+        since they were saved & were saved from the same epub hash or the
+        same `updated` metadata.
+    """
+    if ebook_file.endswith(".epub"):
+        return check_hash(ebook_file, cache_hash, manifest)
+
+    entry = manifest.get(ebook_file)
+    if not entry or not entry["source_hash"]:
+        return False
+
+    # the file was modified or replaced since it was saved
+    if not manifest.is_unchanged(ebook_file, entry):
+        return False
+
+    if entry["source_hash"].strip() == cache_hash.strip():
+        return True
+
+    updated = str(meta.get("updated", ""))
+    return bool(updated) and entry["updated"] == updated
+
+
+def get_validators(ebook_file: str, manifest: HashManifest) -> dict:
+    """ Returns the recorded ETag & Last-Modified of the file if the local
+        file is unchanged since it was saved, for a conditional download
+    """
+    try:
+        entry = manifest.get(ebook_file)
+        if entry and (entry["etag"] or entry["last_modified"]) \
+                and manifest.is_unchanged(ebook_file, entry):
+            return {"etag": entry["etag"],
+                    "last_modified": entry["last_modified"]}
+    except FileNotFoundError:
+        pass
+    return None
+
+
 def out_dir_exists_check(out_dir):
     """Check if the output directory exists"""
     if not os.path.isdir(out_dir):
@@ -176,36 +282,8 @@ def appdir_builder(app_dirs, show_output = False):
     if show_output:
         tqdm.write(
             f"Creating App directory: {app_dirs.user_data_dir}")
-    os.makedirs(app_dirs.user_data_dir, exist_ok=True)
-
-    config_file = os.path.join(app_dirs.user_data_dir, 'config.json')
-    base_config= {'db_up_time_format': r'%Y-%m-%dT%H:%M:%S%z',
-                'fic_up_time_format':  r'%Y-%m-%dT%H:%M:%S',
-                'delete_output_log': '',
-                "filename_format":'',
-                "api_key_v0": ''}
-
-    if os.path.exists(config_file):
-        if show_output:
-            tqdm.write(
-                f"Existing config file found: {config_file}. Updating with new config if its outdated!")
-        with open(os.path.join(app_dirs.user_data_dir, "config.json"), 'r') as f:
-            existing_config = json.load(f)
-            for key, value in base_config.items():
-                if key not in existing_config:
-                    existing_config[key]=value
-        
-        # Update the existing config file
-        with open(os.path.join(app_dirs.user_data_dir, "config.json"), 'w') as f:
-            json.dump(existing_config, f)
-
-    else: 
-        if show_output:
-            tqdm.write(
-                f"Building the config file: {config_file}")
-        
-        with open(os.path.join(app_dirs.user_data_dir, "config.json"), 'w') as f:
-            json.dump(base_config, f)
+    # only writes the config file if it's missing or outdated
+    get_config(app_dirs).save(show_output)
 
 
 def appdir_exists_check(app_dirs):
@@ -220,43 +298,25 @@ def appdir_config_info(app_dirs):
         f"CLI Config file: {os.path.join(app_dirs.user_data_dir, 'config.json')}")
 
     tqdm.write("\nConfig settings:")
-    with open(os.path.join(app_dirs.user_data_dir, 'config.json'), "r") as f:
-        config = json.load(f)
-
-    for key, value in config.items():
+    for key, value in get_config(app_dirs).items():
         tqdm.write(f"{key}: {value}")
 
     tqdm.write("\nFilename format props (case-sensitive): \nauthor, fichubAuthorId, authorId, chapters, created, fichubId, genres, id, language, rated, fandom, status, updated, title")
 
 
-def list_diff(urls_input, urls_output):
-    """ Make a list containing the difference between
-        two lists
+def check_output_log(urls_input, debug):
+    """ Removes the urls already processed in the current directory,
+        using the resume state (which imports output.log & err.log)
     """
-    urls_output = set(urls_output)
-    return [item for item in urls_input if item not in urls_output]
-
+    from loguru import logger
 
-def check_output_log(urls_input, debug):
     if debug:
-        logger.info("Checking output.log and err.log")
-    try:
-        urls_list = []
-        if os.path.exists("output.log"):
-            with open("output.log", "r") as f:
-                urls_list = f.read().splitlines()
+        logger.info("Checking the resume state (output.log and err.log)")
 
-        if os.path.exists("err.log"):
-            with open("err.log", "r") as f:
-                urls_list.extend(f.read().splitlines())
-
-        urls = list_diff(urls_input, urls_list)
-
-    # if output.log doesnt exist, when run 1st time
-    except FileNotFoundError:
-        urls = urls_input
+    state = get_state()
+    urls = [url for url in urls_input if not state.is_processed(url)]
 
-    tqdm.write(
+    summary(
         Fore.BLUE + f"After comparing with output.log, total URLs: {len(urls)}")
     if debug:
         logger.info(
@@ -268,16 +328,46 @@ def versiontuple(v):
     return tuple(map(int, (v.split("."))))
 
 
-def check_cli_outdated(package: str, current_ver: str):
-    res_html = requests.get(f"https://pypi.org/simple/{package}/")
-    html_soup = BeautifulSoup(res_html.content, 'html.parser')
+# the latest version is fetched from PyPI once a day
+PYPI_CHECK_TTL = 24 * 3600
+PYPI_CHECK_TIMEOUT = 3
+# longest wait at exit for the check to save the cache, in seconds
+PYPI_EXIT_WAIT = 0.3
 
-    latest_package = html_soup.find_all('a')[-1].get_text()
-    latest_ver = re.search(
-        r"(?:(\d+\.[.\d]*\d+))", latest_package, re.I).group(0)
 
-    if versiontuple(current_ver) < versiontuple(latest_ver):
-        tqdm.write(
+def check_cli_outdated(package: str, current_ver: str, app_dirs=None):
+    """ Warns if the package is outdated, using the latest version cached in
+        the app directory. The cache is refreshed by a background thread
+        once a day, so the check never blocks or fails the run.
+    """
+    if app_dirs is None:
+        app_dirs = PlatformDirs("fichub_cli", "fichub")
+    cache_file = os.path.join(app_dirs.user_data_dir, f"pypi_{package}.json")
+
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    if time.time() - cache.get("checked_at", 0) > PYPI_CHECK_TTL:
+        thread = threading.Thread(
+            target=fetch_latest_version, daemon=True,
+            args=(package, cache_file, cache.get("latest_ver")))
+        thread.start()
+        # a quick check can still be cached by the short runs, a slow
+        # one is abandoned & retried on the next run
+        atexit.register(thread.join, PYPI_EXIT_WAIT)
+
+    latest_ver = cache.get("latest_ver")
+    try:
+        outdated = latest_ver and \
+            versiontuple(current_ver) < versiontuple(latest_ver)
+    except ValueError:  # pre-release versions
+        outdated = False
+
+    if outdated:
+        console(
             Fore.RED +
             f"The currently installed {package} v{current_ver} is outdated.\n"
             + Style.RESET_ALL + Fore.GREEN +
@@ -287,11 +377,39 @@ def check_cli_outdated(package: str, current_ver: str):
         )
 
 
-def urls_preprocessing(urls_input, debug):
+def fetch_latest_version(package: str, cache_file: str, latest_ver: str = None,
+                         timeout: float = PYPI_CHECK_TIMEOUT):
+    """ Fetches the latest version of the package from PyPI & caches it.
+        If PyPI can't be reached (offline, sandboxed or down), the cached
+        version is kept & the check is retried the next day.
+    """
+    try:
+        import requests
+        response = requests.get(
+            f"https://pypi.org/pypi/{package}/json", timeout=timeout)
+        latest_ver = response.json()["info"]["version"]
+    except Exception:
+        pass
 
-    tqdm.write(Fore.BLUE + f"URLs found: {len(urls_input)}")
-    urls_input_dedup = list(dict.fromkeys(urls_input))
-    tqdm.write(
+    try:
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump({"checked_at": time.time(),
+                       "latest_ver": latest_ver}, f)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        pass
+
+
+def urls_preprocessing(urls_input, debug):
+    from loguru import logger
+
+    console(Fore.BLUE + f"URLs found: {len(urls_input)}")
+    # collapse the urls of the same story before removing the duplicates,
+    # the unsupported urls are kept as is to be rejected by check_url
+    urls_input_dedup = list(dict.fromkeys(
+        canonical_url(url) or url.strip() for url in urls_input if url.strip()))
+    summary(
         Fore.BLUE + f"After removing duplicates, total URLs: {len(urls_input_dedup)}")
 
     if debug:
@@ -313,7 +431,7 @@ def urls_preprocessing(urls_input, debug):
 
 
 def build_changelog(urls_input, urls_input_dedup, urls, downloaded_urls,
-                    err_urls, no_updates_urls, out_dir):
+                    err_urls, no_updates_urls, out_dir, stats=None):
     timestamp = datetime.now().strftime("%Y-%m-%d T%H%M%S")
     with open(os.path.join(out_dir, f"CHANGELOG - {timestamp}.txt"), 'w') as file:
         file.write(f"""# Changelog
@@ -355,6 +473,15 @@ Total URLs without any updates: {len(no_updates_urls)}
             for url in no_updates_urls:
                 file.write(f"\n{url}")
 
+        if stats is not None and stats.urls:
+            file.write("\n\n## Timings")
+            for line in stats.summary():
+                file.write(f"\n{line}")
+
+            file.write("\n\n## Timings per URL")
+            for line in stats.url_timings:
+                file.write(f"\n{line}")
+
 def construct_filename(file_name: str, file_meta: dict, filename_format: str):
     for key, value in file_meta.items():
         if f'[{key}]' in filename_format:
@@ -364,6 +491,21 @@ def construct_filename(file_name: str, file_meta: dict, filename_format: str):
 
 
 
+def ebook_file_names(files: dict, filename_format: str = "") -> dict:
+    """ Returns the names of the files of the fic, as saved by save_data """
+    filename_formats = fetch_filename_formats(files)
+    file_names = {}
+    for file_name in files:
+        if file_name != "meta":
+            name = file_name
+            if not filename_format == "":
+                name = construct_filename(file_name, filename_formats, filename_format)
+
+            # clean the filename
+            file_names[file_name] = re.sub(r"[\\/:\"*?<>|]+", "", name, re.MULTILINE)
+    return file_names
+
+
 def fetch_filename_formats(files: dict):
     filename_formats = {
         "author": files['meta']['author'],
@@ -420,16 +562,24 @@ def process_extraMeta(extraMeta: str, prop):
     return found
 
 def output_log_cleanup(app_dirs):
-    if os.path.exists("output.log"):
-        with open(os.path.join(app_dirs.user_data_dir, "config.json"), 'r') as f:
-            config = json.load(f)
-        
-        if config["delete_output_log"] == "":
-            rm_output_log = typer.confirm(
-                Fore.BLUE+"Delete the output.log?", abort=False, show_default=True)
-            if rm_output_log is True:
-                os.remove("output.log")
-        elif config["delete_output_log"] == "true":
+    """ Clears the downloaded urls from the resume state & the output.log,
+        so they are checked for updates on the next run
+    """
+    state = get_state()
+    if not state.count(DONE_STATUSES) and not os.path.exists("output.log"):
+        return
+
+    config = get_config(app_dirs)
+
+    rm_output_log = False
+    # the json output is for unattended runs, which are never prompted
+    if config["delete_output_log"] == "" and not json_output():
+        rm_output_log = typer.confirm(
+            Fore.BLUE+"Delete the output.log?", abort=False, show_default=True)
+    elif config["delete_output_log"] == "true":
+        rm_output_log = True
+
+    if rm_output_log is True:
+        state.clear(DONE_STATUSES)
+        if os.path.exists("output.log"):
             os.remove("output.log")
-        elif config["delete_output_log"] == "false":
-            pass
\ No newline at end of file
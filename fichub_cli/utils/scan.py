@@ -0,0 +1,163 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from colorama import Fore
+from tqdm import tqdm
+
+from .manifest import get_manifest, hash_file
+from .output import console, summary, emit, show_progress
+from .sites import canonical_url
+from .state import get_state
+
+CONTAINER_NS = "urn:oasis:names:tc:opendocument:xmlns:container"
+DC_NS = "http://purl.org/dc/elements/1.1/"
+# number of scanned files recorded in a single transaction
+RECORD_BATCH = 500
+
+
+def read_opf(epub: zipfile.ZipFile) -> dict:
+    """ Returns the title, source & identifiers from the OPF of the epub """
+    container = ET.fromstring(epub.read("META-INF/container.xml"))
+    rootfile = container.find(f".//{{{CONTAINER_NS}}}rootfile")
+    if rootfile is None:
+        raise KeyError("No rootfile in META-INF/container.xml")
+    opf = ET.fromstring(epub.read(rootfile.get("full-path")))
+
+    def texts(tag: str) -> list:
+        return [element.text.strip() for element in opf.iter(f"{{{DC_NS}}}{tag}")
+                if element.text and element.text.strip()]
+
+    return {"title": next(iter(texts("title")), None),
+            "source": next(iter(texts("source")), None),
+            "identifiers": texts("identifier")}
+
+
+def read_epub(ebook_file: str) -> dict:
+    """ Hashes the epub & reads the url of the fic from its OPF, in a
+        worker process. The url is the source or the first identifier
+        which is the url of a story from a supported site.
+    """
+    result = {"name": os.path.basename(ebook_file), "url": None,
+              "title": None, "error": None}
+    try:
+        stat = os.stat(ebook_file)
+        result.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                      hash=hash_file(ebook_file))
+        with zipfile.ZipFile(ebook_file) as epub:
+            opf = read_opf(epub)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError, OSError) as e:
+        result["error"] = str(e) or type(e).__name__
+        return result
+
+    result["title"] = opf["title"]
+    for candidate in [opf["source"]] + opf["identifiers"]:
+        url = canonical_url(candidate) if candidate else None
+        if url:
+            result["url"] = url
+            break
+    return result
+
+
+def scan_library(out_dir: str, workers: int = 0, force: bool = False,
+                 resume_state: bool = False) -> dict:
+    """ Records the epubs of the output directory in its manifest, with
+        their hash & the url of the fic, so --update-library can check
+        them for updates. The files are read by a pool of processes & the
+        files already recorded with a url are skipped unless force is True.
+
+        If resume_state is True, the urls are also marked as processed in
+        the resume state of the current directory. Returns the counts.
+    """
+    manifest = get_manifest(out_dir)
+    counts = {"scanned": 0, "recorded": 0, "no_url": 0, "unreadable": 0,
+              "skipped": 0}
+
+    ebook_files = []
+    with os.scandir(out_dir or ".") as entries:
+        for entry in entries:
+            if not entry.name.endswith(".epub") or not entry.is_file():
+                continue
+            recorded = manifest.get(entry.path)
+            if not force and recorded and recorded["url"]:
+                stat = entry.stat()
+                if recorded["size"] == stat.st_size \
+                        and recorded["mtime_ns"] == stat.st_mtime_ns:
+                    counts["skipped"] += 1
+                    continue
+            ebook_files.append(entry.path)
+
+    console(Fore.BLUE + f"EPUB files found: {len(ebook_files) + counts['skipped']}"
+            f", already recorded: {counts['skipped']}")
+    emit("start", files=len(ebook_files), skipped=counts["skipped"])
+
+    state = get_state() if resume_state else None
+    with_url, without_url = [], []
+
+    def flush():
+        # the urls of the files without one are kept
+        manifest.record_many(with_url)
+        manifest.record_many(without_url)
+        with_url.clear()
+        without_url.clear()
+
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=len(ebook_files), ascii=False, unit="file",
+                 disable=not show_progress()) as pbar:
+        results = executor.map(read_epub, ebook_files,
+                               chunksize=max(1, min(64, len(ebook_files) // (workers * 4))))
+        for result in results:
+            counts["scanned"] += 1
+            pbar.update(1)
+            if result["error"]:
+                counts["unreadable"] += 1
+                console(Fore.RED + f"Unable to read {result['name']}: {result['error']}")
+                emit("error", file=result["name"], reason=result["error"])
+                continue
+
+            entry = {key: result[key]
+                     for key in ("name", "size", "mtime_ns", "hash")}
+            if result["url"]:
+                counts["recorded"] += 1
+                # the API gives the md5 hash of the epub, the same as the
+                # hash of the file as it was downloaded
+                with_url.append({**entry, "source_hash": result["hash"],
+                                 "url": result["url"]})
+                if state is not None:
+                    state.record(result["url"], "no_updates",
+                                 {"epub": result["hash"]})
+            else:
+                counts["no_url"] += 1
+                without_url.append(entry)
+                console(Fore.YELLOW + f"No url of a supported site found in {result['name']}")
+            emit("scanned", file=result["name"], url=result["url"],
+                 title=result["title"])
+
+            if len(with_url) + len(without_url) >= RECORD_BATCH:
+                flush()
+        flush()
+
+    if state is not None:
+        state.flush()
+
+    summary(Fore.BLUE + f"Scanned: {counts['scanned']} | Recorded with a url: "
+            f"{counts['recorded']} | No url: {counts['no_url']} | Unreadable: "
+            f"{counts['unreadable']} | Skipped: {counts['skipped']}")
+    emit("summary", **counts)
+    return counts
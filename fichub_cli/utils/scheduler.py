@@ -0,0 +1,193 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+from loguru import logger
+
+# the responses slowing down the requests & retried
+THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+# longest pause asked by the server which is honored, in seconds
+MAX_PAUSE = 300
+# lowest request rate after the decreases, in requests/s
+MIN_RATE = 0.5
+
+
+def parse_retry_after(value: str) -> float:
+    """ Returns the delay in seconds from a Retry-After header, given in
+        seconds or as an HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_rate_limit(headers) -> float:
+    """ Returns the delay until the rate limit resets, if the
+        RateLimit-* or X-RateLimit-* headers say no request is left
+    """
+    for prefix in ("RateLimit-", "X-RateLimit-"):
+        remaining = headers.get(prefix + "Remaining")
+        reset = headers.get(prefix + "Reset")
+        if remaining is None or reset is None:
+            continue
+        try:
+            if float(remaining) > 0:
+                return None
+            reset = float(reset)
+        except ValueError:
+            return None
+        # some APIs send the epoch time of the reset instead of the delay
+        return max(0.0, reset - time.time() if reset > 1e9 else reset)
+    return None
+
+
+class RequestScheduler:
+    """ Schedules all the requests of a run, shared by the workers.
+
+        A token bucket limits the request rate & a limit on the requests in
+        flight caps the concurrency. Both start at the configured max (the
+        rate is unlimited by default) & are adjusted with AIMD: halved on
+        a 429 or 5xx response, increased additively on the successes.
+        Retry-After & the rate limit headers pause all the requests.
+    """
+
+    def __init__(self, max_concurrency: int = 10, max_rate: float = 0,
+                 min_rate: float = MIN_RATE, debug: bool = False):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.max_rate = max_rate if max_rate > 0 else None
+        self.rate = self.max_rate  # None: no limit until throttled
+        self.min_rate = min_rate
+        self.burst = float(self.max_concurrency)
+        self.tokens = self.burst
+        self.debug = debug
+
+        self.active = 0
+        self.paused_until = 0.0
+        self.throttled = 0  # number of 429 & 5xx responses
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._starts = deque(maxlen=64)  # for the measured request rate
+        self._cond = threading.Condition()
+
+    def acquire(self) -> float:
+        """ Blocks until the request can be sent, returns its start time """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.active >= int(self.limit):
+                    wait = 1.0  # woken up by release()
+                elif self.rate is not None and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    if self.rate is not None:
+                        self.tokens -= 1
+                    self.active += 1
+                    self._starts.append(now)
+                    return now
+                self._cond.wait(wait)
+
+    def release(self, started: float, status: int = None,
+                headers=None) -> float:
+        """ Updates the rate & concurrency from the response (None if the
+            request failed). Returns the pause asked by the server, if any.
+        """
+        with self._cond:
+            self.active -= 1
+            now = time.monotonic()
+            if status in THROTTLE_STATUSES:
+                self.throttled += 1
+                self._decrease(started, status)
+            elif status is not None:
+                self._increase()
+
+            pause = None
+            if headers is not None:
+                pause = parse_retry_after(headers.get("Retry-After"))
+                if pause is None:
+                    pause = parse_rate_limit(headers)
+            if pause is not None:
+                pause = min(pause, MAX_PAUSE)
+                if now + pause > self.paused_until:
+                    self.paused_until = now + pause
+                    if self.debug:
+                        logger.debug(
+                            f"Scheduler: server asked to wait {pause:.1f}s, "
+                            f"pausing the requests | {self.state()}")
+
+            self._cond.notify_all()
+            return pause
+
+    def state(self) -> str:
+        rate = f"{self.rate:.1f} req/s" if self.rate is not None else "unlimited"
+        return (f"rate: {rate} | concurrency: {int(self.limit)}/"
+                f"{self.max_concurrency} | in flight: {self.active} | "
+                f"throttled responses: {self.throttled}")
+
+    def measured_rate(self) -> float:
+        if len(self._starts) < 2:
+            return None
+        elapsed = self._starts[-1] - self._starts[0]
+        return (len(self._starts) - 1) / elapsed if elapsed > 0 else None
+
+    def _refill(self, now: float):
+        if self.rate is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _decrease(self, started: float, status: int):
+        # the requests sent before the last decrease already got the
+        # same feedback, so a burst of 429s only halves once
+        if started < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+
+        old_state = self.state()
+        self.limit = max(1.0, self.limit / 2)
+        rate = self.rate
+        if rate is None:  # first throttle, starts from the measured rate
+            rate = self.measured_rate() or float(self.max_concurrency)
+        self.rate = max(self.min_rate, rate / 2)
+        self.tokens = min(self.tokens, 1.0)
+        if self.debug:
+            logger.debug(
+                f"Scheduler: got {status}, backing off from {old_state} "
+                f"to {self.state()}")
+
+    def _increase(self):
+        old_limit = int(self.limit)
+        self.limit = min(float(self.max_concurrency),
+                         self.limit + 1 / self.limit)
+        if self.rate is not None:
+            # about +1 req/s for each second of successful requests
+            self.rate += 1 / self.rate
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+        if self.debug and int(self.limit) != old_limit:
+            logger.debug(f"Scheduler: increasing to {self.state()}")
@@ -0,0 +1,262 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Resident server running download jobs with a warm HTTP session,
+    config & metadata cache, over localhost HTTP or a Unix socket.
+
+    POST /jobs   {"urls": [...], "format": "epub", "out_dir": "",
+                  "force": false, "changelog": false, "max_age": "0"}
+                 streams the json events of the job (see --output json),
+                 one per line, ending with a "job_done" event
+    GET /status  the number of jobs, the connections & the scheduler state
+
+    The jobs aren't authenticated, so the server only listens on the
+    loopback interface unless allow_remote is set & the output directories
+    of the jobs are kept inside the root directory of the server.
+"""
+
+import os
+import json
+import time
+import ipaddress
+import threading
+import traceback
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import typer
+from loguru import logger
+
+from .fetch_data import FetchData, app_dirs
+from .fichub import FicHubSession
+from .output import set_output_mode, set_output_sink, emit
+from .processing import get_format_type, parse_duration, output_log_cleanup
+from .url_stream import UrlStream
+
+# largest job accepted, in bytes of JSON
+MAX_JOB_SIZE = 64 * 2**20
+
+
+class InvalidJob(ValueError):
+    pass
+
+
+class JobRunner:
+    """ Runs the jobs one at a time, with the same session & config. The
+        urls of a job are downloaded by the workers, like the -i flag, to
+        an output directory inside root.
+    """
+
+    def __init__(self, session: FicHubSession, config=None, workers: int = 1,
+                 meta_workers: int = 0, lookahead: int = 0,
+                 debug: bool = False, root: str = "."):
+        self.session = session
+        self.root = os.path.realpath(root)
+        self.config = config
+        self.workers = workers
+        self.meta_workers = meta_workers
+        self.lookahead = lookahead
+        self.debug = debug
+        self.jobs = 0
+        self.pending = 0  # the jobs running & waiting for their turn
+        self.started = time.time()
+        self._lock = threading.Lock()  # held by the running job
+        self._pending_lock = threading.Lock()
+
+    def parse_job(self, body: bytes) -> dict:
+        try:
+            job = json.loads(body)
+        except ValueError as e:
+            raise InvalidJob(f"Invalid JSON: {e}")
+        if not isinstance(job, dict):
+            raise InvalidJob("The job must be a JSON object")
+
+        urls = job.get("urls")
+        if not isinstance(urls, list) or not urls \
+                or not all(isinstance(url, str) for url in urls):
+            raise InvalidJob("'urls' must be a non-empty list of urls")
+        out_dir = job.get("out_dir", "")
+        if not isinstance(out_dir, str):
+            raise InvalidJob("'out_dir' must be a path")
+        # relative to the root, symlinks leading out of it are refused too
+        out_dir = os.path.realpath(os.path.join(self.root, out_dir))
+        if os.path.commonpath([self.root, out_dir]) != self.root:
+            raise InvalidJob(f"Output directory isn't inside {self.root}")
+        if not os.path.isdir(out_dir):
+            raise InvalidJob(f"Output directory doesn't exist: {out_dir}")
+        try:
+            max_age = parse_duration(str(job.get("max_age", "0")))
+        except typer.BadParameter as e:
+            raise InvalidJob(str(e))
+
+        return {"urls": urls, "out_dir": out_dir, "max_age": max_age,
+                "format_type": get_format_type(str(job.get("format", "epub"))),
+                "force": bool(job.get("force", False)),
+                "changelog": bool(job.get("changelog", False))}
+
+    def run(self, job: dict, write) -> int:
+        """ Runs the job, writing its events with write. Returns the
+            exit status of the job.
+        """
+        with self._pending_lock:
+            self.pending += 1
+        with self._lock:
+            self.jobs += 1
+            job_id = self.jobs
+            set_output_sink(write)
+            try:
+                emit("job", id=job_id, urls=len(job["urls"]))
+                exit_status = self._download(job)
+                emit("job_done", id=job_id, exit_status=exit_status)
+                return exit_status
+            finally:
+                set_output_sink(None)
+                with self._pending_lock:
+                    self.pending -= 1
+
+    def _download(self, job: dict) -> int:
+        fic = FetchData(format_type=job["format_type"], out_dir=job["out_dir"],
+                        force=job["force"], debug=self.debug,
+                        changelog=job["changelog"], workers=self.workers,
+                        meta_workers=self.meta_workers,
+                        lookahead=self.lookahead, session=self.session,
+                        max_age=job["max_age"], config=self.config)
+        try:
+            # a job asks for its urls, even if an earlier job processed them
+            fic.download_urls(UrlStream(job["urls"], len(job["urls"]),
+                                        keep_lists=job["changelog"],
+                                        resume=False))
+            exit_status = fic.exit_status
+        # the fatal errors of a run (invalid API key, missing output
+        # directory) only end the job
+        except SystemExit as e:
+            exit_status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            if self.debug:
+                logger.error(str(traceback.format_exc()))
+            exit_status = 1
+        output_log_cleanup(app_dirs)
+        return exit_status
+
+    def status(self) -> dict:
+        return {"jobs": self.jobs, "pending": self.pending,
+                "uptime": round(time.time() - self.started, 3),
+                "connections": self.session.connection_stats(),
+                "scheduler": self.session.scheduler.state()}
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    # the events are streamed until the connection is closed
+    protocol_version = "HTTP/1.0"
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/status":
+            return self.send_json(404, {"error": "Not found"})
+        self.send_json(200, self.server.runner.status())
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if not 0 < length <= MAX_JOB_SIZE:
+            return self.send_json(411 if length == 0 else 413,
+                                  {"error": "Invalid Content-Length"})
+        try:
+            job = self.server.runner.parse_job(self.rfile.read(length))
+        except InvalidJob as e:
+            return self.send_json(400, {"error": str(e)})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        self.server.runner.run(job, self.write_event)
+
+    def write_event(self, line: str):
+        # the job keeps running if the client went away
+        try:
+            self.wfile.write(line.encode("utf-8"))
+            self.wfile.flush()
+        except OSError:
+            pass
+
+    def send_json(self, status: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # the client address of a Unix socket is empty
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.runner.debug:
+            logger.debug(f"{self.address_string()} - {format % args}")
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Unix sockets aren't available on Windows
+if hasattr(socketserver, "UnixStreamServer"):
+    class ThreadingUnixServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    ThreadingUnixServer = None
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:  # a host name
+        return False
+
+
+def make_server(runner: JobRunner, host: str = "127.0.0.1", port: int = 0,
+                socket_path: str = "", allow_remote: bool = False):
+    """ Returns the server of the jobs, on the Unix socket if a path is
+        given (readable by the user only), else on host:port. A host other
+        than the loopback is refused unless allow_remote is True.
+    """
+    if not socket_path and not allow_remote and not is_loopback(host):
+        raise typer.BadParameter(
+            f"Refusing to accept unauthenticated jobs on {host}, "
+            "use --allow-remote to listen on it anyway.")
+    set_output_mode("json")
+    if socket_path:
+        if ThreadingUnixServer is None:
+            raise typer.BadParameter(
+                "Unix sockets aren't supported on this platform, use --port.")
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # left by a previous server
+        # created readable by the user only, no other user can connect
+        # between the bind & a chmod
+        umask = os.umask(0o177)
+        try:
+            server = ThreadingUnixServer(socket_path, JobHandler)
+        finally:
+            os.umask(umask)
+    else:
+        server = ThreadingHTTPServer((host, port), JobHandler)
+    server.runner = runner
+    return server
@@ -0,0 +1,96 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from urllib.parse import urlsplit, urlunsplit
+
+_scheme = r"^(?:https?://)?"
+
+XENFORO_HOSTS = (
+    r"forums\.spacebattles\.com|forums\.sufficientvelocity\.com|"
+    r"(?:forum\.)?questionablequesting\.com|forums\.bulbagarden\.net|"
+    r"(?:www\.)?the-fanfiction-forum\.net|(?:www\.)?fanficparadise\.com")
+
+# (site, matcher, canonical url) for the supported sites, checked in order.
+# The matchers with a canonical url collapse all the urls of a story
+# (chapters, mobile site, title slugs) to the same url. The others only
+# normalize the url.
+SITES = [
+    ("FanFiction.net",
+     re.compile(_scheme + r"(?:www\.|m\.)?fanfiction\.net/s/(?P<id>\d+)", re.I),
+     "https://www.fanfiction.net/s/{id}/1/"),
+    ("FictionPress",
+     re.compile(_scheme + r"(?:www\.|m\.)?fictionpress\.com/s/(?P<id>\d+)", re.I),
+     "https://www.fictionpress.com/s/{id}/1/"),
+    ("Archive Of Our Own",
+     re.compile(_scheme + r"(?:www\.)?(?:archiveofourown\.org|ao3\.org)"
+                r"(?:/collections/[^/?#]+)?/works/(?P<id>\d+)", re.I),
+     "https://archiveofourown.org/works/{id}"),
+    ("Archive Of Our Own",
+     re.compile(_scheme + r"(?:www\.)?(?:archiveofourown\.org|ao3\.org)"
+                r"/chapters/(?P<id>\d+)", re.I),
+     "https://archiveofourown.org/chapters/{id}"),
+    ("XenForo",
+     re.compile(_scheme + r"(?P<host>" + XENFORO_HOSTS + r")"
+                r"/threads/(?:[^/?#]*\.)?(?P<id>\d+)", re.I),
+     "https://{host}/threads/{id}/"),
+    ("Harry Potter Fanfic Archive",
+     re.compile(_scheme + r"(?:www\.)?hpfanficarchive\.com/stories/"
+                r"viewstory\.php\?(?:[^#]*&)?sid=(?P<id>\d+)", re.I),
+     "https://www.hpfanficarchive.com/stories/viewstory.php?sid={id}"),
+    ("AdultFanfiction.org",
+     re.compile(_scheme + r"(?P<sub>\w+)\.adult-fanfiction\.org/"
+                r"story\.php\?(?:[^#]*&)?no=(?P<id>\d+)", re.I),
+     "https://{sub}.adult-fanfiction.org/story.php?no={id}"),
+    ("Sink Into Your Eyes",
+     re.compile(_scheme + r"(?:www\.)?siye\.co\.uk/", re.I), None),
+    ("Worm, Ward",
+     re.compile(_scheme + r"(?:www\.)?parahumans\.(?:wordpress\.com|net)/", re.I),
+     None),
+    ("Fiction Alley",
+     re.compile(_scheme + r"(?:www\.)?fictionalley(?:-archive)?\.org/", re.I), None),
+    ("Fiction Hunt",
+     re.compile(_scheme + r"(?:www\.)?fictionhunt\.com/", re.I), None),
+    ("The Sugar Quill",
+     re.compile(_scheme + r"(?:www\.)?sugarquill\.net/", re.I), None),
+    ("FanficAuthors",
+     re.compile(_scheme + r"(?:[\w-]+\.)?fanficauthors\.net/", re.I), None),
+    ("Harry Potter Fanfiction",
+     re.compile(_scheme + r"(?:www\.)?harrypotterfanfiction\.com/", re.I), None),
+]
+
+
+def normalize_url(url: str) -> str:
+    """ Lowercase the scheme & host, drop the fragment & trailing slash """
+    url = url.strip()
+    if not re.match(r"^https?://", url, re.I):
+        url = "https://" + url
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path.rstrip("/"), parts.query, ""))
+
+
+def canonical_url(url: str) -> str:
+    """ Returns the canonical url of the story or None if the url is not
+        from a supported site, without any network calls
+    """
+    url = url.strip()
+    for _, matcher, url_format in SITES:
+        match = matcher.search(url)
+        if match:
+            if url_format is None:
+                return normalize_url(url)
+            return url_format.format(
+                **{key: value.lower() for key, value in match.groupdict().items()})
+    return None
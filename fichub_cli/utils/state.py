@@ -0,0 +1,211 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from .sites import canonical_url
+
+STATE_FILE = "fichub_cli_state.db"
+
+# the urls with these statuses were written to output.log by older versions
+DONE_STATUSES = ("downloaded", "no_updates")
+ERROR_STATUS = "error"
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+def get_state(state_file: str = STATE_FILE) -> "StateStore":
+    """ Returns the state store, shared by all the threads in the process.
+        The output.log & err.log files are imported on first use.
+    """
+    key = os.path.realpath(state_file)
+    with _states_lock:
+        if key not in _states:
+            _states[key] = StateStore(state_file)
+            _states[key].import_logs()
+        return _states[key]
+
+
+class StateStore:
+    """ Resume state of the urls processed in the current directory, which
+        replaces the output.log & err.log files.
+
+        SQLite in WAL mode, so the lookups are indexed & several processes
+        can share the file. The records are committed in batches.
+    """
+
+    def __init__(self, state_file: str = STATE_FILE, batch_size: int = 100):
+        self.state_file = state_file
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._db = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(
+                self.state_file, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, "
+                "status TEXT, updated_at REAL, hashes TEXT)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS urls_status ON urls (status)")
+            # size & mtime of the imported log files
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS imports (log_file TEXT PRIMARY KEY, "
+                "size INTEGER, mtime_ns INTEGER)")
+            self._db.commit()
+        return self._db
+
+    def get(self, url: str) -> str:
+        """ Returns the status of the url or None """
+        with self._lock:
+            row = self.db.execute(
+                "SELECT status FROM urls WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def is_processed(self, url: str) -> bool:
+        return self.get(url) is not None
+
+    def record(self, url: str, status: str, hashes: dict = None):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)",
+                (url, status, time.time(),
+                 json.dumps(hashes) if hashes else None))
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._commit()
+
+    def count(self, statuses: tuple) -> int:
+        with self._lock:
+            return self.db.execute(
+                f"SELECT COUNT(*) FROM urls WHERE status IN "
+                f"({', '.join('?' * len(statuses))})", statuses).fetchone()[0]
+
+    def urls(self, statuses: tuple):
+        """ Yields the urls with the statuses, oldest first """
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT url FROM urls WHERE status IN "
+                f"({', '.join('?' * len(statuses))}) ORDER BY updated_at",
+                statuses).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def clear(self, statuses: tuple):
+        with self._lock:
+            self.db.execute(
+                f"DELETE FROM urls WHERE status IN "
+                f"({', '.join('?' * len(statuses))})", statuses)
+            self._commit()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        if self._db is not None:
+            self._db.commit()
+        self._pending = 0
+
+    def merge(self, state_file: str) -> int:
+        """ Merges the urls of another state file, e.g. of a shard. The
+            most recent status of each url is kept. Returns the number of
+            urls added or updated.
+        """
+        with self._lock:
+            self._commit()
+            self.db.execute("ATTACH DATABASE ? AS other", (state_file,))
+            try:
+                # WHERE true: the ON CONFLICT of an INSERT from a SELECT
+                cursor = self.db.execute(
+                    "INSERT INTO urls SELECT url, status, updated_at, hashes "
+                    "FROM other.urls WHERE true ON CONFLICT(url) DO UPDATE SET "
+                    "status = excluded.status, updated_at = excluded.updated_at, "
+                    "hashes = excluded.hashes "
+                    "WHERE excluded.updated_at > urls.updated_at")
+                merged = max(0, cursor.rowcount)
+                self._commit()
+            finally:
+                self.db.execute("DETACH DATABASE other")
+        return merged
+
+    def import_logs(self, output_log: str = "output.log",
+                    err_log: str = "err.log") -> int:
+        """ Imports the urls from the output.log & err.log files, if they
+            changed since they were last imported
+        """
+        imported = 0
+        for log_file, status in ((output_log, "downloaded"),
+                                 (err_log, ERROR_STATUS)):
+            if not os.path.exists(log_file):
+                continue
+
+            stat = os.stat(log_file)
+            with self._lock:
+                row = self.db.execute(
+                    "SELECT size, mtime_ns FROM imports WHERE log_file = ?",
+                    (os.path.realpath(log_file),)).fetchone()
+            if row == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            now = time.time()
+            with open(log_file, "r") as f, self._lock:
+                # the urls already in the state are more recent
+                cursor = self.db.executemany(
+                    "INSERT OR IGNORE INTO urls VALUES (?, ?, ?, NULL)",
+                    ((canonical_url(url) or url, status, now)
+                     for url in (line.strip() for line in f) if url))
+                imported += max(0, cursor.rowcount)
+
+            with self._lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO imports VALUES (?, ?, ?)",
+                    (os.path.realpath(log_file), stat.st_size, stat.st_mtime_ns))
+                self._commit()
+
+        return imported
+
+    def export_logs(self, output_log: str = "output.log",
+                    err_log: str = "err.log"):
+        """ Writes the processed urls back to the output.log & err.log files """
+        for log_file, statuses in ((output_log, DONE_STATUSES),
+                                   (err_log, (ERROR_STATUS,))):
+            with open(log_file, "w") as f:
+                for url in self.urls(statuses):
+                    f.write(f"{url}\n")
+
+            # the exported files are already in the state
+            stat = os.stat(log_file)
+            with self._lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO imports VALUES (?, ?, ?)",
+                    (os.path.realpath(log_file), stat.st_size, stat.st_mtime_ns))
+                self._commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
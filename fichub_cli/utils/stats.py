@@ -0,0 +1,114 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+from array import array
+
+from .url_stream import SpillList
+
+# the phases of a url, in seconds
+PHASES = ("metadata", "ttfb", "transfer", "disk_write", "total")
+
+
+class UrlTimings:
+    """ Timings of a url: the metadata request, the time to first byte,
+        transfer & disk write of the files, summed over the formats
+    """
+
+    def __init__(self, url: str = ""):
+        self.url = url
+        self.outcome = None
+        self.metadata = 0.0
+        self.metadata_cached = False
+        self.ttfb = 0.0
+        self.transfer = 0.0
+        self.disk_write = 0.0
+        self.total = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self._started = time.perf_counter()
+
+    def finish(self):
+        self.total = time.perf_counter() - self._started
+
+    def __str__(self) -> str:
+        return (f"{self.url} | {self.outcome} | metadata {self.metadata:.3f}s"
+                f"{' (cached)' if self.metadata_cached else ''} | ttfb "
+                f"{self.ttfb:.3f}s | transfer {self.transfer:.3f}s | disk write "
+                f"{self.disk_write:.3f}s | total {self.total:.3f}s | "
+                f"{self.bytes} bytes | {self.retries} retries")
+
+    def to_dict(self) -> dict:
+        return {"url": self.url, "outcome": self.outcome,
+                "metadata": round(self.metadata, 4),
+                "metadata_cached": self.metadata_cached,
+                "ttfb": round(self.ttfb, 4),
+                "transfer": round(self.transfer, 4),
+                "disk_write": round(self.disk_write, 4),
+                "total": round(self.total, 4),
+                "bytes": self.bytes, "retries": self.retries}
+
+
+def percentile(values, pct: float) -> float:
+    """ Nearest-rank percentile of the values """
+    if not len(values):
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(len(values) * pct / 100 + 0.5) - 1))]
+
+
+class RunStats:
+    """ Collects the timings of the urls of a run & writes them as
+        JSON Lines, if a stats file is given. The timings of each url are
+        kept for the changelog if keep_urls is True.
+    """
+
+    def __init__(self, stats_file: str = None, keep_urls: bool = False):
+        self.stats_file = stats_file
+        self._file = open(stats_file, "w") if stats_file else None
+        self.url_timings = SpillList(keep_urls)
+        self.phases = {phase: array("d") for phase in PHASES}
+        self.urls = 0
+        self.bytes = 0
+        self.retries = 0
+
+    def add(self, timings: UrlTimings):
+        self.urls += 1
+        self.bytes += timings.bytes
+        self.retries += timings.retries
+        for phase in PHASES:
+            self.phases[phase].append(getattr(timings, phase))
+        self.url_timings.append(str(timings))
+        if self._file is not None:
+            self._file.write(json.dumps(timings.to_dict()) + "\n")
+
+    def summary(self) -> list:
+        """ Returns the lines of the p50/p95/p99 summary per phase """
+        if not self.urls:
+            return []
+        lines = [f"Timings of {self.urls} urls (p50 / p95 / p99):"]
+        for phase in PHASES:
+            values = self.phases[phase]
+            lines.append(
+                f"  {phase.replace('_', ' '):<12}" + " / ".join(
+                    f"{percentile(values, pct):.3f}s" for pct in (50, 95, 99)))
+        lines.append(f"  Bytes downloaded: {self.bytes} | Retries: {self.retries}")
+        return lines
+
+    def close(self):
+        self.url_timings.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
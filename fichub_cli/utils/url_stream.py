@@ -0,0 +1,197 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import hashlib
+import sqlite3
+import tempfile
+from typing import Iterable, Tuple
+
+from .sites import canonical_url
+from .state import get_state
+
+# number of items kept in memory before spilling to the disk
+SPILL_THRESHOLD = 500000
+
+
+def count_lines(infile: str) -> int:
+    """ Counts the lines of the file without keeping them in memory """
+    lines = 0
+    last_chunk = b""
+    with open(infile, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            lines += chunk.count(b"\n")
+            last_chunk = chunk
+    # last line without a newline
+    if last_chunk and not last_chunk.endswith(b"\n"):
+        lines += 1
+    return lines
+
+
+def in_shard(url: str, shard: Tuple[int, int]) -> bool:
+    """ Check if the canonical url belongs to the shard (i, N), 1 <= i <= N.
+        The md5 of the url is stable across the machines & python versions.
+    """
+    index, shards = shard
+    digest = int.from_bytes(hashlib.md5(url.encode("utf-8")).digest()[:8], "big")
+    return digest % shards == index - 1
+
+
+def iter_infile(infile: str):
+    """ Yields the lines of the file, read lazily """
+    with open(infile, "r") as f:
+        for line in f:
+            yield line.rstrip("\n")
+
+
+class DigestSet:
+    """ Set of the 64-bit digests of the urls, moved to a temp SQLite file
+        once it grows past the threshold
+    """
+
+    def __init__(self, threshold: int = None):
+        self.threshold = threshold or SPILL_THRESHOLD
+        self._digests = set()
+        self._db = None
+
+    def add(self, url: str) -> bool:
+        """ Adds the url, returns False if it was already in the set """
+        digest = int.from_bytes(hashlib.blake2b(
+            url.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+        if self._db is None:
+            if digest in self._digests:
+                return False
+            self._digests.add(digest)
+            if len(self._digests) > self.threshold:
+                self._spill()
+            return True
+
+        cursor = self._db.execute(
+            "INSERT OR IGNORE INTO digests VALUES (?)", (digest,))
+        return cursor.rowcount == 1
+
+    def _spill(self):
+        fd, self._db_file = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self._db = sqlite3.connect(self._db_file, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE digests (digest INTEGER PRIMARY KEY)")
+        self._db.executemany("INSERT INTO digests VALUES (?)",
+                             ((digest,) for digest in self._digests))
+        self._digests = set()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            os.remove(self._db_file)
+            self._db = None
+
+
+class SpillList:
+    """ Append-only list of urls for the changelog, moved to a temp file
+        once it grows past the threshold. If keep is False, only the
+        urls are counted.
+    """
+
+    def __init__(self, keep: bool = True, threshold: int = None):
+        self.keep = keep
+        self.threshold = threshold or SPILL_THRESHOLD
+        self._items = []
+        self._file = None
+        self._count = 0
+
+    def append(self, url: str):
+        self._count += 1
+        if not self.keep:
+            return
+        if self._file is None:
+            self._items.append(url)
+            if len(self._items) > self.threshold:
+                self._file = tempfile.TemporaryFile("w+")
+                self._file.writelines(f"{item}\n" for item in self._items)
+                self._items = []
+        else:
+            self._file.write(f"{url}\n")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        if self._file is None:
+            yield from self._items
+            return
+        self._file.flush()
+        self._file.seek(0)
+        for line in self._file:
+            yield line.rstrip("\n")
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class UrlStream:
+    """ Preprocesses the input urls lazily: canonicalizes them, removes the
+        duplicates & the urls in the resume state, while yielding the new
+        urls as soon as they are read. The totals are exact once the
+        stream is exhausted. With resume=False, the urls in the resume
+        state are yielded too.
+    """
+
+    def __init__(self, urls_input: Iterable[str], total: int,
+                 keep_lists: bool = False, shard: Tuple[int, int] = None,
+                 resume: bool = True):
+        self._urls_input = urls_input
+        self.shard = shard  # only the urls of this shard are yielded
+        self.resume = resume
+        self.total = total  # number of input lines, known upfront
+        self.urls_input = SpillList(keep_lists)
+        self.urls_input_dedup = SpillList(keep_lists)
+        self.urls = SpillList(keep_lists)
+
+    @property
+    def skipped(self) -> int:
+        """ Number of input urls skipped so far """
+        return len(self.urls_input) - len(self.urls)
+
+    def __iter__(self):
+        state = get_state() if self.resume else None
+        seen = DigestSet()
+        try:
+            for url in self._urls_input:
+                self.urls_input.append(url)
+                if not url.strip():
+                    continue
+
+                url = canonical_url(url) or url.strip()
+                url = str(url.encode('ascii', 'ignore'), "utf-8")
+                if not seen.add(url):
+                    continue
+                self.urls_input_dedup.append(url)
+
+                if self.shard and not in_shard(url, self.shard):
+                    continue
+                if state is not None and state.is_processed(url):
+                    continue
+                self.urls.append(url)
+                yield url
+        finally:
+            seen.close()
+
+    def close(self):
+        for spill_list in (self.urls_input, self.urls_input_dedup, self.urls):
+            spill_list.close()
@@ -0,0 +1,142 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from colorama import Fore, Style
+from tqdm import tqdm
+
+from .manifest import FILE_FORMATS, get_manifest, hash_file
+from .output import console, summary, emit, show_progress
+
+if TYPE_CHECKING:
+    from .fetch_data import FetchData
+
+
+def hash_or_none(ebook_file: str) -> str:
+    """ md5 hash of the file or None if it's missing, in a worker process """
+    try:
+        return hash_file(ebook_file)
+    except FileNotFoundError:
+        return None
+
+
+def verify_library(out_dir: str, workers: int = 0,
+                   fetch_data: "FetchData" = None) -> dict:
+    """ Hashes the files recorded in the manifest of the output directory
+        with a pool of processes & compares them with the recorded hashes.
+
+        The files which changed since they were saved are corrupt. They
+        are marked in the manifest with their recorded hash kept, so they
+        are reported again & --update-library downloads them again. If
+        fetch_data is given, the metadata of the fics of the intact files
+        is fetched to find the stale files, saved from an older version
+        of the fic. Returns the counts.
+    """
+    manifest = get_manifest(out_dir)
+    counts = {"verified": 0, "current": 0, "stale": 0, "corrupt": 0,
+              "missing": 0, "unchecked": 0}
+    # only the names & hashes are kept, the rows are read again by url
+    entries = [(entry["name"], entry["hash"], entry["url"])
+               for entry in manifest.entries()]
+    console(Fore.BLUE + f"Files recorded: {len(entries)}")
+    emit("start", files=len(entries))
+
+    intact = {}  # url: names of the intact files, to fetch
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=len(entries), ascii=False, unit="file",
+                 disable=not show_progress()) as pbar:
+        ebook_files = [os.path.join(out_dir, name) for name, _, _ in entries]
+        results = executor.map(hash_or_none, ebook_files,
+                               chunksize=max(1, min(64, len(entries) // (workers * 4))))
+        for (name, recorded_hash, url), ebook_hash in zip(entries, results):
+            counts["verified"] += 1
+            pbar.update(1)
+            if ebook_hash is None:
+                status = "missing"
+            elif ebook_hash != recorded_hash:
+                status = "corrupt"
+                # the validators would turn the download into a 304
+                manifest.update(name, corrupt=1, source_hash=None,
+                                updated=None, etag=None, last_modified=None)
+            else:
+                # stale or current, once the metadata is fetched
+                status = "current"
+                if url and fetch_data is not None:
+                    intact.setdefault(url, set()).add(name)
+                    continue
+
+            counts[status] += 1
+            log_status(name, status)
+
+    if fetch_data is not None and intact:
+        check_stale(manifest, intact, fetch_data, counts)
+
+    summary(Fore.BLUE + f"Verified: {counts['verified']} | Current: "
+            f"{counts['current']} | Stale: {counts['stale']} | Corrupt: "
+            f"{counts['corrupt']} | Missing: {counts['missing']}" +
+            (f" | Unchecked: {counts['unchecked']}" if counts["unchecked"] else ""))
+    if counts["corrupt"] or counts["stale"] or counts["missing"]:
+        summary(Fore.CYAN + "Use --update-library to download the corrupt, "
+                "stale & missing files again")
+    emit("summary", **counts)
+    return counts
+
+
+def check_stale(manifest, intact: dict, fetch_data: "FetchData", counts: dict):
+    """ Fetches the metadata of the urls with the metadata workers & sorts
+        their intact files into stale or current, or unchecked if the
+        metadata couldn't be fetched
+    """
+
+    def fetch(url: str):
+        entries = [entry for entry in manifest.url_entries(url)
+                   if entry["name"] in intact[url]]
+        format_type = sorted({FILE_FORMATS.get(os.path.splitext(entry["name"])[1], 0)
+                              for entry in entries}) or [0]
+        fic, _, _ = fetch_data.resolve_url(url, format_type)
+        return url, entries, fic
+
+    with ThreadPoolExecutor(max_workers=fetch_data.meta_workers) as executor, \
+            tqdm(total=len(intact), ascii=False, unit="url",
+                 disable=not show_progress()) as pbar:
+        for url, entries, fic in executor.map(fetch, intact):
+            pbar.update(1)
+            fetch_data.record_timings(url, "error" if fic is None else "checked")
+            for entry in entries:
+                if fic is None:
+                    status = "unchecked"
+                else:
+                    cache_hash = next(iter(fic.cache_hash.values()), "")
+                    updated = str(fic.files["meta"].get("updated", ""))
+                    status = "current" if fetch_data.is_current(
+                        entry, cache_hash, updated) else "stale"
+                counts[status] += 1
+                log_status(entry["name"], status)
+    fetch_data.meta_cache.close()
+    fetch_data.stats.close()
+
+
+def log_status(name: str, status: str):
+    if status == "corrupt":
+        console(Fore.RED + f"{name} was changed or damaged since it was saved")
+    elif status == "missing":
+        console(Fore.RED + f"{name} is missing")
+    elif status == "stale":
+        console(Fore.YELLOW + f"{name} is an older version of the fic"
+                + Style.RESET_ALL)
+    emit("verified", file=name, status=status)
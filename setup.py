@@ -20,7 +20,6 @@ setup(
         'requests>=2.31.0',
         'loguru>=0.6.0',
         'tqdm>=4.60.0',
-        'BeautifulSoup4>=4.9.3',
         'colorama>=0.4.4',
         'platformdirs>=2.5.1'
     ],
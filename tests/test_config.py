@@ -0,0 +1,48 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+from types import SimpleNamespace
+
+from fichub_cli.utils.config import Config, DEFAULT_CONFIG
+
+
+def test_config_written_only_when_changed(tmpdir):
+    config = Config(SimpleNamespace(user_data_dir=str(tmpdir)))
+    config.save()
+    config_file = tmpdir.join("config.json")
+    assert json.loads(config_file.read()) == DEFAULT_CONFIG
+
+    os.utime(str(config_file), ns=(0, 0))
+    config.save()
+    assert os.stat(str(config_file)).st_mtime_ns == 0
+
+    # the missing settings are added, the existing ones are kept
+    config_file.write(json.dumps({"filename_format": "[title]"}))
+    config.save()
+    assert json.loads(config_file.read()) == dict(
+        DEFAULT_CONFIG, filename_format="[title]")
+
+
+def test_config_reloaded_on_change(tmpdir):
+    config = Config(SimpleNamespace(user_data_dir=str(tmpdir)))
+    assert config["api_key_v0"] == ""
+
+    tmpdir.join("config.json").write(json.dumps(
+        {"api_key_v0": "key", "delete_output_log": "maybe"}))
+    assert config["api_key_v0"] == "key"
+    # invalid values fall back to the defaults
+    assert config["delete_output_log"] == ""
+    assert config["filename_format"] == ""
@@ -0,0 +1,82 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+
+from fichub_cli.utils.manifest import HashManifest, hash_file
+from fichub_cli.utils.processing import check_freshness
+
+
+def test_manifest_reuses_recorded_hash(tmpdir):
+    ebook_file = os.path.join(str(tmpdir), "fic.epub")
+    with open(ebook_file, "wb") as f:
+        f.write(b"epub data")
+
+    manifest = HashManifest(str(tmpdir))
+    manifest.record(ebook_file, "recorded-hash")
+
+    # size & mtime unchanged, so the recorded hash is trusted
+    assert manifest.file_hash(ebook_file) == "recorded-hash"
+
+
+def test_manifest_rehashes_changed_file(tmpdir):
+    ebook_file = os.path.join(str(tmpdir), "fic.epub")
+    with open(ebook_file, "wb") as f:
+        f.write(b"epub data")
+
+    manifest = HashManifest(str(tmpdir))
+    manifest.record(ebook_file, "recorded-hash")
+
+    with open(ebook_file, "wb") as f:
+        f.write(b"updated epub data")
+
+    expected_hash = hashlib.md5(b"updated epub data").hexdigest()
+    assert hash_file(ebook_file) == expected_hash
+    assert manifest.file_hash(ebook_file) == expected_hash
+    assert manifest.get(ebook_file)["hash"] == expected_hash
+
+
+def test_check_freshness_for_other_formats(tmpdir):
+    ebook_file = os.path.join(str(tmpdir), "fic.pdf")
+    with open(ebook_file, "wb") as f:
+        f.write(b"pdf data")
+
+    manifest = HashManifest(str(tmpdir))
+    meta = {"updated": "2022-01-01T00:00:00"}
+    assert not check_freshness(ebook_file, "epub-hash", meta, manifest)
+
+    manifest.record(ebook_file, hash_file(ebook_file),
+                    source_hash="epub-hash", updated=meta["updated"])
+    assert check_freshness(ebook_file, "epub-hash", meta, manifest)
+    assert not check_freshness(ebook_file, "new-epub-hash",
+                               {"updated": "2022-02-01T00:00:00"}, manifest)
+
+
+def test_manifest_urls(tmpdir):
+    manifest = HashManifest(str(tmpdir))
+    for name, url in (("a.epub", "https://a"), ("a.pdf", "https://a"),
+                      ("b.epub", "https://b"), ("c.epub", None)):
+        ebook_file = os.path.join(str(tmpdir), name)
+        with open(ebook_file, "wb") as f:
+            f.write(name.encode())
+        manifest.record(ebook_file, hash_file(ebook_file), url=url)
+
+    manifest.update(os.path.join(str(tmpdir), "c.epub"), url="https://c")
+    assert manifest.get(os.path.join(str(tmpdir), "c.epub"))["hash"] == \
+        hashlib.md5(b"c.epub").hexdigest()
+    assert manifest.url_count() == 3
+    assert list(manifest.urls(page_size=2)) == ["https://a", "https://b", "https://c"]
+    assert sorted(entry["name"] for entry in manifest.url_entries("https://a")) == \
+        ["a.epub", "a.pdf"]
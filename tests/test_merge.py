@@ -0,0 +1,51 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from fichub_cli.utils.merge import merge_shards, read_changelog
+from fichub_cli.utils.processing import build_changelog
+from fichub_cli.utils.state import StateStore, STATE_FILE
+from fichub_cli.utils.url_stream import in_shard
+
+
+def test_merge_shards(tmpdir):
+    urls = [f"https://archiveofourown.org/works/{i}" for i in range(10)]
+    shard_dirs = []
+    for index in (1, 2):
+        shard_dir = tmpdir.mkdir(f"shard{index}")
+        shard_dirs.append(str(shard_dir))
+        shard_urls = [url for url in urls if in_shard(url, (index, 2))]
+        state = StateStore(str(shard_dir.join(STATE_FILE)))
+        for url in shard_urls[1:]:
+            state.record(url, "downloaded")
+        state.record(shard_urls[0], "error")
+        state.close()
+        build_changelog(urls, urls, shard_urls, shard_urls[1:], shard_urls[:1],
+                        [], str(shard_dir))
+
+    out_dir = tmpdir.mkdir("merged")
+    assert merge_shards(shard_dirs, str(out_dir)) == {
+        "shards": 2, "urls": 10, "changelogs": 2}
+
+    assert sorted(out_dir.join("output.log").read().splitlines() +
+                  out_dir.join("err.log").read().splitlines()) == sorted(urls)
+    assert len(out_dir.join("err.log").read().splitlines()) == 2
+
+    changelog, = out_dir.listdir("CHANGELOG*")
+    totals, sections = read_changelog(str(changelog))
+    # the shards read the same input
+    assert totals["Total URLs given as input"] == 10
+    assert totals["Total URLs after comparing with the output.log"] == 10
+    assert totals["Total URLs/Files downloaded"] == 8
+    assert sorted(sections["URLs after comparing with the output.log"]) == \
+        sorted(urls)
@@ -0,0 +1,40 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+
+from fichub_cli.utils.meta_cache import MetadataCache
+
+response = {"meta": {"title": "Fic"}, "urls": {"epub": "/cache/epub/fic.epub"},
+            "hashes": {"epub": "hash"}, "err": 0}
+
+
+def test_meta_cache_max_age(tmpdir):
+    cache = MetadataCache(SimpleNamespace(user_data_dir=str(tmpdir)))
+    cache.put("https://Archiveofourown.org/works/1/", response)
+
+    cached = cache.get("https://archiveofourown.org/works/1", 3600)
+    assert cached == {key: response[key] for key in ("meta", "urls", "hashes")}
+    assert cache.get("https://archiveofourown.org/works/1", -1) is None
+
+
+def test_meta_cache_evicts_oldest(tmpdir):
+    cache = MetadataCache(SimpleNamespace(user_data_dir=str(tmpdir)),
+                          max_entries=2)
+    for work_id in range(3):
+        cache.put(f"https://archiveofourown.org/works/{work_id}", response)
+    cache.evict()
+
+    assert cache.get("https://archiveofourown.org/works/0", 3600) is None
+    assert cache.get("https://archiveofourown.org/works/2", 3600) is not None
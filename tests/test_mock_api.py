@@ -0,0 +1,421 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+import typer
+from requests.exceptions import ChunkedEncodingError, HTTPError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "benchmarks"))
+from mock_api import MockSettings, make_server  # noqa: E402
+
+from fichub_cli.utils.fetch_data import FetchData  # noqa: E402
+from fichub_cli.utils.fichub import FicHub, FicHubSession, \
+    IncompleteDownload  # noqa: E402
+from fichub_cli.utils.manifest import get_manifest, hash_file  # noqa: E402
+from fichub_cli.utils.output import set_output_mode  # noqa: E402
+from fichub_cli.utils.serve import JobRunner  # noqa: E402
+from fichub_cli.utils.serve import make_server as make_job_server  # noqa: E402
+from fichub_cli.utils.url_stream import UrlStream  # noqa: E402
+from fichub_cli.utils.verify import verify_library  # noqa: E402
+
+
+@pytest.fixture
+def mock_api(tmpdir, monkeypatch):
+    # keeps the state, metadata cache & config out of the user's dirs
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmpdir.join("data")))
+
+    settings = MockSettings(file_size=10000)
+    server = make_server(settings)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield settings, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_mock_api_batch(tmpdir, mock_api):
+    settings, api_url = mock_api
+    out_dir = tmpdir.mkdir("out")
+    urls = [f"https://archiveofourown.org/works/{work_id}" for work_id in range(5)]
+
+    fic = FetchData(out_dir=str(out_dir), workers=2,
+                    session=FicHubSession(base_url=api_url))
+    fic.download_urls(UrlStream(urls, len(urls)))
+
+    files = sorted(out_dir.listdir("*.epub"))
+    assert len(files) == 5
+    for ebook_file in files:
+        fic_id = ebook_file.purebasename.rsplit("-", 1)[1]
+        assert os.path.getsize(str(ebook_file)) == 10000
+        assert hash_file(str(ebook_file)) == settings.ebook_hash(fic_id)
+
+
+def test_mock_api_rate_limited(tmpdir, mock_api):
+    settings, api_url = mock_api
+    settings.rate_limit_rate = 0.3
+    settings.retry_after = 0
+    out_dir = tmpdir.mkdir("out")
+    urls = [f"https://archiveofourown.org/works/{work_id}" for work_id in range(5)]
+
+    session = FicHubSession(base_url=api_url)
+    fic = FetchData(out_dir=str(out_dir), workers=2, session=session)
+    fic.download_urls(UrlStream(urls, len(urls)))
+
+    # the 429s are retried by the scheduler
+    assert len(out_dir.listdir("*.epub")) == 5
+    assert session.scheduler.throttled > 0
+
+
+def download(api_url: str, out_dir, fic_url: str) -> tuple:
+    fic = FicHub(False, False, 0, FicHubSession(base_url=api_url))
+    fic.get_fic_metadata(fic_url, [0])
+    (file_name, file_data), = ((name, data) for name, data in fic.files.items()
+                               if name != "meta")
+    ebook_file = str(out_dir.join(file_name))
+    return fic, ebook_file, file_data
+
+
+def test_mock_api_interrupted_download(tmpdir, mock_api):
+    settings, api_url = mock_api
+    fic, ebook_file, file_data = download(
+        api_url, tmpdir, "https://archiveofourown.org/works/1")
+    ebook_hash = fic.save_fic_data(file_data["download_url"], ebook_file)
+    # the hash computed while streaming is the hash of the saved file
+    assert ebook_hash == file_data["hash"] == hash_file(ebook_file)
+
+    # every attempt is cut in the middle, the saved file is kept as it was
+    tmpdir.join(os.path.basename(ebook_file)).write(b"old version", "wb")
+    settings.truncate_rate = 1
+    with pytest.raises((ChunkedEncodingError, IncompleteDownload)):
+        fic.save_fic_data(file_data["download_url"], ebook_file,
+                          expected_hash=file_data["hash"])
+    assert tmpdir.join(os.path.basename(ebook_file)).read_binary() == \
+        b"old version"
+
+
+def test_mock_api_server_errors(tmpdir, mock_api):
+    settings, api_url = mock_api
+    fic, ebook_file, file_data = download(
+        api_url, tmpdir, "https://archiveofourown.org/works/1")
+    fic.save_fic_data(file_data["download_url"], ebook_file)
+
+    # the error body of the last retry isn't saved over the ebook
+    settings.server_error_rate = 1
+    settings.retry_after = 0
+    with pytest.raises(HTTPError) as e:
+        fic.save_fic_data(file_data["download_url"], ebook_file,
+                          expected_hash=file_data["hash"])
+    assert e.value.response.status_code == 503
+    assert hash_file(ebook_file) == file_data["hash"]
+    assert not os.path.exists(ebook_file + ".part")
+
+
+def test_mock_api_resume_download(tmpdir, mock_api):
+    settings, api_url = mock_api
+    settings.file_size = 1000000
+    fic, ebook_file, file_data = download(
+        api_url, tmpdir, "https://archiveofourown.org/works/1")
+
+    # the first response is cut in the middle & resumed with a Range request
+    settings.truncate_next = 1
+    ebook_hash = fic.save_fic_data(file_data["download_url"], ebook_file,
+                                   expected_hash=file_data["hash"])
+    assert ebook_hash == file_data["hash"] == hash_file(ebook_file)
+    assert settings.range_requests == 1
+    assert not os.path.exists(ebook_file + ".part")
+    assert not os.path.exists(ebook_file + ".part.json")
+
+
+def test_mock_api_resume_fallback(tmpdir, mock_api):
+    settings, api_url = mock_api
+    fic, ebook_file, file_data = download(
+        api_url, tmpdir, "https://archiveofourown.org/works/1")
+    etag = f'"{file_data["hash"]}"'
+
+    # a corrupted .part from a previous run fails the md5 check
+    tmpdir.join(os.path.basename(ebook_file) + ".part").write(b"x" * 5000, "wb")
+    tmpdir.join(os.path.basename(ebook_file) + ".part.json").write(
+        json.dumps({"url": file_data["download_url"], "etag": etag}))
+    assert fic.save_fic_data(file_data["download_url"], ebook_file,
+                             expected_hash=file_data["hash"]) == file_data["hash"]
+    assert settings.range_requests == 1
+    assert hash_file(ebook_file) == file_data["hash"]
+
+    # the server ignoring the Range header restarts the download
+    settings.range_support = False
+    tmpdir.join(os.path.basename(ebook_file) + ".part").write(b"x" * 5000, "wb")
+    tmpdir.join(os.path.basename(ebook_file) + ".part.json").write(
+        json.dumps({"url": file_data["download_url"], "etag": etag}))
+    assert fic.save_fic_data(file_data["download_url"], ebook_file) == \
+        file_data["hash"]
+    assert not os.path.exists(ebook_file + ".part")
+
+
+def test_mock_api_resume_misaligned(tmpdir, mock_api):
+    settings, api_url = mock_api
+    fic, ebook_file, file_data = download(
+        api_url, tmpdir, "https://archiveofourown.org/works/1")
+
+    # the 206 doesn't start at the end of the .part, the whole file is
+    # downloaded again
+    settings.range_shift = 100
+    tmpdir.join(os.path.basename(ebook_file) + ".part").write(b"x" * 5000, "wb")
+    tmpdir.join(os.path.basename(ebook_file) + ".part.json").write(
+        json.dumps({"url": file_data["download_url"],
+                    "etag": f'"{file_data["hash"]}"'}))
+    assert fic.save_fic_data(file_data["download_url"], ebook_file) == \
+        file_data["hash"]
+    assert settings.range_requests == 1
+    assert os.path.getsize(ebook_file) == 10000
+    assert hash_file(ebook_file) == file_data["hash"]
+
+
+def test_mock_api_stats(tmpdir, mock_api):
+    settings, api_url = mock_api
+    out_dir = tmpdir.mkdir("out")
+    stats_file = tmpdir.join("stats.jsonl")
+    urls = [f"https://archiveofourown.org/works/{work_id}" for work_id in range(3)]
+
+    fic = FetchData(out_dir=str(out_dir), changelog=True,
+                    session=FicHubSession(base_url=api_url),
+                    stats_file=str(stats_file))
+    fic.download_urls(UrlStream(urls, len(urls), keep_lists=True))
+
+    timings = [json.loads(line) for line in stats_file.readlines()]
+    assert sorted(url_timings["url"] for url_timings in timings) == urls
+    for url_timings in timings:
+        assert url_timings["outcome"] == "downloaded"
+        assert url_timings["bytes"] == 10000
+        assert url_timings["total"] >= url_timings["metadata"] > 0
+
+    changelog, = out_dir.listdir("CHANGELOG*")
+    assert "## Timings per URL" in changelog.read()
+
+
+def test_mock_api_not_modified(tmpdir, mock_api):
+    settings, api_url = mock_api
+    out_dir = tmpdir.mkdir("out")
+    stats_file = tmpdir.join("stats.jsonl")
+    url = "https://archiveofourown.org/works/1"
+    session = FicHubSession(base_url=api_url)
+    FetchData(format_type=[2], out_dir=str(out_dir), session=session) \
+        .download_urls(UrlStream([url], 1))
+    pdf_file, = out_dir.listdir("*.pdf")
+
+    # the pdf looks outdated, the conditional GET finds it unchanged
+    get_manifest(str(out_dir)).update(str(pdf_file), source_hash="old",
+                                      updated="2020-01-01T00:00:00")
+    fic = FetchData(format_type=[2], out_dir=str(out_dir), session=session,
+                    stats_file=str(stats_file))
+    fic.update_library()
+
+    assert settings.conditional_requests == 1
+    url_timings, = [json.loads(line) for line in stats_file.readlines()]
+    assert url_timings["outcome"] == "no_updates"
+    assert url_timings["bytes"] == 0
+    assert pdf_file.size() == 10000
+
+
+def test_mock_api_json_output(tmpdir, mock_api, capsys):
+    settings, api_url = mock_api
+    out_dir = tmpdir.mkdir("out")
+    urls = [f"https://archiveofourown.org/works/{work_id}" for work_id in range(3)]
+    urls.append("https://example.com/not-a-fic")
+
+    set_output_mode("json")
+    try:
+        fic = FetchData(out_dir=str(out_dir), workers=2,
+                        session=FicHubSession(base_url=api_url))
+        fic.download_urls(UrlStream(urls, len(urls)))
+    finally:
+        set_output_mode()
+
+    # only the events are written to stdout
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert events[0]["event"] == "start" and events[0]["urls"] == 4
+    done = {event["url"]: event["outcome"] for event in events
+            if event["event"] == "done"}
+    assert list(done.values()).count("downloaded") == 3
+    assert done["https://example.com/not-a-fic"] == "error"
+    assert sum(event["event"] == "downloaded" for event in events) == 3
+    assert events[-1]["event"] == "summary"
+    assert events[-1]["downloaded"] == 3 and events[-1]["errors"] == 1
+
+
+def test_mock_api_serve(tmpdir, mock_api):
+    settings, api_url = mock_api
+    out_dir = tmpdir.mkdir("out")
+    runner = JobRunner(FicHubSession(base_url=api_url), workers=2)
+    server = make_job_server(runner, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        for job_id, work_ids in ((1, range(3)), (2, range(3, 5))):
+            job = {"urls": [f"https://archiveofourown.org/works/{work_id}"
+                            for work_id in work_ids], "out_dir": str(out_dir)}
+            request = urllib.request.Request(
+                f"{server_url}/jobs", data=json.dumps(job).encode())
+            with urllib.request.urlopen(request) as response:
+                events = [json.loads(line) for line in response]
+
+            # the events of the job are streamed back
+            assert events[0] == {**events[0], "event": "job", "id": job_id}
+            assert events[-1]["event"] == "job_done"
+            assert events[-1]["exit_status"] == 0
+            assert sum(event["event"] == "downloaded" for event in events) == \
+                len(work_ids)
+
+        # the urls of an earlier job are checked for updates again
+        job = {"urls": ["https://archiveofourown.org/works/0"],
+               "out_dir": str(out_dir)}
+        request = urllib.request.Request(
+            f"{server_url}/jobs", data=json.dumps(job).encode())
+        with urllib.request.urlopen(request) as response:
+            events = [json.loads(line) for line in response]
+        assert [event["outcome"] for event in events
+                if event["event"] == "done"] == ["no_updates"]
+        assert sum(event["event"] == "metadata" for event in events) == 1
+
+        with urllib.request.urlopen(f"{server_url}/status") as response:
+            status = json.loads(response.read())
+        # the connections are reused between the jobs
+        assert status["jobs"] == 3
+        assert status["connections"]["connections"] < 5
+        assert len(out_dir.listdir("*.epub")) == 5
+
+        for job in ({"urls": []},
+                    # the output directories are kept inside the root
+                    {"urls": ["https://archiveofourown.org/works/1"],
+                     "out_dir": str(tmpdir.dirpath())},
+                    {"urls": ["https://archiveofourown.org/works/1"],
+                     "out_dir": "../"}):
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(urllib.request.Request(
+                    f"{server_url}/jobs", data=json.dumps(job).encode()))
+            assert e.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+        set_output_mode()
+
+    # the unauthenticated jobs aren't accepted from the network by default
+    with pytest.raises(typer.BadParameter):
+        make_job_server(runner, host="0.0.0.0", port=0)
+
+
+def test_mock_api_update_library(tmpdir, mock_api):
+    settings, api_url = mock_api
+    out_dir = tmpdir.mkdir("out")
+    urls = [f"https://archiveofourown.org/works/{work_id}" for work_id in range(3)]
+    session = FicHubSession(base_url=api_url)
+    FetchData(out_dir=str(out_dir), session=session).download_urls(
+        UrlStream(urls, len(urls)))
+
+    # a new version of one fic
+    changed_id = settings.fic_id(urls[1])
+    settings.size = lambda fic_id: 12000 if fic_id == changed_id else 10000
+    settings.hashes.pop(changed_id)
+    mtimes = {str(ebook_file): os.stat(str(ebook_file)).st_mtime_ns
+              for ebook_file in out_dir.listdir("*.epub")}
+
+    fic = FetchData(out_dir=str(out_dir), workers=2, session=session)
+    fic.update_library()
+
+    assert fic.stats.urls == 3
+    assert fic.stats.bytes == 12000
+    for ebook_file, mtime in mtimes.items():
+        if changed_id in ebook_file:
+            assert os.path.getsize(ebook_file) == 12000
+        else:  # the unchanged fics aren't downloaded again
+            assert os.stat(ebook_file).st_mtime_ns == mtime
+
+
+def test_mock_api_update_library_renamed(tmpdir, mock_api, capsys):
+    settings, api_url = mock_api
+    out_dir = tmpdir.mkdir("out")
+    url = "https://archiveofourown.org/works/1"
+    session = FicHubSession(base_url=api_url)
+    FetchData(out_dir=str(out_dir), session=session).download_urls(
+        UrlStream([url], 1))
+
+    # a file saved under the old name of the fic
+    old_file = out_dir.join("Old-Title-by-Author.epub")
+    old_file.write(b"old version", "wb")
+    get_manifest(str(out_dir)).record(str(old_file), hash_file(str(old_file)),
+                                      source_hash="old", url=url)
+
+    capsys.readouterr()
+    set_output_mode("json")
+    try:
+        # the fic isn't reported as changed by every sweep
+        for run in range(2):
+            fic = FetchData(out_dir=str(out_dir), session=session)
+            fic.update_library()
+            events = [json.loads(line)
+                      for line in capsys.readouterr().out.splitlines()]
+            assert events[-1]["event"] == "summary"
+            assert events[-1]["checked"] == 1
+            assert events[-1]["changed"] == 0
+            assert events[-1]["bytes"] == 0
+    finally:
+        set_output_mode()
+
+
+def test_mock_api_verify(tmpdir, mock_api):
+    settings, api_url = mock_api
+    out_dir = tmpdir.mkdir("out")
+    urls = [f"https://archiveofourown.org/works/{work_id}" for work_id in range(4)]
+    session = FicHubSession(base_url=api_url)
+    FetchData(out_dir=str(out_dir), session=session).download_urls(
+        UrlStream(urls, len(urls)))
+    ebook_files = {work_id: str(out_dir.join(
+        f"Mock-Fic-by-Author-{settings.fic_id(url)}.epub"))
+        for work_id, url in enumerate(urls)}
+
+    # a damaged file with the same size & mtime, a deleted file & a new
+    # version of a fic
+    stat = os.stat(ebook_files[0])
+    with open(ebook_files[0], "r+b") as f:
+        f.write(b"x" * 100)
+    os.utime(ebook_files[0], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.remove(ebook_files[1])
+    changed_id = settings.fic_id(urls[2])
+    settings.size = lambda fic_id: 12000 if fic_id == changed_id else 10000
+    settings.hashes.pop(changed_id)
+
+    assert verify_library(str(out_dir), workers=2) == {
+        "verified": 4, "current": 2, "stale": 0, "corrupt": 1, "missing": 1,
+        "unchecked": 0}
+    # the corrupt file is still reported by the next runs
+    assert verify_library(str(out_dir), workers=2)["corrupt"] == 1
+    counts = verify_library(str(out_dir), workers=2, fetch_data=FetchData(
+        out_dir=str(out_dir), meta_workers=2, session=session))
+    assert counts == {"verified": 4, "current": 1, "stale": 1, "corrupt": 1,
+                      "missing": 1, "unchecked": 0}
+
+    # the corrupt, missing & stale files are downloaded again
+    fic = FetchData(out_dir=str(out_dir), session=session)
+    fic.update_library()
+    assert fic.stats.bytes == 10000 * 2 + 12000
+    assert verify_library(str(out_dir), workers=2)["current"] == 4
@@ -0,0 +1,80 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from types import SimpleNamespace
+
+import typer
+from typer.testing import CliRunner
+
+from fichub_cli.utils import plugins
+
+plugin_source = '''
+import typer
+
+app = typer.Typer()
+
+
+@app.callback(invoke_without_command=True)
+def dummy():
+    """ Dummy plugin """
+    typer.echo("dummy plugin")
+'''
+
+
+def make_app(tmpdir):
+    app = typer.Typer(
+        cls=plugins.plugin_group(SimpleNamespace(user_data_dir=str(tmpdir))))
+
+    @app.callback()
+    def default():
+        pass
+    return app
+
+
+def test_plugins_cached_and_lazy(tmpdir, monkeypatch):
+    plugin_dir = tmpdir.mkdir("site-packages")
+    plugin_dir.join("fichub_cli_dummy.py").write(plugin_source)
+    monkeypatch.syspath_prepend(str(plugin_dir))
+
+    assert plugins.discover_plugins(SimpleNamespace(user_data_dir=str(tmpdir))) == {
+        "dummy": {"target": "fichub_cli_dummy:app", "help": "Dummy plugin"}}
+    assert tmpdir.join(plugins.PLUGIN_CACHE_FILE).exists()
+
+    # served from the cache, without importing the plugin
+    sys.modules.pop("fichub_cli_dummy")
+    monkeypatch.setattr(plugins, "scan_plugins", lambda: {})
+    result = CliRunner().invoke(make_app(tmpdir), ["--help"])
+    assert "Dummy plugin" in result.output
+    assert "fichub_cli_dummy" not in sys.modules
+
+    result = CliRunner().invoke(make_app(tmpdir), ["dummy"])
+    assert result.output == "dummy plugin\n"
+    sys.modules.pop("fichub_cli_dummy")
+
+
+def test_plugins_entry_points(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugins, "iter_entry_points", lambda group: [
+        SimpleNamespace(name="dummy-ep", value="fichub_cli_dummy_ep:app")])
+    plugin_dir = tmpdir.mkdir("site-packages")
+    plugin_dir.join("fichub_cli_dummy_ep.py").write(plugin_source)
+    monkeypatch.syspath_prepend(str(plugin_dir))
+
+    assert plugins.scan_plugins()["dummy-ep"] == {
+        "target": "fichub_cli_dummy_ep:app", "help": ""}
+    assert "fichub_cli_dummy_ep" not in sys.modules
+
+    result = CliRunner().invoke(make_app(tmpdir), ["dummy-ep"])
+    assert result.output == "dummy plugin\n"
+    sys.modules.pop("fichub_cli_dummy_ep")
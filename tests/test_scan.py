@@ -0,0 +1,75 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import zipfile
+
+from fichub_cli.utils.manifest import get_manifest, hash_file
+from fichub_cli.utils.scan import read_epub, scan_library
+from fichub_cli.utils.state import StateStore
+
+CONTAINER = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>"""
+
+OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>{title}</dc:title>
+    <dc:identifier id="BookId">{identifier}</dc:identifier>
+    {source}
+  </metadata>
+</package>"""
+
+
+def write_epub(path: str, title: str, identifier: str, source: str = ""):
+    with zipfile.ZipFile(path, "w") as epub:
+        epub.writestr("mimetype", "application/epub+zip")
+        epub.writestr("META-INF/container.xml", CONTAINER)
+        epub.writestr("OEBPS/content.opf", OPF.format(
+            title=title, identifier=identifier,
+            source=f"<dc:source>{source}</dc:source>" if source else ""))
+
+
+def test_scan_library(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    out_dir = tmpdir.mkdir("library")
+    write_epub(str(out_dir.join("a.epub")), "Fic A", "uuid-a",
+               "https://archiveofourown.org/works/1/chapters/2")
+    # the url in an identifier
+    write_epub(str(out_dir.join("b.epub")), "Fic B",
+               "https://www.fanfiction.net/s/2/1/Fic-B")
+    write_epub(str(out_dir.join("c.epub")), "Fic C", "uuid-c")
+    out_dir.join("d.epub").write(b"not a zip", "wb")
+
+    counts = scan_library(str(out_dir), workers=2, resume_state=True)
+    assert counts == {"scanned": 4, "recorded": 2, "no_url": 1,
+                      "unreadable": 1, "skipped": 0}
+
+    manifest = get_manifest(str(out_dir))
+    entry = manifest.get("a.epub")
+    assert entry["url"] == "https://archiveofourown.org/works/1"
+    assert entry["hash"] == entry["source_hash"] == \
+        hash_file(str(out_dir.join("a.epub")))
+    assert manifest.get("b.epub")["url"] == "https://www.fanfiction.net/s/2/1/"
+    assert manifest.get("c.epub")["url"] is None
+    assert StateStore().is_processed("https://archiveofourown.org/works/1")
+
+    # the recorded files are skipped on the next scan
+    assert scan_library(str(out_dir), workers=2)["skipped"] == 2
+
+    # a file deleted during the scan is reported, not raised
+    assert read_epub(str(out_dir.join("deleted.epub")))["error"]
@@ -0,0 +1,58 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from email.utils import formatdate
+
+from fichub_cli.utils.scheduler import RequestScheduler, parse_retry_after, \
+    parse_rate_limit
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("2") == 2
+    assert 50 < parse_retry_after(formatdate(time.time() + 60, usegmt=True)) <= 60
+    assert parse_retry_after("soon") is None
+    assert parse_rate_limit({"X-RateLimit-Remaining": "0",
+                             "X-RateLimit-Reset": "5"}) == 5
+    assert parse_rate_limit({"RateLimit-Remaining": "3",
+                             "RateLimit-Reset": "5"}) is None
+
+
+def test_scheduler_aimd():
+    scheduler = RequestScheduler(max_concurrency=8)
+    assert scheduler.rate is None
+
+    # a burst of 429s for the requests in flight only halves once
+    started = [scheduler.acquire() for _ in range(4)]
+    for request_start in started:
+        scheduler.release(request_start, 429, {})
+    assert int(scheduler.limit) == 4
+    assert scheduler.rate is not None
+    rate = scheduler.rate
+
+    # additive increase on the successes
+    for _ in range(20):
+        scheduler.release(scheduler.acquire(), 200, {})
+    assert 4 < scheduler.limit <= 8
+    assert scheduler.rate > rate
+
+
+def test_scheduler_retry_after():
+    scheduler = RequestScheduler(max_concurrency=2)
+    assert scheduler.release(scheduler.acquire(), 429,
+                             {"Retry-After": "0.2"}) == 0.2
+
+    start = time.monotonic()
+    scheduler.release(scheduler.acquire(), 200, {})
+    assert time.monotonic() - start >= 0.15
@@ -0,0 +1,47 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from fichub_cli.utils.sites import canonical_url
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://www.fanfiction.net/s/123/1/Title", "https://www.fanfiction.net/s/123/1/"),
+    ("https://www.fanfiction.net/s/123/5/", "https://www.fanfiction.net/s/123/1/"),
+    ("m.fanfiction.net/s/123", "https://www.fanfiction.net/s/123/1/"),
+    ("https://www.fictionpress.com/s/42/3/Title", "https://www.fictionpress.com/s/42/1/"),
+    ("https://archiveofourown.org/works/10916730/chapters/24276864",
+     "https://archiveofourown.org/works/10916730"),
+    ("https://archiveofourown.org/collections/col/works/10916730",
+     "https://archiveofourown.org/works/10916730"),
+    ("https://forums.spacebattles.com/threads/some-fic.12345/page-3",
+     "https://forums.spacebattles.com/threads/12345/"),
+    ("https://Forums.SufficientVelocity.com/threads/12345/",
+     "https://forums.sufficientvelocity.com/threads/12345/"),
+    ("https://www.parahumans.net/2017/10/21/glow-worm-0-1/#comments",
+     "https://www.parahumans.net/2017/10/21/glow-worm-0-1"),
+])
+def test_canonical_url(url, expected):
+    assert canonical_url(url) == expected
+
+
+@pytest.mark.parametrize("url", [
+    "https://archiveofourown.org/series/1234",
+    "https://www.fanfiction.net/u/1234/Author",
+    "https://example.com/s/123",
+    "not a url",
+])
+def test_canonical_url_unsupported(url):
+    assert canonical_url(url) is None
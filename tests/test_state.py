@@ -0,0 +1,64 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from fichub_cli.utils.state import StateStore, DONE_STATUSES
+
+
+def test_state_import_export(tmpdir):
+    output_log = os.path.join(str(tmpdir), "output.log")
+    err_log = os.path.join(str(tmpdir), "err.log")
+    with open(output_log, "w") as f:
+        f.write("https://archiveofourown.org/works/1/chapters/2\n")
+    with open(err_log, "w") as f:
+        f.write("https://archiveofourown.org/works/3\n")
+
+    state = StateStore(os.path.join(str(tmpdir), "state.db"))
+    assert state.import_logs(output_log, err_log) == 2
+    # unchanged log files are not imported again
+    assert state.import_logs(output_log, err_log) == 0
+
+    assert state.get("https://archiveofourown.org/works/1") == "downloaded"
+    assert state.get("https://archiveofourown.org/works/3") == "error"
+
+    state.record("https://archiveofourown.org/works/4", "no_updates")
+    state.export_logs(output_log, err_log)
+    with open(output_log, "r") as f:
+        assert f.read().splitlines() == [
+            "https://archiveofourown.org/works/1",
+            "https://archiveofourown.org/works/4"]
+
+    state.clear(DONE_STATUSES)
+    assert not state.is_processed("https://archiveofourown.org/works/1")
+    assert state.is_processed("https://archiveofourown.org/works/3")
+
+
+def test_state_merge(tmpdir):
+    state = StateStore(os.path.join(str(tmpdir), "state.db"))
+    state.record("https://archiveofourown.org/works/1", "error")
+    state.record("https://archiveofourown.org/works/2", "downloaded")
+    state.flush()
+
+    shard = StateStore(os.path.join(str(tmpdir), "shard.db"))
+    shard.record("https://archiveofourown.org/works/1", "downloaded")
+    shard.record("https://archiveofourown.org/works/3", "no_updates")
+    shard.close()
+
+    # the most recent status of each url is kept
+    assert state.merge(os.path.join(str(tmpdir), "shard.db")) == 2
+    assert state.get("https://archiveofourown.org/works/1") == "downloaded"
+    assert state.get("https://archiveofourown.org/works/2") == "downloaded"
+    assert state.get("https://archiveofourown.org/works/3") == "no_updates"
+    assert state.merge(os.path.join(str(tmpdir), "shard.db")) == 0
@@ -0,0 +1,39 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from fichub_cli.utils.stats import RunStats, UrlTimings, percentile
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 99) == 3.0
+    assert percentile([], 50) == 0.0
+
+
+def test_run_stats_summary():
+    stats = RunStats()
+    for work_id in range(10):
+        timings = UrlTimings(f"https://archiveofourown.org/works/{work_id}")
+        timings.metadata = work_id / 10
+        timings.bytes = 100
+        timings.retries = work_id % 2
+        stats.add(timings)
+
+    summary = stats.summary()
+    assert summary[0] == "Timings of 10 urls (p50 / p95 / p99):"
+    assert summary[1].split() == ["metadata", "0.400s", "/", "0.900s", "/", "0.900s"]
+    assert summary[-1] == "  Bytes downloaded: 1000 | Retries: 5"
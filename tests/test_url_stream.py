@@ -0,0 +1,63 @@
+# Copyright 2021 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from fichub_cli.utils.url_stream import DigestSet, SpillList, UrlStream, \
+    in_shard
+
+
+def test_digest_set_spills_to_disk():
+    seen = DigestSet(threshold=10)
+    assert all(seen.add(f"https://archiveofourown.org/works/{i}") for i in range(50))
+    assert not seen.add("https://archiveofourown.org/works/3")
+    assert not seen.add("https://archiveofourown.org/works/42")
+    seen.close()
+
+
+def test_spill_list_spills_to_disk():
+    urls = SpillList(threshold=10)
+    for i in range(25):
+        urls.append(f"https://archiveofourown.org/works/{i}")
+    assert len(urls) == 25
+    assert list(urls)[-1] == "https://archiveofourown.org/works/24"
+    urls.close()
+
+
+def test_url_stream_counts(tmpdir):
+    with tmpdir.as_cwd():
+        urls_input = ["https://archiveofourown.org/works/1",
+                      "https://archiveofourown.org/works/1/chapters/2",
+                      "",
+                      "https://www.fanfiction.net/s/123/4/Title"]
+        stream = UrlStream(urls_input, len(urls_input), keep_lists=True)
+
+        assert list(stream) == ["https://archiveofourown.org/works/1",
+                                "https://www.fanfiction.net/s/123/1/"]
+        assert len(stream.urls_input) == 4
+        assert len(stream.urls_input_dedup) == 2
+        assert stream.skipped == 2
+
+
+def test_url_stream_shards(tmpdir):
+    with tmpdir.as_cwd():
+        urls_input = [f"https://archiveofourown.org/works/{i}" for i in range(100)]
+        shards = [list(UrlStream(urls_input, len(urls_input), shard=(i, 3)))
+                  for i in range(1, 4)]
+
+        # each url is in exactly one shard, the same on every run
+        assert sorted(sum(shards, [])) == sorted(urls_input)
+        assert all(shards)
+        assert all(in_shard(url, (2, 3)) for url in shards[1])
+        assert list(UrlStream(["https://archiveofourown.org/works/5/chapters/9"],
+                              1, shard=(1, 1))) == \
+            ["https://archiveofourown.org/works/5"]